@@ -2,7 +2,6 @@
 from flask import jsonify, request, g, json
 
 from backend.api.login import post_login
-from backend.data_ingestion.graph.persist_data import load_nodes
 from backend.routes.route_builder import build_routes, routes_to_geojson, MILES_TO_METERS
 from backend.users.manage_user_profiles import load_user_profile
 
@@ -92,14 +91,15 @@ def get_routes():
             "max_routes": max_routes,
         }
 
-        scored_routes = build_routes(**params, return_scores=True)
+        # the graph the routes were walked on, not a second lookup that may differ
+        scored_routes, graph = build_routes(**params, return_scores=True, return_graph=True)
         routes = [route for route, _ in scored_routes]
         route_scores = {tuple(route.edge_ids): score for route, score in scored_routes}
 
         # iOS client has a small max response size; keep the GeoJSON lightweight.
         geojson = routes_to_geojson(
             routes,
-            load_nodes(),
+            graph,
             route_scores=route_scores,
             slim=True,
             coord_stride=2,
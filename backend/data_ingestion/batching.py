@@ -0,0 +1,19 @@
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+# executemany over a row generator, batch_size rows at a time (None: all at once)
+def executemany_in_batches(cur, sql: str, rows: Iterable, batch_size: Optional[int] = None):
+    if batch_size is None:
+        cur.executemany(sql, rows)
+        return
+    for batch in iter_batches(rows, batch_size):
+        cur.executemany(sql, batch)
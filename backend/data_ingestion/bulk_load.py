@@ -0,0 +1,134 @@
+import os
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from config import Config
+from .graph.graph_builder import GraphArrays
+from .graph.persist_data import DB_PATH, make_tables, create_edge_indexes, load_tag_dictionary, write_graph_arrays
+from .index.inverted_index_builder import (
+    DB_PATH as INDEX_DB_PATH,
+    create_edge_features_table,
+    create_edge_features_indexes,
+    insert_feature_edge_ids,
+)
+
+'''
+Bulk load mode for a full rebuild of walk_routes.db and inverted_index.db.
+
+The graph is written into "<name>.building" files next to the serving DBs:
+WAL journaling with synchronous=OFF, one transaction per file, rows in
+executemany batches of Config.BATCH_SIZE and the secondary indexes (edges by
+way and endpoint, edge_features) created after the rows are in. On success both
+files are checkpointed back to a plain rollback journal and swapped over the
+serving files with os.replace, so readers see either the old DB or the finished
+new one. On failure the partial
+files are deleted and the serving DBs are untouched.
+
+    with BulkLoad() as load:
+        for graph in graph_batches:
+            load.add_graph_arrays(graph)
+
+The two files are swapped one after the other, walk_routes.db first; GraphStore
+keys its cache on both, so a reader that catches the gap reloads once more.
+'''
+
+def _building_path(path: Path) -> Path:
+    return path.with_name(path.name + ".building")
+
+def _remove_db_files(path: Path):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        try:
+            os.remove(f"{path}{suffix}")
+        except FileNotFoundError:
+            pass
+
+def _open_for_bulk_load(path: Path) -> sqlite3.Connection:
+    # isolation_level=None: the transaction is managed explicitly with BEGIN/COMMIT
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("BEGIN;")
+    return conn
+
+def _finish(conn: sqlite3.Connection):
+    conn.execute("COMMIT;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    # back to the default journal so the swapped-in file is self-contained
+    conn.execute("PRAGMA journal_mode=DELETE;")
+    conn.close()
+
+
+class BulkLoad:
+    def __init__(
+        self,
+        db_path: Path = DB_PATH,
+        index_path: Optional[Path] = INDEX_DB_PATH,
+        batch_size: int = Config.BATCH_SIZE,
+    ):
+        self.db_path = Path(db_path)
+        self.index_path = Path(index_path) if index_path is not None else None
+        self.batch_size = batch_size
+        self.conn: Optional[sqlite3.Connection] = None
+        self.index_conn: Optional[sqlite3.Connection] = None
+        self.dictionary = None
+
+    def __enter__(self) -> "BulkLoad":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def start(self):
+        building = _building_path(self.db_path)
+        _remove_db_files(building)
+        make_tables(building, with_indexes=False)
+        self.conn = _open_for_bulk_load(building)
+        self.dictionary = load_tag_dictionary(self.conn)
+
+        if self.index_path is not None:
+            index_building = _building_path(self.index_path)
+            _remove_db_files(index_building)
+            index_conn = sqlite3.connect(index_building)
+            create_edge_features_table(index_conn, with_indexes=False)
+            index_conn.close()
+            self.index_conn = _open_for_bulk_load(index_building)
+
+    def add_graph_arrays(self, graph: GraphArrays, feature_edge_ids=None):
+        write_graph_arrays(self.conn, graph, self.dictionary, batch_size=self.batch_size)
+        if self.index_conn is not None:
+            if feature_edge_ids is None:
+                feature_edge_ids = graph.feature_edge_ids()
+            insert_feature_edge_ids(self.index_conn, feature_edge_ids, batch_size=self.batch_size, commit=False)
+
+    def node_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM nodes;").fetchone()[0]
+
+    def commit(self):
+        create_edge_indexes(self.conn)
+        _finish(self.conn)
+        self.conn = None
+        if self.index_conn is not None:
+            create_edge_features_indexes(self.index_conn, commit=False)
+            _finish(self.index_conn)
+            self.index_conn = None
+
+        os.replace(_building_path(self.db_path), self.db_path)
+        if self.index_path is not None:
+            os.replace(_building_path(self.index_path), self.index_path)
+
+    def abort(self):
+        for conn in (self.conn, self.index_conn):
+            if conn is not None:
+                conn.close()
+        self.conn = None
+        self.index_conn = None
+        _remove_db_files(_building_path(self.db_path))
+        if self.index_path is not None:
+            _remove_db_files(_building_path(self.index_path))
@@ -0,0 +1,55 @@
+from typing import Tuple
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+'''
+Graph cleaning.
+
+Overpass returns the union of several queries and OSM has its share of
+degenerate geometry, so the raw segments contain edges a walk can only waste
+attempts on. Before persistence graph_builder drops
+
+    zero-length segments: a node repeated in a way
+    duplicate segments: a second edge between the same two nodes in the same
+                        direction (overlapping ways), the first one is kept
+
+and the nodes only those segments used. Edge ids of the kept segments do not
+change. Two different nodes at the same spot keep their 0 m edge, dropping it
+would cut the graph there. Duplicates are found within one build batch; a
+duplicate across batches or against stored ways (refresh) is kept.
+
+Connected components need the whole graph rather than one ingest batch, so they
+are computed when a graph is loaded (CompactGraph.component_ids): weakly
+connected components of the directed edges, and the total edge length of each.
+A walk that does not reuse edges cannot cover more than the total length of its
+component, so without allow_edge_reuse build_routes does not start walks in
+components shorter than min_distance_m.
+'''
+
+def segment_keep_mask(start_nodes: np.ndarray, end_nodes: np.ndarray) -> np.ndarray:
+    """Segments to keep: not from a node to itself and the first between their two nodes in that direction."""
+    keep = start_nodes != end_nodes
+    candidates = np.flatnonzero(keep)
+    if len(candidates):
+        pairs = np.column_stack((start_nodes[candidates], end_nodes[candidates]))
+        _, first = np.unique(pairs, axis=0, return_index=True)
+        keep[:] = False
+        keep[candidates[first]] = True
+    return keep
+
+def graph_components(graph) -> Tuple[np.ndarray, np.ndarray]:
+    """Per node component id, and per component the summed length of its edges."""
+    n = graph.num_nodes
+    if n == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+    adjacency = coo_matrix(
+        (np.ones(graph.num_edges, dtype=np.int8), (graph.edge_src, graph.edge_dst)),
+        shape=(n, n),
+    )
+    num_components, labels = connected_components(adjacency, directed=True, connection="weak")
+    length_m = np.bincount(
+        labels[graph.edge_src], weights=graph.distance_m.astype(np.float64), minlength=num_components
+    )
+    return labels.astype(np.int32), length_m
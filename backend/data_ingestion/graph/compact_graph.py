@@ -0,0 +1,454 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from .node import Node
+from .edge import Edge
+
+'''
+Array-backed walk graph in CSR layout.
+
+Nodes are numbered 0..N-1 in ascending OSM id order. Edges are stored grouped by
+their start node, so the out-edges of node i are the edge rows
+offsets[i]:offsets[i + 1]. Every per-edge attribute is a flat array indexed by
+edge row; tags are shared per distinct tag set instead of one dict per edge.
+
+The tag index is feature -> sorted edge rows, loaded once with the graph.
+tag_mask turns a set of features into a read-only boolean mask over edge rows
+(union, or intersection with match_all) and keeps the most recent
+TAG_MASK_CACHE_SIZE masks keyed by the sorted feature tuple, so the handful of
+tag combinations requests use are computed once per graph version.
+
+node_ids / edge_ids map indices and rows back to the OSM node ids and edge ids
+used everywhere else. The nodes / edges / adjacency views keep the old
+Dict[int, Node], Dict[int, Edge] and Adjacency.map APIs working on top of the arrays.
+'''
+
+TAG_MASK_CACHE_SIZE = 64
+
+class CompactGraph:
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        offsets: np.ndarray,
+        edge_ids: np.ndarray,
+        edge_src: np.ndarray,
+        edge_dst: np.ndarray,
+        distance_m: np.ndarray,
+        way_ids: np.ndarray,
+        edge_tag_set: np.ndarray,
+        tag_sets: Sequence[dict],
+        feature_edge_rows: Optional[Dict[str, np.ndarray]] = None,
+        version: Tuple = (),
+        edge_id_order: Optional[np.ndarray] = None,
+        sorted_edge_ids: Optional[np.ndarray] = None,
+    ):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.edge_ids = edge_ids
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.distance_m = distance_m
+        self.way_ids = way_ids
+        self.edge_tag_set = edge_tag_set
+        self.tag_sets = tag_sets
+        self.feature_edge_rows = feature_edge_rows or {}
+        self.version = version
+
+        # where the spatial index for this graph's DB is persisted, set by the graph store
+        self.spatial_index_path = None
+        self._spatial_index = None
+        self._spatial_index_lock = threading.Lock()
+        # same for the landmark distance tables
+        self.landmarks_path = None
+        self._landmarks = None
+        self._landmarks_lock = threading.Lock()
+        self._contracted = None
+        self._contracted_lock = threading.Lock()
+        self._components = None
+        self._tag_masks: OrderedDict = OrderedDict()
+        self._tag_masks_lock = threading.Lock()
+
+        # edge ids are not in row order, keep a sorted lookup for id -> row
+        if edge_id_order is None:
+            edge_id_order = np.argsort(edge_ids, kind="stable").astype(np.int32)
+        self._edge_id_order = edge_id_order
+        if sorted_edge_ids is None:
+            sorted_edge_ids = edge_ids[edge_id_order]
+        self._sorted_edge_ids = sorted_edge_ids
+
+    @classmethod
+    def from_arrays(
+        cls,
+        node_ids: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        edge_ids: np.ndarray,
+        start_nodes: np.ndarray,
+        end_nodes: np.ndarray,
+        distance_m: np.ndarray,
+        way_ids: np.ndarray,
+        edge_tag_set: np.ndarray,
+        tag_sets: Sequence[dict],
+        feature_edge_ids: Optional[Dict[str, Iterable[int]]] = None,
+        version: Tuple = (),
+    ) -> "CompactGraph":
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        node_order = np.argsort(node_ids, kind="stable")
+        node_ids = node_ids[node_order]
+        lat = np.asarray(lat, dtype=np.float64)[node_order]
+        lon = np.asarray(lon, dtype=np.float64)[node_order]
+
+        start_nodes = np.asarray(start_nodes, dtype=np.int64)
+        end_nodes = np.asarray(end_nodes, dtype=np.int64)
+        src = _lookup(node_ids, start_nodes)
+        dst = _lookup(node_ids, end_nodes)
+
+        # edges pointing at nodes we have no coordinates for cannot be walked or drawn
+        known = (src >= 0) & (dst >= 0)
+        edge_ids = np.asarray(edge_ids, dtype=np.int64)[known]
+        src = src[known]
+        dst = dst[known]
+        distance_m = np.asarray(distance_m, dtype=np.float32)[known]
+        way_ids = np.asarray(way_ids, dtype=np.int64)[known]
+        edge_tag_set = np.asarray(edge_tag_set, dtype=np.int32)[known]
+
+        edge_order = np.lexsort((edge_ids, src))
+        edge_ids = edge_ids[edge_order]
+        src = src[edge_order]
+        dst = dst[edge_order]
+        distance_m = distance_m[edge_order]
+        way_ids = way_ids[edge_order]
+        edge_tag_set = edge_tag_set[edge_order]
+
+        offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(node_ids)), out=offsets[1:])
+
+        graph = cls(
+            node_ids=node_ids,
+            lat=lat,
+            lon=lon,
+            offsets=offsets,
+            edge_ids=edge_ids,
+            edge_src=src.astype(np.int32),
+            edge_dst=dst.astype(np.int32),
+            distance_m=distance_m,
+            way_ids=way_ids,
+            edge_tag_set=edge_tag_set,
+            tag_sets=tag_sets,
+            version=version,
+        )
+        if feature_edge_ids:
+            graph.feature_edge_rows = {
+                feature: graph.known_edge_rows(edge_ids)
+                for feature, edge_ids in feature_edge_ids.items()
+            }
+        return graph
+
+    @classmethod
+    def from_objects(
+        cls,
+        nodes: Dict[int, Node],
+        edges: Dict[int, Edge],
+        feature_edge_ids: Optional[Dict[str, Iterable[int]]] = None,
+    ) -> "CompactGraph":
+        tag_set_ids: Dict[int, int] = {}
+        tag_sets: List[dict] = []
+        edge_tag_set = []
+        for e in edges.values():
+            # edges of one way share their tags dict
+            tag_set_id = tag_set_ids.get(id(e.tags))
+            if tag_set_id is None:
+                tag_set_id = tag_set_ids[id(e.tags)] = len(tag_sets)
+                tag_sets.append(e.tags)
+            edge_tag_set.append(tag_set_id)
+
+        return cls.from_arrays(
+            node_ids=np.fromiter((n.node_id for n in nodes.values()), dtype=np.int64, count=len(nodes)),
+            lat=np.fromiter((n.lat for n in nodes.values()), dtype=np.float64, count=len(nodes)),
+            lon=np.fromiter((n.lon for n in nodes.values()), dtype=np.float64, count=len(nodes)),
+            edge_ids=np.fromiter((e.edge_id for e in edges.values()), dtype=np.int64, count=len(edges)),
+            start_nodes=np.fromiter((e.start_node for e in edges.values()), dtype=np.int64, count=len(edges)),
+            end_nodes=np.fromiter((e.end_node for e in edges.values()), dtype=np.int64, count=len(edges)),
+            distance_m=np.fromiter((e.distance_m for e in edges.values()), dtype=np.float32, count=len(edges)),
+            way_ids=np.fromiter((e.way_id for e in edges.values()), dtype=np.int64, count=len(edges)),
+            edge_tag_set=np.asarray(edge_tag_set, dtype=np.int32),
+            tag_sets=tag_sets,
+            feature_edge_ids=feature_edge_ids,
+        )
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edge_ids)
+
+    # id <-> index lookups
+    def node_index(self, node_id: int) -> int:
+        index = int(np.searchsorted(self.node_ids, node_id))
+        if index >= len(self.node_ids) or self.node_ids[index] != node_id:
+            raise KeyError(node_id)
+        return index
+
+    def node_indices(self, node_ids: Iterable[int]) -> np.ndarray:
+        node_ids = np.asarray(list(node_ids), dtype=np.int64)
+        indices = _lookup(self.node_ids, node_ids)
+        if (indices < 0).any():
+            raise KeyError(int(node_ids[indices < 0][0]))
+        return indices
+
+    def edge_row(self, edge_id: int) -> int:
+        position = int(np.searchsorted(self._sorted_edge_ids, edge_id))
+        if position >= len(self._sorted_edge_ids) or self._sorted_edge_ids[position] != edge_id:
+            raise KeyError(edge_id)
+        return int(self._edge_id_order[position])
+
+    def edge_rows(self, edge_ids: Iterable[int]) -> np.ndarray:
+        edge_ids = np.asarray(list(edge_ids), dtype=np.int64)
+        positions = _lookup(self._sorted_edge_ids, edge_ids)
+        if (positions < 0).any():
+            raise KeyError(int(edge_ids[positions < 0][0]))
+        return self._edge_id_order[positions]
+
+    def known_edge_rows(self, edge_ids: Iterable[int]) -> np.ndarray:
+        """Sorted rows of the given edge ids, silently skipping ids not in the graph."""
+        edge_ids = np.fromiter(edge_ids, dtype=np.int64)
+        positions = _lookup(self._sorted_edge_ids, edge_ids)
+        return np.unique(self._edge_id_order[positions[positions >= 0]])
+
+    # what persisted indexes are keyed on: the signature of the DB the graph was read
+    # from (the first part of GraphStore's version), so rebuilding the tag index or
+    # the snapshot does not invalidate them
+    @property
+    def index_version(self) -> Tuple:
+        return tuple(self.version[:1])
+
+    # spatial index over node coordinates, built (or loaded) on first use
+    @property
+    def spatial_index(self):
+        from ..index.spatial import SpatialIndex, load_spatial_index, save_spatial_index
+
+        index = self._spatial_index
+        if index is not None:
+            return index
+        with self._spatial_index_lock:
+            # another thread may have built it while we waited
+            if self._spatial_index is None:
+                index = None
+                if self.spatial_index_path is not None:
+                    index = load_spatial_index(self.index_version, self.num_nodes, self.spatial_index_path)
+                if index is None:
+                    index = SpatialIndex(self.lat, self.lon, version=self.index_version)
+                    if self.spatial_index_path is not None:
+                        save_spatial_index(index, self.spatial_index_path)
+                self._spatial_index = index
+            return self._spatial_index
+
+    # landmark distance tables for A* over the contracted graph, built (or loaded) on first use
+    @property
+    def landmarks(self):
+        from ..index.landmarks import LandmarkTable, load_landmarks, save_landmarks
+
+        table = self._landmarks
+        if table is not None:
+            return table
+        # one build per graph: it runs two Dijkstras over the whole graph per landmark
+        with self._landmarks_lock:
+            if self._landmarks is None:
+                table = None
+                if self.landmarks_path is not None:
+                    table = load_landmarks(self.index_version, self.num_nodes, self.landmarks_path)
+                if table is None:
+                    table = LandmarkTable.build(self)
+                    if self.landmarks_path is not None:
+                        save_landmarks(table, self.landmarks_path)
+                self._landmarks = table
+            return self._landmarks
+
+    # degree-2 chains merged into super-edges for the route walker, built on first use
+    @property
+    def contracted(self):
+        from .contraction import contract_graph
+
+        contracted = self._contracted
+        if contracted is not None:
+            return contracted
+        with self._contracted_lock:
+            if self._contracted is None:
+                self._contracted = contract_graph(self)
+            return self._contracted
+
+    # weakly connected components, see cleaning.py
+    def _component_data(self):
+        from .cleaning import graph_components
+
+        if self._components is None:
+            self._components = graph_components(self)
+        return self._components
+
+    @property
+    def component_ids(self) -> np.ndarray:
+        return self._component_data()[0]
+
+    @property
+    def component_length_m(self) -> np.ndarray:
+        return self._component_data()[1]
+
+    # CSR access
+    def out_edges(self, node_index: int) -> range:
+        return range(int(self.offsets[node_index]), int(self.offsets[node_index + 1]))
+
+    def edge_tags(self, row: int) -> dict:
+        return self.tag_sets[self.edge_tag_set[row]]
+
+    # tag index
+    def tag_mask(self, tags: Iterable[str], match_all: bool = False) -> np.ndarray:
+        key = (match_all, tuple(sorted(set(tags))))
+        with self._tag_masks_lock:
+            mask = self._tag_masks.get(key)
+            if mask is not None:
+                self._tag_masks.move_to_end(key)
+                return mask
+
+        features = key[1]
+        if match_all and features:
+            mask = np.ones(self.num_edges, dtype=bool)
+            for tag in features:
+                tag_mask = np.zeros(self.num_edges, dtype=bool)
+                rows = self.feature_edge_rows.get(tag)
+                if rows is not None:
+                    tag_mask[rows] = True
+                mask &= tag_mask
+        else:
+            mask = np.zeros(self.num_edges, dtype=bool)
+            for tag in features:
+                rows = self.feature_edge_rows.get(tag)
+                if rows is not None:
+                    mask[rows] = True
+        # shared between requests
+        mask.setflags(write=False)
+
+        with self._tag_masks_lock:
+            self._tag_masks[key] = mask
+            while len(self._tag_masks) > TAG_MASK_CACHE_SIZE:
+                self._tag_masks.popitem(last=False)
+        return mask
+
+    def matching_edge_ids(self, tags: Iterable[str]) -> Set[int]:
+        return set(self.edge_ids[self.tag_mask(tags)].tolist())
+
+    # compatibility views
+    @property
+    def nodes(self) -> "NodeView":
+        return NodeView(self)
+
+    @property
+    def edges(self) -> "EdgeView":
+        return EdgeView(self)
+
+    @property
+    def adjacency(self) -> "AdjacencyView":
+        return AdjacencyView(self)
+
+
+def _lookup(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Positions of ids in sorted_ids, -1 where an id is missing."""
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    positions = np.searchsorted(sorted_ids, ids)
+    clipped = np.minimum(positions, len(sorted_ids) - 1)
+    return np.where(sorted_ids[clipped] == ids, clipped, -1)
+
+
+class NodeView(Mapping):
+    def __init__(self, graph: CompactGraph):
+        self._graph = graph
+
+    def __getitem__(self, node_id: int) -> Node:
+        index = self._graph.node_index(node_id)
+        return Node(node_id=int(node_id),
+                    lat=float(self._graph.lat[index]),
+                    lon=float(self._graph.lon[index]))
+
+    def __iter__(self):
+        return iter(self._graph.node_ids.tolist())
+
+    def __len__(self) -> int:
+        return self._graph.num_nodes
+
+    def __contains__(self, node_id) -> bool:
+        try:
+            self._graph.node_index(node_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+
+class EdgeView(Mapping):
+    def __init__(self, graph: CompactGraph):
+        self._graph = graph
+
+    def __getitem__(self, edge_id: int) -> Edge:
+        g = self._graph
+        row = g.edge_row(edge_id)
+        return Edge(edge_id=int(edge_id),
+                    start_node=int(g.node_ids[g.edge_src[row]]),
+                    end_node=int(g.node_ids[g.edge_dst[row]]),
+                    distance_m=float(g.distance_m[row]),
+                    way_id=int(g.way_ids[row]),
+                    tags=g.edge_tags(row),
+                    tag_set_id=int(g.edge_tag_set[row]))
+
+    def __iter__(self):
+        return iter(self._graph.edge_ids.tolist())
+
+    def __len__(self) -> int:
+        return self._graph.num_edges
+
+    def __contains__(self, edge_id) -> bool:
+        try:
+            self._graph.edge_row(edge_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+
+class _AdjacencyMap(Mapping):
+    def __init__(self, graph: CompactGraph):
+        self._graph = graph
+
+    def __getitem__(self, node_id: int) -> List[int]:
+        g = self._graph
+        index = g.node_index(node_id)
+        return g.edge_ids[g.offsets[index]:g.offsets[index + 1]].tolist()
+
+    def __iter__(self):
+        g = self._graph
+        has_out_edges = g.offsets[1:] > g.offsets[:-1]
+        return iter(g.node_ids[has_out_edges].tolist())
+
+    def __len__(self) -> int:
+        g = self._graph
+        return int(np.count_nonzero(g.offsets[1:] > g.offsets[:-1]))
+
+    def get(self, node_id, default=None):
+        try:
+            edge_ids = self[node_id]
+        except KeyError:
+            return default
+        return edge_ids if edge_ids else default
+
+
+class AdjacencyView:
+    """Read-only stand-in for Adjacency: map[node_id] -> outgoing edge ids."""
+    def __init__(self, graph: CompactGraph):
+        self.map = _AdjacencyMap(graph)
@@ -0,0 +1,229 @@
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .compact_graph import TAG_MASK_CACHE_SIZE
+
+'''
+Degree-2 chain contraction.
+
+OSM ways are split at every shape node, so most nodes of the walk graph have one
+way in and one way out and a random walk spends most of its steps passing
+through them. contract_graph merges every maximal chain of such nodes into one
+super-edge from junction to junction, with the summed length and the list of
+original edge rows it stands for.
+
+A node is contracted when it only continues a path: one edge in and one out
+(to a different node), or the same two neighbours in and out as on a two-way
+street, and the edge leaving it has the same tag set as the edge arriving on
+that side. Every other node is a junction. Cycles without any junction get one
+of their nodes promoted to a junction.
+
+Super-edges are numbered in CSR order over the original node indices (only
+junctions have out-edges), so walkers that read offsets / distance_m / edge_dst
+work on a ContractedGraph unchanged. expand maps a walk back to original node
+indices and edge rows, and prefix lets a walk end partway along a chain.
+'''
+
+class ContractedGraph:
+    def __init__(
+        self,
+        graph,
+        offsets: np.ndarray,
+        edge_src: np.ndarray,
+        edge_dst: np.ndarray,
+        distance_m: np.ndarray,
+        member_offsets: np.ndarray,
+        member_rows: np.ndarray,
+        is_junction: np.ndarray,
+    ):
+        self.graph = graph
+        self.offsets = offsets
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.distance_m = distance_m
+        # super-edge i stands for the original edge rows member_rows[member_offsets[i]:member_offsets[i + 1]]
+        self.member_offsets = member_offsets
+        self.member_rows = member_rows
+        self.is_junction = is_junction
+        self._tag_masks = {}
+        self._tag_masks_lock = threading.Lock()
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edge_src)
+
+    def edge_mask(self, mask: np.ndarray) -> np.ndarray:
+        """Per super-edge: does any of its original edges have mask set."""
+        if not self.num_edges:
+            return np.zeros(0, dtype=bool)
+        return np.logical_or.reduceat(mask[self.member_rows], self.member_offsets[:-1])
+
+    def tag_mask(self, tags: Iterable[str]) -> np.ndarray:
+        """edge_mask of the base graph's (cached) tag_mask, cached the same way."""
+        key = tuple(sorted(set(tags)))
+        with self._tag_masks_lock:
+            mask = self._tag_masks.get(key)
+        if mask is None:
+            mask = self.edge_mask(self.graph.tag_mask(key))
+            mask.setflags(write=False)
+            with self._tag_masks_lock:
+                while len(self._tag_masks) >= TAG_MASK_CACHE_SIZE:
+                    self._tag_masks.pop(next(iter(self._tag_masks)))
+                self._tag_masks[key] = mask
+        return mask
+
+    def start_nodes(self, node_indices: np.ndarray) -> np.ndarray:
+        """
+        The junctions among node_indices; walks can only start where super-edges start.
+        Without any, the starts of the super-edges passing through node_indices.
+        """
+        node_indices = np.asarray(node_indices, dtype=np.int64)
+        junctions = node_indices[self.is_junction[node_indices]]
+        if len(junctions) or not len(node_indices):
+            return junctions
+        super_rows = np.repeat(np.arange(self.num_edges), np.diff(self.member_offsets))
+        passing = np.isin(self.graph.edge_src[self.member_rows], node_indices)
+        return np.unique(self.edge_src[super_rows[passing]]).astype(np.int64)
+
+    def prefix(self, row: int, distance_m: float) -> Tuple[int, float]:
+        """
+        How many original edges from the start of super-edge row it takes to cover
+        distance_m (all of them if the chain is shorter), and their length.
+        """
+        start, stop = int(self.member_offsets[row]), int(self.member_offsets[row + 1])
+        lengths = np.cumsum(self.graph.distance_m[self.member_rows[start:stop]], dtype=np.float64)
+        members = min(int(np.searchsorted(lengths, distance_m)) + 1, stop - start)
+        return members, float(lengths[members - 1])
+
+    def expand(
+        self, start_node_index: int, super_rows: List[int], last_members: Optional[int] = None
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Original (node indices, edge rows) of a walk over super-edges. With
+        last_members the walk ends that many original edges into its last super-edge.
+        """
+        parts = [self.member_rows[self.member_offsets[row]:self.member_offsets[row + 1]] for row in super_rows]
+        if parts and last_members is not None:
+            parts[-1] = parts[-1][:last_members]
+        edge_rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        node_indices = [start_node_index] + self.graph.edge_dst[edge_rows].tolist()
+        return node_indices, edge_rows.tolist()
+
+
+def _successors(graph) -> Tuple[np.ndarray, np.ndarray]:
+    """For every edge the edge that continues it through a contractible node (-1 if none), and that node mask."""
+    n = graph.num_nodes
+    src = graph.edge_src
+    dst = graph.edge_dst
+    tags = graph.edge_tag_set
+    offsets = graph.offsets
+
+    out_degree = np.diff(offsets)
+    in_degree = np.bincount(dst, minlength=n)
+    in_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(in_degree, out=in_offsets[1:])
+    in_edges = np.argsort(dst, kind="stable")
+
+    successor = np.full(len(src), -1, dtype=np.int64)
+    interior = np.zeros(n, dtype=bool)
+
+    # one edge in, one out
+    nodes = np.flatnonzero((in_degree == 1) & (out_degree == 1))
+    in0 = in_edges[in_offsets[nodes]]
+    out0 = offsets[nodes]
+    ok = (src[in0] != dst[out0]) & (tags[in0] == tags[out0])
+    interior[nodes[ok]] = True
+    successor[in0[ok]] = out0[ok]
+
+    # two-way street: in from a and b, out to b and a
+    nodes = np.flatnonzero((in_degree == 2) & (out_degree == 2))
+    in0 = in_edges[in_offsets[nodes]]
+    in1 = in_edges[in_offsets[nodes] + 1]
+    out0 = offsets[nodes]
+    out1 = out0 + 1
+    s0, s1, d0, d1 = src[in0], src[in1], dst[out0], dst[out1]
+    straight = (d0 == s1) & (d1 == s0)
+    crossed = (d0 == s0) & (d1 == s1)
+    next0 = np.where(straight, out0, out1)
+    next1 = np.where(straight, out1, out0)
+    ok = (s0 != s1) & (straight | crossed) & (tags[in0] == tags[next0]) & (tags[in1] == tags[next1])
+    interior[nodes[ok]] = True
+    successor[in0[ok]] = next0[ok]
+    successor[in1[ok]] = next1[ok]
+    return successor, interior
+
+
+def contract_graph(graph) -> ContractedGraph:
+    n = graph.num_nodes
+    src = graph.edge_src
+    dst = graph.edge_dst
+    successor, interior = _successors(graph)
+    is_junction = ~interior
+
+    # walk all chains from their junction in lockstep, one original edge per step
+    chain_parts, edge_parts = [], []
+    current = np.flatnonzero(is_junction[src])
+    chain = np.arange(len(current))
+    num_chains = len(current)
+    covered = np.zeros(len(src), dtype=bool)
+    while len(current):
+        chain_parts.append(chain)
+        edge_parts.append(current)
+        covered[current] = True
+        following = successor[current]
+        keep = following >= 0
+        current, chain = following[keep], chain[keep]
+
+    # what is left are cycles through contractible nodes only
+    for edge in np.flatnonzero(~covered).tolist():
+        if covered[edge]:
+            continue
+        is_junction[src[edge]] = True
+        for start in range(int(graph.offsets[src[edge]]), int(graph.offsets[src[edge] + 1])):
+            if covered[start]:
+                continue
+            members = [start]
+            covered[start] = True
+            while not is_junction[dst[members[-1]]]:
+                members.append(int(successor[members[-1]]))
+                covered[members[-1]] = True
+            chain_parts.append(np.full(len(members), num_chains))
+            edge_parts.append(np.asarray(members, dtype=np.int64))
+            num_chains += 1
+
+    chain_ids = np.concatenate(chain_parts) if chain_parts else np.zeros(0, dtype=np.int64)
+    member_rows = np.concatenate(edge_parts) if edge_parts else np.zeros(0, dtype=np.int64)
+    # steps were appended in order, a stable sort keeps them in walk order per chain
+    order = np.argsort(chain_ids, kind="stable")
+    member_rows = member_rows[order]
+    sizes = np.bincount(chain_ids, minlength=num_chains)
+    first = np.zeros(num_chains, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=first[1:])
+
+    super_src = src[member_rows[first]]
+    super_dst = dst[member_rows[first + sizes - 1]]
+    distance_m = np.add.reduceat(graph.distance_m[member_rows].astype(np.float64), first) if num_chains else np.zeros(0)
+
+    # CSR order by start node; chains started from cycles were appended last
+    chain_order = np.argsort(super_src, kind="stable")
+    member_offsets = np.zeros(num_chains + 1, dtype=np.int64)
+    np.cumsum(sizes[chain_order], out=member_offsets[1:])
+    moved_sizes = sizes[chain_order]
+    step = np.arange(len(member_rows)) - np.repeat(member_offsets[:-1], moved_sizes)
+    member_rows = member_rows[np.repeat(first[chain_order], moved_sizes) + step]
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(super_src, minlength=n), out=offsets[1:])
+
+    return ContractedGraph(
+        graph=graph,
+        offsets=offsets,
+        edge_src=super_src[chain_order].astype(np.int32),
+        edge_dst=super_dst[chain_order].astype(np.int32),
+        distance_m=distance_m[chain_order],
+        member_offsets=member_offsets,
+        member_rows=member_rows,
+        is_junction=is_junction,
+    )
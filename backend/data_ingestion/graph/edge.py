@@ -1,10 +1,11 @@
 from .node import Node
 
 class Edge:
-    def __init__(self, edge_id, start_node, end_node, distance_m, way_id, tags):
+    def __init__(self, edge_id, start_node, end_node, distance_m, way_id, tags, tag_set_id=None):
         self.edge_id = edge_id
         self.start_node: Node = start_node
         self.end_node: Node = end_node
         self.distance_m = distance_m
         self.way_id = way_id
-        self.tags = tags
\ No newline at end of file
+        self.tags = tags
+        self.tag_set_id = tag_set_id
\ No newline at end of file
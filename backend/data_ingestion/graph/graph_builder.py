@@ -1,7 +1,13 @@
 import math
+import zlib
 from typing import Dict
+import numpy as np
 from .node import Node
 from .edge import Edge
+from .compact_graph import CompactGraph
+from .tag_dictionary import TagDictionary
+from .cleaning import segment_keep_mask
+from ..index.inverted_index_builder import extract_features
 
 def _haversine_distance_m(lat1, lon1, lat2, lon2):
     radius_m = 6371000
@@ -17,39 +23,242 @@ def _haversine_distance_m(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return radius_m * c
 
+# same formula as _haversine_distance_m, over whole arrays of points
+def _haversine_distances_m(lat1, lon1, lat2, lon2):
+    radius_m = 6371000
+    lat1_rad = np.radians(lat1)
+    lat2_rad = np.radians(lat2)
+    delta_lat = np.radians(np.subtract(lat2, lat1))
+    delta_lon = np.radians(np.subtract(lon2, lon1))
+
+    a = (
+        np.sin(delta_lat / 2) ** 2
+        + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(delta_lon / 2) ** 2
+    )
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return radius_m * c
+
+
+'''
+Columnar graph construction.
+
+Every way's node ids and geometry are flattened into arrays once, all segment
+lengths come from one haversine over those arrays and nodes are deduplicated
+with np.unique (the first occurrence of a node id gives its coordinates).
+build_graph_arrays returns the result as GraphArrays, which persist_data and
+CompactGraph take directly; build_graph wraps the same arrays in Node/Edge
+objects for code that wants dicts.
+'''
+
+# edge ids are (way_id << EDGE_ID_SHIFT) | segment index, so the same segment keeps its
+# id across imports; OSM caps ways at 2000 nodes, well below 1 << EDGE_ID_SHIFT
+EDGE_ID_SHIFT = 12
+MAX_SEGMENTS_PER_WAY = 1 << EDGE_ID_SHIFT
+
+WAY_DTYPE = np.dtype([("way_id", "i8"), ("tag_set_id", "i4"), ("version", "i8"),
+                      ("timestamp", "U20"), ("checksum", "i8")])
+
+def edge_id_for(way_id: int, segment_index: int) -> int:
+    return (way_id << EDGE_ID_SHIFT) | segment_index
+
+# crc32 over a way's node ids, coordinates and tags; changes when a member node moves,
+# which does not bump the way's own OSM version
+def way_checksum(way) -> int:
+    count = min(len(way["nodes"]), len(way["geometry"]))
+    node_ids = np.asarray(way["nodes"][:count], dtype=np.int64)
+    coords = np.array([_point_coords(point) for point in way["geometry"][:count]], dtype=np.float64)
+    crc = zlib.crc32(node_ids.tobytes())
+    crc = zlib.crc32(coords.tobytes(), crc)
+    return zlib.crc32(repr(sorted(way["tags"].items())).encode("utf-8"), crc)
+
+class GraphArrays:
+    def __init__(self, node_ids, lat, lon, edge_ids, start_nodes, end_nodes,
+                 distance_m, way_ids, edge_tag_set, tag_sets: TagDictionary, ways=None):
+        # nodes sorted by node id
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        # edges in way order, ids from edge_id_for
+        self.edge_ids = edge_ids
+        self.start_nodes = start_nodes
+        self.end_nodes = end_nodes
+        self.distance_m = distance_m
+        self.way_ids = way_ids
+        self.edge_tag_set = edge_tag_set
+        self.tag_sets = tag_sets
+        # one WAY_DTYPE row per way, including ways too short to have edges
+        self.ways = ways if ways is not None else np.zeros(0, dtype=WAY_DTYPE)
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edge_ids)
+
+    # feature -> edge ids, computed once per tag set instead of once per edge
+    def feature_edge_ids(self) -> Dict[str, np.ndarray]:
+        edge_rows_by_tag_set = np.argsort(self.edge_tag_set, kind="stable")
+        bounds = np.searchsorted(self.edge_tag_set[edge_rows_by_tag_set], np.arange(len(self.tag_sets) + 1))
+
+        rows_by_feature = {}
+        for tag_set_id in range(len(self.tag_sets)):
+            rows = edge_rows_by_tag_set[bounds[tag_set_id]:bounds[tag_set_id + 1]]
+            if len(rows) == 0:
+                continue
+            for feature in extract_features(self.tag_sets.tags(tag_set_id)):
+                rows_by_feature.setdefault(feature, []).append(rows)
+
+        return {
+            feature: np.sort(self.edge_ids[np.concatenate(rows)])
+            for feature, rows in rows_by_feature.items()
+        }
+
+    def to_compact_graph(self, feature_edge_ids=None, version=()) -> CompactGraph:
+        if feature_edge_ids is None:
+            feature_edge_ids = self.feature_edge_ids()
+        return CompactGraph.from_arrays(
+            node_ids=self.node_ids,
+            lat=self.lat,
+            lon=self.lon,
+            edge_ids=self.edge_ids,
+            start_nodes=self.start_nodes,
+            end_nodes=self.end_nodes,
+            distance_m=self.distance_m,
+            way_ids=self.way_ids,
+            edge_tag_set=self.edge_tag_set,
+            tag_sets=self.tag_sets,
+            feature_edge_ids=feature_edge_ids,
+            version=version,
+        )
+
+
+_MISSING_POINT = (np.nan, np.nan)
+
+def _point_coords(point):
+    return _MISSING_POINT if point is None else (point["lat"], point["lon"])
+
+def _flatten_ways(elements):
+    # ways whose geometry and node list disagree in length keep the common prefix
+    counts = np.fromiter(
+        (min(len(way["nodes"]), len(way["geometry"])) for way in elements),
+        dtype=np.int64, count=len(elements),
+    )
+    total = int(counts.sum())
+    node_refs = np.fromiter(
+        (node_id for way, count in zip(elements, counts) for node_id in way["nodes"][:count]),
+        dtype=np.int64, count=total,
+    )
+    coords = np.fromiter(
+        (value for way, count in zip(elements, counts)
+         for point in way["geometry"][:count] for value in _point_coords(point)),
+        dtype=np.float64, count=2 * total,
+    ).reshape(total, 2)
+
+    # a segment starts at every point except the last point of its way; a node without
+    # geometry (None, cut off by a clipped extract) ends the run before it and starts the
+    # next one after it, and the segments of the gap are skipped
+    point_way = np.repeat(np.arange(len(elements)), counts)
+    if total:
+        present = ~np.isnan(coords[:, 0])
+        segment_starts = np.flatnonzero((point_way[:-1] == point_way[1:]) & present[:-1] & present[1:])
+    else:
+        segment_starts = np.zeros(0, dtype=np.int64)
+    return node_refs, coords, point_way, segment_starts
+
+def _build_arrays(elements):
+    # a way fetched twice (overlapping tiles) is built once
+    way_id_array = np.fromiter((way["id"] for way in elements), dtype=np.int64, count=len(elements))
+    unique_way_ids, first_way = np.unique(way_id_array, return_index=True)
+    if len(unique_way_ids) < len(elements):
+        first_way.sort()
+        elements = [elements[i] for i in first_way.tolist()]
+        way_id_array = way_id_array[first_way]
+
+    node_refs, coords, point_way, segment_starts = _flatten_ways(elements)
+
+    segment_ends = segment_starts + 1
+    distance_m = _haversine_distances_m(
+        coords[segment_starts, 0], coords[segment_starts, 1],
+        coords[segment_ends, 0], coords[segment_ends, 1],
+    )
+
+    edge_way = point_way[segment_starts]
+    way_first_point = np.searchsorted(point_way, np.arange(len(elements)))
+    segment_index = segment_starts - way_first_point[edge_way]
+    if len(segment_index) and segment_index.max() >= MAX_SEGMENTS_PER_WAY:
+        raise ValueError(f"way has more than {MAX_SEGMENTS_PER_WAY} segments")
+
+    # segments from a node to itself and duplicates are dropped, see cleaning.py; the rest keep their segment index
+    keep = segment_keep_mask(node_refs[segment_starts], node_refs[segment_ends])
+    if not keep.all():
+        segment_starts, segment_ends = segment_starts[keep], segment_ends[keep]
+        distance_m, edge_way, segment_index = distance_m[keep], edge_way[keep], segment_index[keep]
+
+    # nodes of the kept segments, coordinates from the first point with that node id
+    used_points = np.unique(np.concatenate((segment_starts, segment_ends)))
+    node_ids, first_used = np.unique(node_refs[used_points], return_index=True)
+    first_seen = used_points[first_used]
+
+    # segments of one way share their tags dict, intern it once
+    tag_sets = TagDictionary()
+    interned = {}
+    way_tag_set = np.empty(len(elements), dtype=np.int32)
+    for i, way in enumerate(elements):
+        tags = way["tags"]
+        tag_set_id = interned.get(id(tags))
+        if tag_set_id is None:
+            tag_set_id = interned[id(tags)] = tag_sets.intern(tags)
+        way_tag_set[i] = tag_set_id
+
+    ways = np.zeros(len(elements), dtype=WAY_DTYPE)
+    ways["way_id"] = way_id_array
+    ways["tag_set_id"] = way_tag_set
+    # version and timestamp come with Overpass "out meta", -1 / "" when absent
+    ways["version"] = [way.get("version", -1) for way in elements]
+    ways["timestamp"] = [way.get("timestamp", "") for way in elements]
+    ways["checksum"] = [way_checksum(way) for way in elements]
+
+    arrays = GraphArrays(
+        node_ids=node_ids,
+        lat=coords[first_seen, 0],
+        lon=coords[first_seen, 1],
+        edge_ids=(way_id_array[edge_way] << EDGE_ID_SHIFT) | segment_index,
+        start_nodes=node_refs[segment_starts],
+        end_nodes=node_refs[segment_ends],
+        distance_m=distance_m,
+        way_ids=way_id_array[edge_way],
+        edge_tag_set=way_tag_set[edge_way],
+        tag_sets=tag_sets,
+        ways=ways,
+    )
+    return arrays, elements, first_seen, edge_way
+
+def build_graph_arrays(ways) -> GraphArrays:
+    arrays, _, _, _ = _build_arrays(ways["elements"])
+    return arrays
 
 def build_graph(ways):
+    arrays, elements, first_seen, edge_way = _build_arrays(ways["elements"])
+
     nodes: Dict[int, Node] = {}
+    # nodes in the order they are first seen
+    for node_id, lat, lon in zip(
+        *(column[np.argsort(first_seen)].tolist() for column in (arrays.node_ids, arrays.lat, arrays.lon))
+    ):
+        nodes[node_id] = Node(node_id=node_id, lat=lat, lon=lon)
+
     edges: Dict[int, Edge] = {}
-    edge_id = 1
+    for edge_id, start_node, end_node, distance_m, way_index in zip(
+        arrays.edge_ids.tolist(),
+        arrays.start_nodes.tolist(),
+        arrays.end_nodes.tolist(),
+        arrays.distance_m.tolist(),
+        edge_way.tolist(),
+    ):
+        way = elements[way_index]
+        edges[edge_id] = Edge(edge_id=edge_id, start_node=start_node,
+                              end_node=end_node, distance_m=distance_m, way_id=way["id"], tags=way["tags"])
 
-    for way in ways["elements"]:
-        node_ids = way["nodes"]
-        geometry = way["geometry"]
-        tags = way["tags"]
-        way_id = way["id"]
-
-        # make nodes
-        for node_id, point in zip(node_ids, geometry):
-            if node_id not in nodes:
-                nodes[node_id] = Node(node_id=node_id, 
-                                      lat=point["lat"], 
-                                      lon=point["lon"])
-        
-        # make edges
-        for i in range(len(node_ids)-1):
-            start_node = node_ids[i]
-            end_node = node_ids[i+1]
-            start_point = geometry[i]
-            end_point = geometry[i + 1]
-            distance_m = _haversine_distance_m(
-                start_point["lat"],
-                start_point["lon"],
-                end_point["lat"],
-                end_point["lon"],
-            )
-            edges[edge_id] = Edge(edge_id=edge_id, start_node=start_node, 
-                                  end_node=end_node, distance_m=distance_m, way_id=way_id, tags=tags)
-            edge_id += 1
-    
-    return nodes, edges
\ No newline at end of file
+    return nodes, edges
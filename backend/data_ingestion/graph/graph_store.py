@@ -0,0 +1,175 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from config import Config
+from .compact_graph import CompactGraph
+from .persist_data import DB_PATH, load_compact_graph, load_subgraph
+from .snapshot import SNAPSHOT_PATH, SnapshotError, is_snapshot_current, open_snapshot
+from ..index.landmarks import LANDMARKS_PATH
+from ..index.spatial import SPATIAL_INDEX_PATH
+from ..index.inverted_index_builder import (
+    DB_PATH as INDEX_DB_PATH,
+    make_connection as index_connection,
+    load_feature_edge_ids,
+)
+
+'''
+Process-wide walk graph cache.
+
+Every request used to re-read walk_routes.db and rebuild the adjacency.
+The store loads the graph (as a CompactGraph) and the tag index once and hands
+the same read-only instance to every caller. The database files are stat()-ed on
+each get(); a rebuilt or replaced DB (new mtime, size or inode) triggers a reload.
+
+If a binary snapshot built from the current DB files exists it is mapped instead
+of reading SQLite, see snapshot.py.
+
+With Config.GRAPH_REGION_MODE on, requests get a regional subgraph instead of the
+whole graph (get_graph_for_area). Regions are keyed by a REGION_TILE_M tile around
+the request point, loaded through the R*Tree in walk_routes.db, and the most
+recently used REGION_CACHE_SIZE of them are kept.
+'''
+
+METERS_PER_DEGREE = 6371000 * math.pi / 180
+
+def _file_signature(path: Path) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def load_walk_graph(db_path: Path = DB_PATH, index_path: Path = INDEX_DB_PATH, version: Tuple = ()) -> CompactGraph:
+    feature_edge_ids = {}
+    if _file_signature(index_path) is not None:
+        conn = index_connection(index_path)
+        try:
+            feature_edge_ids = load_feature_edge_ids(conn)
+        finally:
+            conn.close()
+
+    return load_compact_graph(db_path, feature_edge_ids=feature_edge_ids, version=version)
+
+
+class GraphStore:
+    def __init__(
+        self,
+        db_path: Path = DB_PATH,
+        index_path: Path = INDEX_DB_PATH,
+        snapshot_path: Optional[Path] = SNAPSHOT_PATH,
+        spatial_index_path: Optional[Path] = SPATIAL_INDEX_PATH,
+        landmarks_path: Optional[Path] = LANDMARKS_PATH,
+    ):
+        self.db_path = Path(db_path)
+        self.index_path = Path(index_path)
+        self.snapshot_path = Path(snapshot_path) if snapshot_path is not None else None
+        self.spatial_index_path = spatial_index_path
+        self.landmarks_path = landmarks_path
+        self._graph: Optional[CompactGraph] = None
+        self._lock = threading.Lock()
+        # tile -> [(radius_m, graph)], least recently used tile first
+        self._regions: OrderedDict = OrderedDict()
+        self._regions_version: Optional[Tuple] = None
+
+    def _current_version(self) -> Tuple:
+        snapshot_signature = None
+        if self.snapshot_path is not None:
+            snapshot_signature = _file_signature(self.snapshot_path)
+        return (_file_signature(self.db_path), _file_signature(self.index_path), snapshot_signature)
+
+    def _load(self, version: Tuple) -> CompactGraph:
+        graph = None
+        if version[2] is not None and is_snapshot_current(self.snapshot_path, self.db_path, self.index_path):
+            try:
+                graph = open_snapshot(self.snapshot_path, version=version)
+            except SnapshotError as e:
+                print(f"Ignoring graph snapshot {self.snapshot_path}: {e}")
+        if graph is None:
+            graph = load_walk_graph(self.db_path, self.index_path, version=version)
+        graph.spatial_index_path = self.spatial_index_path
+        graph.landmarks_path = self.landmarks_path
+        return graph
+
+    def get(self) -> CompactGraph:
+        graph = self._graph
+        if graph is not None and graph.version == self._current_version():
+            return graph
+
+        with self._lock:
+            # another thread may have reloaded while we waited
+            graph = self._graph
+            version = self._current_version()
+            if graph is None or graph.version != version:
+                graph = self._load(version)
+                self._graph = graph
+            return graph
+
+    def get_region(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_m: float,
+        tile_m: float = Config.REGION_TILE_M,
+        cache_size: int = Config.REGION_CACHE_SIZE,
+    ) -> CompactGraph:
+        # snap to a tile so nearby requests share one region, load around the tile
+        # center with enough margin to cover any point of the tile
+        tile_lat = math.floor(latitude * METERS_PER_DEGREE / tile_m)
+        center_lat = (tile_lat + 0.5) * tile_m / METERS_PER_DEGREE
+        lon_tile_m = tile_m / max(math.cos(math.radians(center_lat)), 1e-6)
+        tile_lon = math.floor(longitude * METERS_PER_DEGREE / lon_tile_m)
+        center_lon = (tile_lon + 0.5) * lon_tile_m / METERS_PER_DEGREE
+        needed_m = radius_m + tile_m * math.sqrt(2) / 2
+        key = (tile_lat, tile_lon)
+
+        with self._lock:
+            version = self._current_version()
+            if version != self._regions_version:
+                self._regions.clear()
+                self._regions_version = version
+
+            cached = self._regions.get(key, [])
+            for loaded_radius_m, graph in cached:
+                if loaded_radius_m >= needed_m:
+                    self._regions.move_to_end(key)
+                    return graph
+
+            load_radius_m = math.ceil(needed_m / tile_m) * tile_m
+            graph = load_subgraph(
+                center_lat, center_lon, load_radius_m,
+                db_path=self.db_path, index_path=self.index_path, version=version,
+            )
+            # region graphs are small, build their spatial index and landmarks in memory
+            graph.spatial_index_path = None
+            graph.landmarks_path = None
+            self._regions[key] = [(r, g) for r, g in cached if r > load_radius_m] + [(load_radius_m, graph)]
+            self._regions.move_to_end(key)
+            while len(self._regions) > cache_size:
+                self._regions.popitem(last=False)
+            return graph
+
+    def clear(self):
+        with self._lock:
+            self._graph = None
+            self._regions.clear()
+
+
+_default_store = GraphStore()
+
+# use this function at request time instead of load_nodes()/load_edges()
+def get_graph() -> CompactGraph:
+    return _default_store.get()
+
+# the graph to use for a request around (latitude, longitude) that stays within radius_m
+def get_graph_for_area(latitude: float, longitude: float, radius_m: float) -> CompactGraph:
+    if Config.GRAPH_REGION_MODE:
+        return _default_store.get_region(latitude, longitude, radius_m)
+    return _default_store.get()
+
+def clear_graph_cache():
+    _default_store.clear()
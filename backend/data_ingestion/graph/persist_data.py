@@ -1,8 +1,19 @@
 import sqlite3
 import json
+import math
 from pathlib import Path
+import numpy as np
 from .node import Node
 from .edge import Edge
+from .compact_graph import CompactGraph
+from .graph_builder import GraphArrays, _haversine_distances_m
+from ..batching import executemany_in_batches
+from .tag_dictionary import TagDictionary
+from ..index.inverted_index_builder import (
+    DB_PATH as INDEX_DB_PATH,
+    make_connection as index_connection,
+    load_feature_edge_ids,
+)
 
 DATA_INGESTION_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = DATA_INGESTION_DIR / "data"
@@ -10,13 +21,14 @@ DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 DB_PATH = DATA_DIR / "walk_routes.db"
 
-def make_connection():
-    conn = sqlite3.connect(DB_PATH)
+def make_connection(db_path: Path = DB_PATH):
+    conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
     return conn
 
-def make_tables():
-    conn = make_connection()
+# bulk loads pass with_indexes=False and call create_edge_indexes once the rows are in
+def make_tables(db_path: Path = DB_PATH, with_indexes: bool = True):
+    conn = make_connection(db_path)
     cur = conn.cursor()
 
     cur.execute("""
@@ -26,22 +38,167 @@ def make_tables():
                 lon REAL NOT NULL
                 ); """)
 
+    # interned tag strings and tag sets, see tag_dictionary.py
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS tag_strings (
+                string_id INTEGER PRIMARY KEY,
+                value TEXT NOT NULL UNIQUE
+                ); """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS tag_set_items (
+                tag_set_id INTEGER NOT NULL,
+                key_id INTEGER NOT NULL,
+                value_id INTEGER NOT NULL,
+                PRIMARY KEY (tag_set_id, key_id)
+                ) WITHOUT ROWID; """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS ways (
+                way_id INTEGER PRIMARY KEY,
+                tag_set_id INTEGER NOT NULL,
+                version INTEGER,
+                timestamp TEXT,
+                checksum INTEGER
+                ); """)
+
+    # ways tables from before incremental refresh
+    way_columns = {row[1] for row in cur.execute("PRAGMA table_info(ways);")}
+    for column, column_type in (("version", "INTEGER"), ("timestamp", "TEXT"), ("checksum", "INTEGER")):
+        if column not in way_columns:
+            cur.execute(f"ALTER TABLE ways ADD COLUMN {column} {column_type};")
+
     cur.execute("""
                 CREATE TABLE IF NOT EXISTS edges (
                 edge_id INTEGER PRIMARY KEY,
                 start_node INTEGER NOT NULL,
                 end_node INTEGER NOT NULL,
                 distance_m REAL NOT NULL DEFAULT 0.0,
-                way_id INTEGER NOT NULL,
-                tags TEXT NOT NULL
+                way_id INTEGER NOT NULL
+                ); """)
+
+    # R*Tree indexes over node positions and edge bounding boxes for load_subgraph
+    cur.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS node_rtree USING rtree(
+                node_id, min_lat, max_lat, min_lon, max_lon
                 ); """)
 
+    cur.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS edge_rtree USING rtree(
+                edge_id, min_lat, max_lat, min_lon, max_lon
+                ); """)
+
+    if _has_legacy_edge_tags(cur):
+        _migrate_legacy_edge_tags(conn)
+
+    if with_indexes:
+        create_edge_indexes(conn)
+
+    # databases built before the R*Tree existed
+    has_nodes = cur.execute("SELECT 1 FROM nodes LIMIT 1;").fetchone() is not None
+    has_node_rtree = cur.execute("SELECT 1 FROM node_rtree LIMIT 1;").fetchone() is not None
+    if has_nodes and not has_node_rtree:
+        _rebuild_rtrees(cur)
+
     conn.commit()
     conn.close()
 
+# lookups by way for refresh.py, and by endpoint to find nodes no edge uses any more
+def create_edge_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_edges_way ON edges(way_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_edges_start_node ON edges(start_node);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_edges_end_node ON edges(end_node);")
+
+def _rebuild_rtrees(cur):
+    cur.execute("DELETE FROM node_rtree;")
+    cur.execute("""
+                INSERT INTO node_rtree (node_id, min_lat, max_lat, min_lon, max_lon)
+                SELECT node_id, lat, lat, lon, lon FROM nodes;
+                """)
+    cur.execute("DELETE FROM edge_rtree;")
+    cur.execute("""
+                INSERT INTO edge_rtree (edge_id, min_lat, max_lat, min_lon, max_lon)
+                SELECT e.edge_id, MIN(a.lat, b.lat), MAX(a.lat, b.lat), MIN(a.lon, b.lon), MAX(a.lon, b.lon)
+                FROM edges e
+                JOIN nodes a ON a.node_id = e.start_node
+                JOIN nodes b ON b.node_id = e.end_node;
+                """)
+
+def _has_legacy_edge_tags(cur) -> bool:
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(edges);")]
+    return "tags" in columns
+
+# older databases kept a JSON copy of the way's tags on every edge
+def _migrate_legacy_edge_tags(conn):
+    cur = conn.cursor()
+    dictionary = load_tag_dictionary(conn)
+    persisted = (len(dictionary.strings), len(dictionary))
+
+    way_tag_sets = {}
+    for way_id, tags in cur.execute("SELECT way_id, tags FROM edges GROUP BY way_id;").fetchall():
+        way_tag_sets[way_id] = dictionary.intern(json.loads(tags))
+
+    save_tag_dictionary(conn, dictionary, persisted)
+    cur.executemany("INSERT OR REPLACE INTO ways (way_id, tag_set_id) VALUES (?, ?);",
+                    way_tag_sets.items())
+
+    cur.execute("ALTER TABLE edges RENAME TO edges_legacy;")
+    cur.execute("""
+                CREATE TABLE edges (
+                edge_id INTEGER PRIMARY KEY,
+                start_node INTEGER NOT NULL,
+                end_node INTEGER NOT NULL,
+                distance_m REAL NOT NULL DEFAULT 0.0,
+                way_id INTEGER NOT NULL
+                ); """)
+    cur.execute("""
+                INSERT INTO edges (edge_id, start_node, end_node, distance_m, way_id)
+                SELECT edge_id, start_node, end_node, distance_m, way_id FROM edges_legacy;
+                """)
+    cur.execute("DROP TABLE edges_legacy;")
+
+def load_tag_dictionary(conn) -> TagDictionary:
+    dictionary = TagDictionary()
+    cur = conn.cursor()
+
+    for string_id, value in cur.execute("SELECT string_id, value FROM tag_strings ORDER BY string_id;"):
+        # ids are handed out densely from 0 so they double as list positions
+        if dictionary.intern_string(value) != string_id:
+            raise ValueError("tag_strings ids are not dense")
+
+    current_id = None
+    items = []
+    for tag_set_id, key_id, value_id in cur.execute(
+        "SELECT tag_set_id, key_id, value_id FROM tag_set_items ORDER BY tag_set_id, key_id;"
+    ):
+        if tag_set_id != current_id and current_id is not None:
+            dictionary.add_items(tuple(items))
+            items = []
+        current_id = tag_set_id
+        items.append((key_id, value_id))
+    if current_id is not None:
+        dictionary.add_items(tuple(items))
+
+    return dictionary
+
+# writes strings and tag sets that were interned after `persisted` = (strings, tag sets) were saved
+def save_tag_dictionary(conn, dictionary: TagDictionary, persisted=(0, 0)):
+    cur = conn.cursor()
+    saved_strings, saved_tag_sets = persisted
+
+    cur.executemany("INSERT INTO tag_strings (string_id, value) VALUES (?, ?);",
+                    enumerate(dictionary.strings[saved_strings:], start=saved_strings))
+    cur.executemany("INSERT INTO tag_set_items (tag_set_id, key_id, value_id) VALUES (?, ?, ?);",
+                    [
+                        (tag_set_id, key_id, value_id)
+                        for tag_set_id in range(saved_tag_sets, len(dictionary))
+                        for key_id, value_id in dictionary.tag_set_items[tag_set_id]
+                    ])
+
 # populates nodes table with nodes
-def insert_nodes(nodes: dict[int, Node]):
-    conn = make_connection()
+def insert_nodes(nodes: dict[int, Node], db_path: Path = DB_PATH):
+    conn = make_connection(db_path)
     cur = conn.cursor()
 
     cur.executemany("""
@@ -50,18 +207,44 @@ def insert_nodes(nodes: dict[int, Node]):
                     """,
                     [(n.node_id, n.lat, n.lon) for n in nodes.values()] )
 
+    cur.executemany("""
+                    INSERT OR REPLACE INTO node_rtree (node_id, min_lat, max_lat, min_lon, max_lon)
+                    VALUES (?, ?, ?, ?, ?);
+                    """,
+                    [(n.node_id, n.lat, n.lat, n.lon, n.lon) for n in nodes.values()] )
+
     conn.commit()
     conn.close()
 
-# populates edges table with edges
-def insert_edges(edges: dict[int, Edge]):
-    conn = make_connection()
+# populates edges table with edges, and the ways table with each way's interned tag set
+def insert_edges(edges: dict[int, Edge], db_path: Path = DB_PATH):
+    conn = make_connection(db_path)
     cur = conn.cursor()
 
+    dictionary = load_tag_dictionary(conn)
+    persisted = (len(dictionary.strings), len(dictionary))
+
+    way_tag_sets = {}
+    interned = {}
+    for e in edges.values():
+        # segments of one way share their tags dict, intern it once
+        tag_set_id = interned.get(id(e.tags))
+        if tag_set_id is None:
+            tag_set_id = interned[id(e.tags)] = dictionary.intern(e.tags)
+        way_tag_sets[e.way_id] = tag_set_id
+
+    save_tag_dictionary(conn, dictionary, persisted)
+
+    cur.executemany("""
+                    INSERT OR REPLACE INTO ways (way_id, tag_set_id)
+                    VALUES (?, ?);
+                    """,
+                    way_tag_sets.items())
+
     cur.executemany("""
                     INSERT OR REPLACE INTO edges
-                    (edge_id, start_node, end_node, distance_m, way_id, tags)
-                    VALUES (?, ?, ?, ?, ?, ?);
+                    (edge_id, start_node, end_node, distance_m, way_id)
+                    VALUES (?, ?, ?, ?, ?);
                     """,
                     [
                         (
@@ -70,18 +253,90 @@ def insert_edges(edges: dict[int, Edge]):
                             e.end_node,
                             e.distance_m,
                             e.way_id,
-                            json.dumps(e.tags),
                         )
                         for e in edges.values()
                     ]
                 )
 
+    # edge bounding boxes come from the node table, so insert nodes first
+    cur.executemany("""
+                    INSERT OR REPLACE INTO edge_rtree (edge_id, min_lat, max_lat, min_lon, max_lon)
+                    SELECT ?, MIN(a.lat, b.lat), MAX(a.lat, b.lat), MIN(a.lon, b.lon), MAX(a.lon, b.lon)
+                    FROM nodes a, nodes b
+                    WHERE a.node_id = ? AND b.node_id = ?;
+                    """,
+                    [(e.edge_id, e.start_node, e.end_node) for e in edges.values()]
+                )
+
+    conn.commit()
+    conn.close()
+
+# populates nodes, ways and edges (and their R*Trees) straight from build_graph_arrays output
+def insert_graph_arrays(graph: GraphArrays, db_path: Path = DB_PATH):
+    conn = make_connection(db_path)
+    write_graph_arrays(conn, graph, load_tag_dictionary(conn))
     conn.commit()
     conn.close()
 
+# writes one GraphArrays on an open connection without committing; `dictionary` must be
+# the tag dictionary stored in that DB and is extended in place (see bulk_load.py)
+def write_graph_arrays(conn, graph: GraphArrays, dictionary: TagDictionary, batch_size=None):
+    cur = conn.cursor()
+
+    node_ids = graph.node_ids.tolist()
+    lat = graph.lat.tolist()
+    lon = graph.lon.tolist()
+    executemany_in_batches(cur, "INSERT OR REPLACE INTO nodes (node_id, lat, lon) VALUES (?, ?, ?);",
+                           zip(node_ids, lat, lon), batch_size)
+    executemany_in_batches(cur, """
+                           INSERT OR REPLACE INTO node_rtree (node_id, min_lat, max_lat, min_lon, max_lon)
+                           VALUES (?, ?, ?, ?, ?);
+                           """,
+                           zip(node_ids, lat, lat, lon, lon), batch_size)
+
+    # the graph's tag set ids are local to it, map them onto the stored dictionary
+    persisted = (len(dictionary.strings), len(dictionary))
+    stored_tag_set = np.array(
+        [dictionary.intern(graph.tag_sets.tags(i)) for i in range(len(graph.tag_sets))],
+        dtype=np.int64,
+    )
+    save_tag_dictionary(conn, dictionary, persisted)
+
+    ways = graph.ways
+    executemany_in_batches(cur, """
+                           INSERT OR REPLACE INTO ways (way_id, tag_set_id, version, timestamp, checksum)
+                           VALUES (?, ?, ?, ?, ?);
+                           """,
+                           zip(ways["way_id"].tolist(), stored_tag_set[ways["tag_set_id"]].tolist(),
+                               ways["version"].tolist(), ways["timestamp"].tolist(), ways["checksum"].tolist()),
+                           batch_size)
+
+    edge_ids = graph.edge_ids.tolist()
+    executemany_in_batches(cur, """
+                           INSERT OR REPLACE INTO edges
+                           (edge_id, start_node, end_node, distance_m, way_id)
+                           VALUES (?, ?, ?, ?, ?);
+                           """,
+                           zip(edge_ids, graph.start_nodes.tolist(), graph.end_nodes.tolist(),
+                               graph.distance_m.tolist(), graph.way_ids.tolist()),
+                           batch_size)
+
+    start = np.searchsorted(graph.node_ids, graph.start_nodes)
+    end = np.searchsorted(graph.node_ids, graph.end_nodes)
+    executemany_in_batches(cur, """
+                           INSERT OR REPLACE INTO edge_rtree (edge_id, min_lat, max_lat, min_lon, max_lon)
+                           VALUES (?, ?, ?, ?, ?);
+                           """,
+                           zip(edge_ids,
+                               np.minimum(graph.lat[start], graph.lat[end]).tolist(),
+                               np.maximum(graph.lat[start], graph.lat[end]).tolist(),
+                               np.minimum(graph.lon[start], graph.lon[end]).tolist(),
+                               np.maximum(graph.lon[start], graph.lon[end]).tolist()),
+                           batch_size)
+
 # use this function after query time to load node information as Node objects
-def load_nodes() -> dict[int, Node]:
-    conn = make_connection()
+def load_nodes(db_path: Path = DB_PATH) -> dict[int, Node]:
+    conn = make_connection(db_path)
     cur = conn.cursor()
 
     cur.execute("SELECT * FROM nodes;")
@@ -99,11 +354,16 @@ def load_nodes() -> dict[int, Node]:
     }
 
 # use this function after query time to load edge information as Edge objects
-def load_edges() -> dict[int, Edge]:
-    conn = make_connection()
+# edges of the same tag set share one tags dict from the tag dictionary
+def load_edges(db_path: Path = DB_PATH) -> dict[int, Edge]:
+    conn = make_connection(db_path)
     cur = conn.cursor()
 
-    cur.execute("SELECT * FROM edges;")
+    dictionary = load_tag_dictionary(conn)
+    cur.execute("""
+                SELECT e.edge_id, e.start_node, e.end_node, e.distance_m, e.way_id, w.tag_set_id
+                FROM edges e JOIN ways w ON w.way_id = e.way_id;
+                """)
     rows = cur.fetchall()
 
     conn.close()
@@ -115,7 +375,152 @@ def load_edges() -> dict[int, Edge]:
             end_node=row["end_node"],
             distance_m=row["distance_m"],
             way_id=row["way_id"],
-            tags=json.loads(row["tags"])
+            tags=dictionary.tags(row["tag_set_id"]),
+            tag_set_id=row["tag_set_id"]
         )
         for row in rows
-    }
\ No newline at end of file
+    }
+
+# loads the graph straight into CSR arrays without building Node/Edge objects
+def load_compact_graph(db_path: Path = DB_PATH, feature_edge_ids=None, version=()) -> CompactGraph:
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+
+    node_rows = cur.execute("SELECT node_id, lat, lon FROM nodes;").fetchall()
+    nodes = np.array(node_rows, dtype=[("node_id", "i8"), ("lat", "f8"), ("lon", "f8")])
+
+    dictionary = load_tag_dictionary(conn)
+    edge_rows = cur.execute("""
+                            SELECT e.edge_id, e.start_node, e.end_node, e.distance_m, e.way_id, w.tag_set_id
+                            FROM edges e JOIN ways w ON w.way_id = e.way_id;
+                            """).fetchall()
+
+    conn.close()
+
+    edges = np.array(edge_rows, dtype=[("edge_id", "i8"), ("start_node", "i8"), ("end_node", "i8"),
+                                       ("distance_m", "f4"), ("way_id", "i8"), ("tag_set_id", "i4")])
+
+    return CompactGraph.from_arrays(
+        node_ids=nodes["node_id"],
+        lat=nodes["lat"],
+        lon=nodes["lon"],
+        edge_ids=edges["edge_id"],
+        start_nodes=edges["start_node"],
+        end_nodes=edges["end_node"],
+        distance_m=edges["distance_m"],
+        way_ids=edges["way_id"],
+        edge_tag_set=edges["tag_set_id"],
+        tag_sets=dictionary,
+        feature_edge_ids=feature_edge_ids,
+        version=version,
+    )
+
+def _bounding_box(latitude: float, longitude: float, radius_m: float):
+    meters_per_degree = 6371000 * math.pi / 180
+    delta_lat = radius_m / meters_per_degree
+    delta_lon = radius_m / (meters_per_degree * max(math.cos(math.radians(latitude)), 1e-6))
+    return latitude - delta_lat, latitude + delta_lat, longitude - delta_lon, longitude + delta_lon
+
+def _temp_id_table(cur, name: str, ids):
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY);")
+    cur.execute(f"DELETE FROM {name};")
+    cur.executemany(f"INSERT OR IGNORE INTO {name} (id) VALUES (?);", ((int(i),) for i in ids))
+
+'''
+Loads only the part of the graph a walk starting within radius_m of (latitude, longitude)
+can reach: every edge whose start node lies inside the radius, plus their end nodes.
+A walk never gets farther from its start than the distance it has walked, so
+radius = max_start_distance_m + max_distance_m covers every route of a request.
+Feature (tag) sets from the inverted index are restricted to the same edges.
+'''
+def load_subgraph(
+    latitude: float,
+    longitude: float,
+    radius_m: float,
+    db_path: Path = DB_PATH,
+    index_path: Path = INDEX_DB_PATH,
+    version=(),
+) -> CompactGraph:
+    min_lat, max_lat, min_lon, max_lon = _bounding_box(latitude, longitude, radius_m)
+
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+
+    edge_rows = cur.execute("""
+                            SELECT e.edge_id, e.start_node, e.end_node, e.distance_m, e.way_id,
+                                   w.tag_set_id, n.lat, n.lon
+                            FROM edge_rtree r
+                            JOIN edges e ON e.edge_id = r.edge_id
+                            JOIN ways w ON w.way_id = e.way_id
+                            JOIN nodes n ON n.node_id = e.start_node
+                            WHERE r.max_lat >= ? AND r.min_lat <= ?
+                              AND r.max_lon >= ? AND r.min_lon <= ?;
+                            """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    edges = np.array(edge_rows, dtype=[("edge_id", "i8"), ("start_node", "i8"), ("end_node", "i8"),
+                                       ("distance_m", "f4"), ("way_id", "i8"), ("tag_set_id", "i4"),
+                                       ("lat", "f8"), ("lon", "f8")])
+    # the box is a superset of the circle
+    inside = _haversine_distances_m(latitude, longitude, edges["lat"], edges["lon"]) <= radius_m
+    edges = edges[inside]
+
+    # nodes inside the radius (including ones without outgoing edges) and every edge endpoint
+    box_nodes = cur.execute("""
+                            SELECT n.node_id, n.lat, n.lon
+                            FROM node_rtree r
+                            JOIN nodes n ON n.node_id = r.node_id
+                            WHERE r.max_lat >= ? AND r.min_lat <= ?
+                              AND r.max_lon >= ? AND r.min_lon <= ?;
+                            """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    box_nodes = np.array(box_nodes, dtype=[("node_id", "i8"), ("lat", "f8"), ("lon", "f8")])
+    box_nodes = box_nodes[_haversine_distances_m(latitude, longitude, box_nodes["lat"], box_nodes["lon"]) <= radius_m]
+    _temp_id_table(cur, "region_nodes", np.union1d(
+        box_nodes["node_id"], np.union1d(edges["start_node"], edges["end_node"])
+    ))
+    node_rows = cur.execute("""
+                            SELECT n.node_id, n.lat, n.lon
+                            FROM region_nodes r JOIN nodes n ON n.node_id = r.id;
+                            """).fetchall()
+    nodes = np.array(node_rows, dtype=[("node_id", "i8"), ("lat", "f8"), ("lon", "f8")])
+
+    # re-intern just the tag sets used here, numbered from 0
+    old_tag_set_ids, tag_set_positions = np.unique(edges["tag_set_id"], return_inverse=True)
+    _temp_id_table(cur, "region_tag_sets", old_tag_set_ids)
+    region_tags = {int(tag_set_id): {} for tag_set_id in old_tag_set_ids}
+    for tag_set_id, key, value in cur.execute("""
+                                              SELECT i.tag_set_id, k.value, v.value
+                                              FROM region_tag_sets r
+                                              JOIN tag_set_items i ON i.tag_set_id = r.id
+                                              JOIN tag_strings k ON k.string_id = i.key_id
+                                              JOIN tag_strings v ON v.string_id = i.value_id;
+                                              """):
+        region_tags[tag_set_id][key] = value
+    conn.close()
+
+    dictionary = TagDictionary()
+    new_tag_set_ids = np.array(
+        [dictionary.intern(region_tags[int(tag_set_id)]) for tag_set_id in old_tag_set_ids],
+        dtype=np.int32,
+    )
+
+    feature_edge_ids = {}
+    if Path(index_path).exists():
+        index_conn = index_connection(index_path)
+        try:
+            feature_edge_ids = load_feature_edge_ids(index_conn, edge_ids=edges["edge_id"])
+        finally:
+            index_conn.close()
+
+    return CompactGraph.from_arrays(
+        node_ids=nodes["node_id"],
+        lat=nodes["lat"],
+        lon=nodes["lon"],
+        edge_ids=edges["edge_id"],
+        start_nodes=edges["start_node"],
+        end_nodes=edges["end_node"],
+        distance_m=edges["distance_m"],
+        way_ids=edges["way_id"],
+        edge_tag_set=new_tag_set_ids[tag_set_positions],
+        tag_sets=dictionary,
+        feature_edge_ids=feature_edge_ids,
+        version=version,
+    )
@@ -0,0 +1,388 @@
+import mmap
+import os
+import struct
+import tempfile
+import weakref
+import zlib
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from .compact_graph import CompactGraph
+from .tag_dictionary import TagDictionary
+from .persist_data import DATA_DIR, DB_PATH
+from ..index.inverted_index_builder import DB_PATH as INDEX_DB_PATH
+
+'''
+Binary graph snapshot.
+
+An offline build step turns walk_routes.db + inverted_index.db into one file of
+fixed-layout arrays that the server maps with mmap instead of querying every
+row out of SQLite. Opening costs a header read, pages
+are shared between processes through the page cache, and only the parts of the
+graph a request touches are ever read from disk.
+
+Layout (little endian):
+    header      magic, format version, counts, source DB signatures, payload crc32
+    sections    (offset, count) for every entry of SECTIONS, in order
+    header crc  crc32 of everything above
+    payload     the section arrays, each aligned to ALIGNMENT bytes
+
+The string table holds the interned tag key/value strings followed by the
+feature names of the inverted index. tag_set_offsets / tag_set_items are a CSR
+of tag set -> (key string id, value string id) pairs, and feature_offsets /
+feature_rows a CSR of feature -> sorted edge rows.
+'''
+
+SNAPSHOT_PATH = DATA_DIR / "walk_graph.snapshot"
+
+MAGIC = b"WRGRAPH\x00"
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+SECTIONS = (
+    ("node_ids", np.int64),
+    ("lat", np.float64),
+    ("lon", np.float64),
+    ("offsets", np.int64),
+    ("edge_ids", np.int64),
+    ("edge_src", np.int32),
+    ("edge_dst", np.int32),
+    ("distance_m", np.float32),
+    ("way_ids", np.int64),
+    ("edge_tag_set", np.int32),
+    ("edge_id_order", np.int32),
+    ("sorted_edge_ids", np.int64),
+    ("tag_set_offsets", np.int64),
+    ("tag_set_items", np.int32),
+    ("feature_offsets", np.int64),
+    ("feature_rows", np.int32),
+    ("string_offsets", np.int64),
+    ("string_data", np.uint8),
+)
+
+# magic, format version, section count, nodes, edges, tag sets, strings, features,
+# db mtime_ns, db size, index mtime_ns, index size, payload crc32
+_HEADER = struct.Struct("<8sIIqqqqqqqqqI")
+_SECTION = struct.Struct("<qq")
+_CRC = struct.Struct("<I")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _header_size() -> int:
+    size = _HEADER.size + _SECTION.size * len(SECTIONS) + _CRC.size
+    return _align(size)
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _source_signature(path: Path) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return (-1, -1)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _string_table(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def write_snapshot(
+    graph: CompactGraph,
+    path: Path = SNAPSHOT_PATH,
+    db_path: Path = DB_PATH,
+    index_path: Path = INDEX_DB_PATH,
+) -> Path:
+    path = Path(path)
+    features = sorted(graph.feature_edge_rows)
+    feature_offsets = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum([len(graph.feature_edge_rows[f]) for f in features], out=feature_offsets[1:])
+    if features:
+        feature_rows = np.concatenate([graph.feature_edge_rows[f] for f in features])
+    else:
+        feature_rows = np.zeros(0, dtype=np.int32)
+
+    if isinstance(graph.tag_sets, TagDictionary):
+        dictionary = graph.tag_sets
+        tag_set_items = dictionary.tag_set_items
+    else:
+        # plain list of dicts, intern the strings but keep tag set positions
+        dictionary = TagDictionary()
+        tag_set_items = [
+            tuple((dictionary.intern_string(k), dictionary.intern_string(v)) for k, v in tags.items())
+            for tags in graph.tag_sets
+        ]
+    tag_set_offsets = np.zeros(len(tag_set_items) + 1, dtype=np.int64)
+    np.cumsum([len(items) for items in tag_set_items], out=tag_set_offsets[1:])
+    flat_items = np.array(
+        [ids for items in tag_set_items for pair in items for ids in pair], dtype=np.int32
+    )
+
+    string_offsets, string_data = _string_table(dictionary.strings + features)
+
+    arrays = {
+        "node_ids": graph.node_ids,
+        "lat": graph.lat,
+        "lon": graph.lon,
+        "offsets": graph.offsets,
+        "edge_ids": graph.edge_ids,
+        "edge_src": graph.edge_src,
+        "edge_dst": graph.edge_dst,
+        "distance_m": graph.distance_m,
+        "way_ids": graph.way_ids,
+        "edge_tag_set": graph.edge_tag_set,
+        "edge_id_order": graph._edge_id_order,
+        "sorted_edge_ids": graph._sorted_edge_ids,
+        "tag_set_offsets": tag_set_offsets,
+        "tag_set_items": flat_items,
+        "feature_offsets": feature_offsets,
+        "feature_rows": feature_rows,
+        "string_offsets": string_offsets,
+        "string_data": string_data,
+    }
+
+    sections = []
+    offset = _header_size()
+    for name, dtype in SECTIONS:
+        array = np.ascontiguousarray(arrays[name], dtype=dtype)
+        arrays[name] = array
+        sections.append((offset, len(array)))
+        offset = _align(offset + array.nbytes)
+
+    # write next to the target and swap in, readers never see a partial file
+    tmp_path = path.with_name(path.name + ".tmp")
+    crc = 0
+    with open(tmp_path, "wb") as f:
+        f.write(b"\x00" * _header_size())
+        for (name, _), (section_offset, _) in zip(SECTIONS, sections):
+            padding = b"\x00" * (section_offset - f.tell())
+            data = arrays[name].tobytes()
+            crc = zlib.crc32(data, zlib.crc32(padding, crc))
+            f.write(padding)
+            f.write(data)
+        padding = b"\x00" * (_align(f.tell()) - f.tell())
+        crc = zlib.crc32(padding, crc)
+        f.write(padding)
+
+        header = _HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            len(SECTIONS),
+            graph.num_nodes,
+            graph.num_edges,
+            len(tag_set_items),
+            len(dictionary.strings),
+            len(features),
+            *_source_signature(db_path),
+            *_source_signature(index_path),
+            crc,
+        )
+        header += b"".join(_SECTION.pack(o, n) for o, n in sections)
+        header += _CRC.pack(zlib.crc32(header))
+        f.seek(0)
+        f.write(header)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return path
+
+
+class _StringTable:
+    def __init__(self, offsets: np.ndarray, data: np.ndarray, start: int = 0):
+        self._offsets = offsets
+        self._data = data
+        self._start = start
+
+    def __getitem__(self, index: int) -> str:
+        i = self._start + index
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class _LazyTagSets(Sequence):
+    """Tag sets decoded from the string table the first time an edge asks for them."""
+    def __init__(self, strings: _StringTable, offsets: np.ndarray, items: np.ndarray):
+        self._strings = strings
+        self._offsets = offsets
+        self._items = items
+        self._count = len(offsets) - 1
+        self._decoded = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        tags = self._decoded.get(index)
+        if tags is None:
+            ids = self._items[2 * self._offsets[index]:2 * self._offsets[index + 1]].tolist()
+            strings = self._strings
+            tags = self._decoded[index] = {
+                strings[key_id]: strings[value_id]
+                for key_id, value_id in zip(ids[::2], ids[1::2])
+            }
+        return tags
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def read_header(path: Path = SNAPSHOT_PATH) -> dict:
+    with open(path, "rb") as f:
+        raw = f.read(_header_size())
+    return _parse_header(raw)
+
+
+def _parse_header(raw) -> dict:
+    if len(raw) < _header_size():
+        raise SnapshotError("snapshot is truncated")
+    fields = _HEADER.unpack_from(raw, 0)
+    magic, version, section_count = fields[:3]
+    if magic != MAGIC:
+        raise SnapshotError("not a walk graph snapshot")
+    if version != FORMAT_VERSION:
+        raise SnapshotError(f"unsupported snapshot version {version}")
+    if section_count != len(SECTIONS):
+        raise SnapshotError("snapshot section table does not match this build")
+
+    table_end = _HEADER.size + _SECTION.size * section_count
+    (header_crc,) = _CRC.unpack_from(raw, table_end)
+    if zlib.crc32(bytes(raw[:table_end])) != header_crc:
+        raise SnapshotError("snapshot header checksum mismatch")
+
+    sections = [
+        _SECTION.unpack_from(raw, _HEADER.size + i * _SECTION.size)
+        for i in range(section_count)
+    ]
+    return {
+        "num_nodes": fields[3],
+        "num_edges": fields[4],
+        "num_tag_sets": fields[5],
+        "num_strings": fields[6],
+        "num_features": fields[7],
+        "db_signature": (fields[8], fields[9]),
+        "index_signature": (fields[10], fields[11]),
+        "payload_crc": fields[12],
+        "sections": dict(zip((name for name, _ in SECTIONS), sections)),
+    }
+
+
+def is_snapshot_current(
+    path: Path = SNAPSHOT_PATH,
+    db_path: Path = DB_PATH,
+    index_path: Path = INDEX_DB_PATH,
+) -> bool:
+    """True if the snapshot was built from the DB files as they are now (or the DBs are absent)."""
+    try:
+        header = read_header(path)
+    except (FileNotFoundError, SnapshotError):
+        return False
+
+    for recorded, source in ((header["db_signature"], db_path), (header["index_signature"], index_path)):
+        current = _source_signature(source)
+        if current != (-1, -1) and current != recorded:
+            return False
+    return True
+
+
+def open_snapshot(path: Path = SNAPSHOT_PATH, verify: bool = False, version: Tuple = ()) -> CompactGraph:
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = _parse_header(mm[:_header_size()])
+    if verify:
+        payload_crc = zlib.crc32(memoryview(mm)[_header_size():])
+        if payload_crc != header["payload_crc"]:
+            raise SnapshotError("snapshot payload checksum mismatch")
+
+    arrays = {}
+    for name, dtype in SECTIONS:
+        offset, count = header["sections"][name]
+        if offset + count * np.dtype(dtype).itemsize > len(mm):
+            raise SnapshotError(f"snapshot section {name} runs past the end of the file")
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+
+    strings = _StringTable(arrays["string_offsets"], arrays["string_data"])
+    feature_offsets = arrays["feature_offsets"]
+    feature_names = _StringTable(arrays["string_offsets"], arrays["string_data"], start=header["num_strings"])
+    feature_edge_rows = {
+        feature_names[i]: arrays["feature_rows"][feature_offsets[i]:feature_offsets[i + 1]]
+        for i in range(header["num_features"])
+    }
+
+    graph = CompactGraph(
+        node_ids=arrays["node_ids"],
+        lat=arrays["lat"],
+        lon=arrays["lon"],
+        offsets=arrays["offsets"],
+        edge_ids=arrays["edge_ids"],
+        edge_src=arrays["edge_src"],
+        edge_dst=arrays["edge_dst"],
+        distance_m=arrays["distance_m"],
+        way_ids=arrays["way_ids"],
+        edge_tag_set=arrays["edge_tag_set"],
+        tag_sets=_LazyTagSets(strings, arrays["tag_set_offsets"], arrays["tag_set_items"]),
+        feature_edge_rows=feature_edge_rows,
+        version=version,
+        edge_id_order=arrays["edge_id_order"],
+        sorted_edge_ids=arrays["sorted_edge_ids"],
+    )
+    # the arrays are views into the mapping, keep it alive with the graph
+    graph._mmap = mm
+    graph._snapshot_path = Path(path)
+    return graph
+
+
+def shared_snapshot_path(graph: CompactGraph) -> Path:
+    """
+    A snapshot of graph that other processes can map: the file it was opened from,
+    or a temporary one written on first use and removed with the graph.
+    """
+    path = getattr(graph, "_snapshot_path", None)
+    if path is None:
+        fd, name = tempfile.mkstemp(prefix="walk_graph_", suffix=".snapshot")
+        os.close(fd)
+        path = write_snapshot(graph, Path(name))
+        weakref.finalize(graph, _remove_file, path)
+        graph._snapshot_path = path
+    return path
+
+def _remove_file(path: Path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def verify_snapshot(path: Path = SNAPSHOT_PATH) -> dict:
+    graph = open_snapshot(path, verify=True)
+    return {"nodes": graph.num_nodes, "edges": graph.num_edges, "tag_sets": len(graph.tag_sets)}
+
+
+def build_snapshot(
+    db_path: Path = DB_PATH,
+    index_path: Path = INDEX_DB_PATH,
+    path: Path = SNAPSHOT_PATH,
+) -> Path:
+    from .graph_store import load_walk_graph
+
+    graph = load_walk_graph(db_path, index_path)
+    write_snapshot(graph, path, db_path=db_path, index_path=index_path)
+    verify_snapshot(path)
+    return path
+
+
+if __name__ == "__main__":
+    out_path = build_snapshot()
+    print(f"Wrote graph snapshot to {out_path}: {verify_snapshot(out_path)}")
@@ -0,0 +1,60 @@
+from typing import Dict, List, Mapping, Tuple
+
+'''
+Interned OSM tag sets.
+
+Every key and value string gets a small integer id, and every distinct set of
+(key id, value id) pairs gets a tag set id. Edges of a way point at their way's
+tag set, so a long residential street is stored and decoded once instead of once
+per segment. tags(tag_set_id) hands out one shared dict per tag set; treat it as
+read-only.
+'''
+
+TagSetItems = Tuple[Tuple[int, int], ...]
+
+class TagDictionary:
+    def __init__(self):
+        self.strings: List[str] = []
+        self.string_ids: Dict[str, int] = {}
+        self.tag_set_items: List[TagSetItems] = []
+        self.tag_set_ids: Dict[TagSetItems, int] = {}
+        self._decoded: List[dict | None] = []
+
+    def intern_string(self, value: str) -> int:
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def intern(self, tags: Mapping[str, str]) -> int:
+        items = tuple(sorted(
+            (self.intern_string(key), self.intern_string(value))
+            for key, value in tags.items()
+        ))
+        return self.add_items(items)
+
+    def add_items(self, items: TagSetItems) -> int:
+        tag_set_id = self.tag_set_ids.get(items)
+        if tag_set_id is None:
+            tag_set_id = self.tag_set_ids[items] = len(self.tag_set_items)
+            self.tag_set_items.append(items)
+            self._decoded.append(None)
+        return tag_set_id
+
+    def tags(self, tag_set_id: int) -> dict:
+        tags = self._decoded[tag_set_id]
+        if tags is None:
+            strings = self.strings
+            tags = self._decoded[tag_set_id] = {
+                strings[key_id]: strings[value_id]
+                for key_id, value_id in self.tag_set_items[tag_set_id]
+            }
+        return tags
+
+    # lets CompactGraph use the dictionary directly as its tag_sets sequence
+    def __getitem__(self, tag_set_id: int) -> dict:
+        return self.tags(tag_set_id)
+
+    def __len__(self) -> int:
+        return len(self.tag_set_items)
@@ -1,55 +1,259 @@
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
+import hashlib
+import math
+import os
+import random
+import shutil
+import time
 import requests
 import json
 from config import Config
+from .overpass_cache import OverpassCache, OverpassCacheMiss, OverpassRuntimeError
+from .osm_extract import iter_osm_extract
+from .overpass_query import WALKABLE_HIGHWAYS, HARD_EXCLUDE, DENY, project_tags, walkable_ways_query
+from .stream import iter_overpass_elements, iter_overpass_file
+
+OVERPASS_TILE_DIR = Path(__file__).resolve().parent / "data" / "overpass_tiles"
+
+# rate limited or overloaded, worth retrying after a pause
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+OC_BBOX = (33.39, -118.13, 33.87, -117.51)
+
+class OverpassFetchError(Exception):
+    pass
+
+Bbox = Tuple[float, float, float, float]
+
+def split_bbox(bbox: Bbox, tile_deg: float) -> List[Bbox]:
+    """
+    Split a (south, west, north, east) box into tiles of at most tile_deg x tile_deg.
+    """
+    south, west, north, east = bbox
+    # the epsilon keeps float noise (0.2 / 0.05 = 4.000000000000001) from adding a sliver row
+    rows = max(1, math.ceil((north - south) / tile_deg - 1e-9))
+    cols = max(1, math.ceil((east - west) / tile_deg - 1e-9))
+    lat_step = (north - south) / rows
+    lon_step = (east - west) / cols
+    return [
+        (
+            round(south + r * lat_step, 7),
+            round(west + c * lon_step, 7),
+            round(south + (r + 1) * lat_step, 7),
+            round(west + (c + 1) * lon_step, 7),
+        )
+        for r in range(rows)
+        for c in range(cols)
+    ]
+
+def _has_runtime_error(path: Path) -> bool:
+    # Overpass answers 200 and appends a runtime error remark when a query times out
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - 4096))
+        return b"runtime error" in f.read()
+
+class _RetryLater(Exception):
+    def __init__(self, response, message=None):
+        self.retry_after = 0.0
+        if response is not None:
+            message = f"HTTP {response.status_code}"
+            try:
+                self.retry_after = float(response.headers.get("Retry-After", 0))
+            except ValueError:
+                pass
+        super().__init__(message)
+
+def iter_tile_elements(tile_paths: Iterable[Path]) -> Iterator[Dict]:
+    """
+    Elements of finished tiles, each way once even if it crosses tile borders.
+    """
+    seen = set()
+    for path in tile_paths:
+        for el in iter_overpass_file(path):
+            key = (el.get("type"), el.get("id"))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield el
 
 class DataIngestion:
-    def __init__(self):
+    def __init__(self, cache: Optional[OverpassCache] = None, use_cache: bool = Config.OVERPASS_CACHE_ENABLED):
         self.overpass_url = Config.OVERPASS_URL
+        if cache is None and use_cache:
+            cache = OverpassCache()
+        self.cache = cache if use_cache else None
 
-    def fetch_routes(self, latitude, longitude, radius) -> Dict:
+    @contextmanager
+    def _open_query(self, query, timeout):
         """
-        Fetch walkways around a certain coordinate.
+        Binary stream of the raw response to a query, from the cache when it has it.
         """
-        query = f"""
-                [out:json];
-                (
-                    way(around:{radius},{latitude},{longitude})["highway"~"footway|path|pedestrian|steps|track|residential|sidewalk"];
-                    way(around:{radius},{latitude},{longitude})["foot"~"yes|designated"];
-                    way(around:{radius},{latitude},{longitude})["access"!~"no|private"];
-                );
-                out body geom;
-                """
-        try:
-            response = requests.post(self.overpass_url, data = {'data':query}, timeout= 60 )
+        if self.cache is not None:
+            path = self.cache.lookup(query)
+            if path is None:
+                with requests.post(self.overpass_url, data={"data": query}, timeout=timeout, stream=True) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    path = self.cache.store(query, response.raw)
+            with self.cache.open(path) as stream:
+                yield stream
+            return
+
+        with requests.post(self.overpass_url, data={"data": query}, timeout=timeout, stream=True) as response:
             response.raise_for_status()
-            return response.json()
+            response.raw.decode_content = True
+            yield response.raw
+
+    def _fetch_json(self, query, timeout) -> Dict:
+        try:
+            with self._open_query(query, timeout) as stream:
+                return json.load(stream)
         except Exception as e:
             print(e)
             return {}
+
+    def fetch_routes(self, latitude, longitude, radius) -> Dict:
+        """
+        Fetch walkways around a certain coordinate.
+        """
+        query = walkable_ways_query(f"(around:{radius},{latitude},{longitude})", 60)
+        return self._fetch_json(query, timeout=60)
         
     def fetch_irvine_walkways(self) -> Dict:
         """
         Fetch walkways in all of Irvine
         """
-        query = """
-                [out:json][timeout:180];
-                area["name"="Irvine"]["boundary"="administrative"]["admin_level"="8"]->.irvine;
-                ( 
-                way(area.irvine)["highway"~"footway|path|pedestrian|steps|track|residential|sidewalk"]; 
-                way(area.irvine)["foot"~"yes|designated"]; 
-                way(area.irvine)["access"!~"no|private"]; 
-                ); 
-                out body geom;
-                """
-        try:
-            response = requests.post(self.overpass_url, data={"data": query}, timeout=180)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(e)
-            return {}
+        query = walkable_ways_query(
+            "(area.irvine)", 180,
+            'area["name"="Irvine"]["boundary"="administrative"]["admin_level"="8"]->.irvine;',
+        )
+        return self._fetch_json(query, timeout=180)
+
+    def _oc_county_query(self) -> str:
+        # bbox: south, west, north, east
+        south, west, north, east = OC_BBOX
+        return walkable_ways_query(f"({south},{west},{north},{east})", 900)
+
+    def fetch_tiled(
+        self,
+        bbox: Bbox,
+        tile_deg: float = Config.OVERPASS_TILE_DEG,
+        area: Optional[str] = None,
+        max_workers: int = Config.OVERPASS_MAX_WORKERS,
+        max_retries: int = Config.OVERPASS_MAX_RETRIES,
+        backoff_s: float = Config.OVERPASS_BACKOFF_S,
+        checkpoint_dir: Optional[Path] = None,
+        timeout: int = 180,
+    ) -> Iterator[Dict]:
+        """
+        Fetch walkways in a bbox tile by tile, max_workers tiles at a time.
+        `area` optionally restricts the tiles to an Overpass area selector,
+        e.g. 'area["name"="Irvine"]["admin_level"="8"]'.
+
+        Every finished tile is saved under checkpoint_dir before the next one is
+        counted as done; running the same fetch again only requests the tiles
+        that are missing. Raises OverpassFetchError if a tile still fails after
+        max_retries retries (the finished tiles stay on disk for the next run).
+        Returns the deduplicated elements of all tiles.
+        """
+        tiles = split_bbox(bbox, tile_deg)
+        if checkpoint_dir is None:
+            # one checkpoint set per fetch and UTC day: reruns the same day resume, the next day refetches
+            run_key = hashlib.sha1(repr((self.overpass_url, bbox, tile_deg, area)).encode("utf-8")).hexdigest()[:16]
+            checkpoint_dir = OVERPASS_TILE_DIR / f"{time.strftime('%Y-%m-%d', time.gmtime())}_{run_key}"
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+        tile_paths = [checkpoint_dir / f"tile_{i:05d}.json" for i in range(len(tiles))]
+        missing = [(tile, path) for tile, path in zip(tiles, tile_paths) if not path.exists()]
+        print(f"{len(tiles) - len(missing)} of {len(tiles)} tiles already fetched")
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(self._fetch_tile, tile, path, area, max_retries, backoff_s, timeout): tile
+                for tile, path in missing
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except OverpassFetchError as e:
+                    print(e)
+                    failed.append(futures[future])
+
+        if failed:
+            raise OverpassFetchError(f"{len(failed)} of {len(tiles)} tiles failed, rerun to resume: {failed}")
+        return iter_tile_elements(tile_paths)
+
+    def _fetch_tile(self, tile: Bbox, path: Path, area, max_retries, backoff_s, timeout):
+        south, west, north, east = tile
+        if area:
+            query = walkable_ways_query(f"(area.a)({south},{west},{north},{east})", timeout, f"{area}->.a;")
+        else:
+            query = walkable_ways_query(f"({south},{west},{north},{east})", timeout)
+
+        tmp_path = path.with_name(path.name + ".tmp")
+        if self.cache is not None:
+            try:
+                cached = self.cache.lookup(query)
+            except OverpassCacheMiss as e:
+                raise OverpassFetchError(f"tile {tile}: {e}") from e
+            if cached is not None:
+                self._copy_cached(cached, tmp_path)
+                os.replace(tmp_path, path)
+                return path
+
+        error = None
+        for attempt in range(max_retries + 1):
+            if attempt:
+                # exponential backoff with jitter, or what the server asks for
+                delay = backoff_s * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                time.sleep(max(delay, error.retry_after) if isinstance(error, _RetryLater) else delay)
+            try:
+                with requests.post(self.overpass_url, data={"data": query}, timeout=timeout + 30, stream=True) as response:
+                    if response.status_code in RETRYABLE_STATUS:
+                        raise _RetryLater(response)
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    if self.cache is not None:
+                        try:
+                            cached = self.cache.store(query, response.raw)
+                        except OverpassRuntimeError:
+                            raise _RetryLater(None, f"Overpass runtime error for tile {tile}")
+                        self._copy_cached(cached, tmp_path)
+                    else:
+                        with open(tmp_path, "wb") as f:
+                            shutil.copyfileobj(response.raw, f)
+                if _has_runtime_error(tmp_path):
+                    raise _RetryLater(None, f"Overpass runtime error for tile {tile}")
+                os.replace(tmp_path, path)
+                print(f"Fetched tile {tile}")
+                return path
+            except (requests.RequestException, _RetryLater) as e:
+                error = e
+
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise OverpassFetchError(f"tile {tile} failed after {max_retries + 1} attempts: {error}")
+
+    def _copy_cached(self, cached: Path, path: Path):
+        with self.cache.open(cached) as src, open(path, "wb") as f:
+            shutil.copyfileobj(src, f)
+
+    def read_osm_extract(self, path: Path, **kwargs) -> Iterator[Dict]:
+        """
+        Walkable ways of a local .osm.pbf / .osm extract, for refreshes that cannot depend on Overpass.
+        """
+        return iter_osm_extract(path, **kwargs)
+
+    def fetch_oc_county_tiled(self, **kwargs) -> Iterator[Dict]:
+        """
+        Tiled, resumable version of fetch_oc_county_walkways, see fetch_tiled.
+        """
+        return self.fetch_tiled(OC_BBOX, **kwargs)
 
     def fetch_oc_county_walkways(self) -> Dict:
         """
@@ -57,66 +261,54 @@ class DataIngestion:
         Uses bounding box (faster than area query, avoids Overpass timeout).
         OC bbox approx: south=33.39, west=-118.13, north=33.87, east=-117.51
         """
-        # bbox: south, west, north, east
-        south, west, north, east = 33.39, -118.13, 33.87, -117.51
-        query = f"""
-                [out:json][timeout:900];
-                (
-                way({south},{west},{north},{east})["highway"~"footway|path|pedestrian|steps|track|residential|sidewalk"];
-                way({south},{west},{north},{east})["foot"~"yes|designated"];
-                way({south},{west},{north},{east})["access"!~"no|private"];
-                );
-                out body geom;
-                """
-        try:
-            response = requests.post(self.overpass_url, data={"data": query}, timeout=900)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(e)
-            return {}
-        
-    def filter_for_walkability(self, routes):
-        filtered = []
-
-        walkable_highways = {
-            "footway", "path", "pedestrian", "steps", "corridor",
-            "residential", "living_street", "service", "unclassified",
-            "tertiary", "secondary", "primary",
-            "track", "cycleway",
-        }
-
-        hard_exclude = {"motorway", "motorway_link", "construction"}
-        deny = {"no", "private"}
-
-        for el in routes.get("elements", []):
-            tags = el.get("tags", {})
-            hwy = tags.get("highway")
-            if not hwy:
-                continue
+        return self._fetch_json(self._oc_county_query(), timeout=900)
 
-            if hwy in hard_exclude:
-                continue
+    def stream_query(self, query, timeout=900) -> Iterator[Dict]:
+        """
+        Run an Overpass query and yield its elements as they arrive,
+        without holding the whole response in memory.
+        """
+        with self._open_query(query, timeout) as stream:
+            yield from iter_overpass_elements(stream)
 
-            # Optional: trunk is often sketchy to walk; only allow if explicitly walkable
-            if hwy in {"trunk", "trunk_link"} and tags.get("foot") not in {"yes", "designated"}:
-                continue
+    def stream_oc_county_walkways(self) -> Iterator[Dict]:
+        """
+        Streaming version of fetch_oc_county_walkways, see stream.ingest_elements.
+        """
+        return self.stream_query(self._oc_county_query(), timeout=900)
 
-            if hwy not in walkable_highways:
-                continue
+    def is_walkable(self, el) -> bool:
+        tags = el.get("tags", {})
+        hwy = tags.get("highway")
+        if not hwy:
+            return False
 
-            if tags.get("access") in deny:
-                continue
-            if tags.get("foot") in deny:
-                continue
+        if hwy in HARD_EXCLUDE:
+            return False
 
-            # Optional: drop “proposed”/“abandoned” style states if present
-            if tags.get("highway") == "proposed":
-                continue
+        # Optional: trunk is often sketchy to walk; only allow if explicitly walkable
+        if hwy in {"trunk", "trunk_link"} and tags.get("foot") not in {"yes", "designated"}:
+            return False
+
+        if hwy not in WALKABLE_HIGHWAYS:
+            return False
+
+        if tags.get("access") in DENY:
+            return False
+        if tags.get("foot") in DENY:
+            return False
 
-            filtered.append(el)
+        # Optional: drop “proposed”/“abandoned” style states if present
+        if tags.get("highway") == "proposed":
+            return False
 
-        return {"elements": filtered}
+        return True
+
+    def iter_walkable(self, elements: Iterable[Dict]) -> Iterator[Dict]:
+        return (project_tags(el) for el in elements if self.is_walkable(el))
+
+    def filter_for_walkability(self, routes):
+        return {"elements": list(self.iter_walkable(routes.get("elements", [])))}
 
 def overpass_to_geojson(elements):
     features = []
@@ -129,14 +321,26 @@ def overpass_to_geojson(elements):
         if not geometry or len(geometry) < 2:
             continue
 
-        coords = [[pt["lon"], pt["lat"]] for pt in geometry]
+        # points without geometry (cut off by a clipped extract) split the line
+        lines = [[]]
+        for pt in geometry:
+            if pt is None:
+                lines.append([])
+            else:
+                lines[-1].append([pt["lon"], pt["lat"]])
+        lines = [coords for coords in lines if len(coords) >= 2]
+        if not lines:
+            continue
 
         features.append({
             "type": "Feature",
             "properties": el.get("tags", {}),
             "geometry": {
                 "type": "LineString",
-                "coordinates": coords
+                "coordinates": lines[0]
+            } if len(lines) == 1 else {
+                "type": "MultiLineString",
+                "coordinates": lines
             }
         })
 
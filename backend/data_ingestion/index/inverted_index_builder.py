@@ -1,6 +1,8 @@
 import sqlite3
+from collections import defaultdict
 from pathlib import Path
 from ..graph.edge import Edge
+from ..batching import executemany_in_batches
 
 DATA_INGESTION_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = DATA_INGESTION_DIR / "index"
@@ -66,12 +68,13 @@ def extract_features(tags):
     return features
 
 # create sqlite table for inverted index
-def make_connection():
-    conn = sqlite3.connect(DB_PATH)
+def make_connection(db_path: Path = DB_PATH):
+    conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
     return conn
 
-def create_edge_features_table(conn):
+# bulk loads pass with_indexes=False and call create_edge_features_indexes once the rows are in
+def create_edge_features_table(conn, with_indexes: bool = True):
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -83,6 +86,14 @@ def create_edge_features_table(conn):
         );
     """)
 
+    if with_indexes:
+        create_edge_features_indexes(conn, commit=False)
+
+    conn.commit()
+
+def create_edge_features_indexes(conn, commit: bool = True):
+    cursor = conn.cursor()
+
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_edge_features_feature
         ON edge_features(feature);
@@ -93,15 +104,20 @@ def create_edge_features_table(conn):
         ON edge_features(edge_id);
     """)
 
-    conn.commit()
+    if commit:
+        conn.commit()
 
 def populate_edge_features(conn, edges):
     cursor = conn.cursor()
 
     rows = []
+    tag_set_features = {}
 
     for edge in edges.values():
-        features = extract_features(edge.tags)
+        # edges of a way share one tags dict, extract its features once
+        features = tag_set_features.get(id(edge.tags))
+        if features is None:
+            features = tag_set_features[id(edge.tags)] = extract_features(edge.tags)
         for feature in features:
             rows.append((feature, edge.edge_id))
 
@@ -110,4 +126,43 @@ def populate_edge_features(conn, edges):
         VALUES (?, ?);
     """, rows)
 
-    conn.commit()
\ No newline at end of file
+    conn.commit()
+
+# same as populate_edge_features for feature -> edge ids, e.g. GraphArrays.feature_edge_ids()
+def insert_feature_edge_ids(conn, feature_edge_ids, batch_size=None, commit: bool = True):
+    cursor = conn.cursor()
+
+    executemany_in_batches(cursor, """
+        INSERT OR IGNORE INTO edge_features (feature, edge_id)
+        VALUES (?, ?);
+    """, ((feature, int(edge_id)) for feature, edge_ids in feature_edge_ids.items() for edge_id in edge_ids),
+        batch_size)
+
+    if commit:
+        conn.commit()
+
+# loads the inverted index as feature -> edge ids, optionally only for the given edges
+def load_feature_edge_ids(conn, edge_ids=None) -> dict[str, set[int]]:
+    cursor = conn.cursor()
+
+    try:
+        if edge_ids is None:
+            cursor.execute("SELECT feature, edge_id FROM edge_features;")
+        else:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_edges (edge_id INTEGER PRIMARY KEY);")
+            cursor.execute("DELETE FROM wanted_edges;")
+            cursor.executemany("INSERT OR IGNORE INTO wanted_edges (edge_id) VALUES (?);",
+                               ((int(edge_id),) for edge_id in edge_ids))
+            cursor.execute("""
+                SELECT f.feature, f.edge_id
+                FROM wanted_edges w JOIN edge_features f ON f.edge_id = w.edge_id;
+            """)
+    except sqlite3.OperationalError:
+        # index has not been built yet
+        return {}
+
+    feature_edge_ids = defaultdict(set)
+    for feature, edge_id in cursor.fetchall():
+        feature_edge_ids[feature].add(edge_id)
+
+    return dict(feature_edge_ids)
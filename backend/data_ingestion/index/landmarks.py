@@ -0,0 +1,157 @@
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+LANDMARKS_PATH = DATA_DIR / "landmarks.pkl"
+
+'''
+Landmark distance tables for A* over the walk graph (ALT).
+
+For a few landmark nodes spread over the graph the table holds the shortest
+walk from every landmark to every node and from every node to every landmark.
+By the triangle inequality, for any landmark l
+
+    d(v, t) >= d(l, t) - d(l, v)    and    d(v, t) >= d(v, l) - d(t, l)
+
+so the largest of these is a lower bound on the distance left from v to the
+target t, much tighter than the straight line wherever streets wind.
+
+Landmarks are picked farthest-first: each new one is the node whose nearest
+landmark so far is the farthest away, which puts them on the edges of the graph
+where their bounds are best. Tables are computed over the contracted walk graph
+(only junctions are ever looked up) and persisted per DB version
+(CompactGraph.index_version) like the spatial index; build them offline after
+ingesting with
+
+    python -m backend.data_ingestion.index.landmarks
+'''
+
+NUM_LANDMARKS = 8
+
+def distance_matrix(walk_graph, reverse: bool = False) -> csr_matrix:
+    """walk_graph's edge lengths as a sparse matrix (turned around with reverse), the shortest of parallel edges kept."""
+    n = len(walk_graph.offsets) - 1
+    src = np.asarray(walk_graph.edge_src, dtype=np.int64)
+    dst = np.asarray(walk_graph.edge_dst, dtype=np.int64)
+    if reverse:
+        src, dst = dst, src
+    # csgraph sums duplicate entries and skips zeros
+    distance_m = np.maximum(np.asarray(walk_graph.distance_m, dtype=np.float64), 1e-3)
+    order = np.lexsort((distance_m, dst, src))
+    _, first = np.unique(np.column_stack((src[order], dst[order])), axis=0, return_index=True)
+    keep = order[first]
+    return csr_matrix((distance_m[keep], (src[keep], dst[keep])), shape=(n, n))
+
+
+class LandmarkTable:
+    def __init__(self, landmarks: np.ndarray, from_m: np.ndarray, to_m: np.ndarray, version: Tuple = ()):
+        self.landmarks = landmarks
+        # from_m[i, v]: landmark i to node v, to_m[i, v]: node v to landmark i (inf if unreachable)
+        self.from_m = from_m
+        self.to_m = to_m
+        self.num_points = from_m.shape[1]
+        self.version = version
+
+    @classmethod
+    def build(cls, graph, num_landmarks: int = NUM_LANDMARKS) -> "LandmarkTable":
+        """Landmarks over graph.contracted, in the longest connected component."""
+        walk_graph = graph.contracted
+        forward = distance_matrix(walk_graph)
+        backward = distance_matrix(walk_graph, reverse=True)
+        n = forward.shape[0]
+
+        def reach_m(node: int) -> Tuple[np.ndarray, np.ndarray]:
+            return (
+                dijkstra(forward, indices=node).astype(np.float32),
+                dijkstra(backward, indices=node).astype(np.float32),
+            )
+
+        landmarks, from_rows, to_rows = [], [], []
+        junctions = np.flatnonzero(np.diff(walk_graph.offsets) > 0)
+        if len(junctions) and num_landmarks > 0:
+            longest = np.argmax(graph.component_length_m)
+            in_longest = junctions[graph.component_ids[junctions] == longest]
+            seed = int(in_longest[0]) if len(in_longest) else int(junctions[0])
+            # the seed only starts the search; the first landmark is the node farthest from it
+            nearest_m = np.minimum(*reach_m(seed)).astype(np.float64)
+            while len(landmarks) < num_landmarks:
+                scores = np.where(np.isfinite(nearest_m), nearest_m, -1.0)
+                scores[landmarks] = -1.0
+                candidate = int(np.argmax(scores))
+                if scores[candidate] <= 0 and landmarks:
+                    break
+                from_m, to_m = reach_m(candidate)
+                landmarks.append(candidate)
+                from_rows.append(from_m)
+                to_rows.append(to_m)
+                reached_m = np.minimum(from_m, to_m)
+                nearest_m = reached_m if len(landmarks) == 1 else np.minimum(nearest_m, reached_m)
+
+        if not landmarks:
+            empty = np.zeros((0, n), dtype=np.float32)
+            return cls(np.zeros(0, dtype=np.int64), empty, empty, graph.index_version)
+        return cls(
+            np.asarray(landmarks, dtype=np.int64), np.vstack(from_rows), np.vstack(to_rows), graph.index_version
+        )
+
+    def active(self, source: int, target: int, count: int) -> np.ndarray:
+        """The count landmarks giving the best bound from source to target."""
+        bounds = self.bounds(source, target)
+        return np.argsort(-bounds, kind="stable")[:count]
+
+    def bounds(self, node: int, target: int) -> np.ndarray:
+        """Per landmark, the lower bound on the distance from node to target (0 where unknown)."""
+        with np.errstate(invalid="ignore"):
+            forward = self.from_m[:, target] - self.from_m[:, node]
+            backward = self.to_m[:, node] - self.to_m[:, target]
+        bounds = np.fmax(forward, backward)
+        return np.where(np.isfinite(bounds), np.maximum(bounds, 0.0), 0.0)
+
+
+def save_landmarks(table: LandmarkTable, path: Path = LANDMARKS_PATH):
+    path = Path(path)
+    # a temporary file of its own, so concurrent saves do not replace each other's
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# returns None if there is no persisted table for this DB version
+def load_landmarks(version: Tuple, num_points: int, path: Path = LANDMARKS_PATH) -> Optional[LandmarkTable]:
+    try:
+        with open(path, "rb") as f:
+            table = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+    if not isinstance(table, LandmarkTable):
+        return None
+    if table.version != version or table.num_points != num_points:
+        return None
+    return table
+
+
+if __name__ == "__main__":
+    import time
+
+    from ..graph.graph_store import get_graph
+
+    graph = get_graph()
+    started = time.perf_counter()
+    table = LandmarkTable.build(graph)
+    save_landmarks(table)
+    print(f"Saved {len(table.landmarks)} landmarks over {graph.num_nodes} nodes to {LANDMARKS_PATH} "
+          f"in {time.perf_counter() - started:.1f} s")
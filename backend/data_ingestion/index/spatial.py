@@ -1,7 +1,68 @@
-from sklearn.neighbors import KDTree
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
 
-# this creates a KDTree to be used as a spatial index
-# input: a list of points in the form (lat, lon)  
-class KDTree:
-    def __init__(self, node_points):
-        self.tree = KDTree(node_points)
\ No newline at end of file
+import numpy as np
+from sklearn.neighbors import BallTree
+
+EARTH_RADIUS_M = 6371000
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+SPATIAL_INDEX_PATH = DATA_DIR / "spatial_index.pkl"
+
+# haversine ball tree over node coordinates, used as a spatial index
+# input: node latitudes and longitudes in degrees, in node index order
+class SpatialIndex:
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, version: Tuple = ()):
+        points = np.radians(np.column_stack((lat, lon)))
+        self.tree = BallTree(points, metric="haversine")
+        self.num_points = len(points)
+        self.version = version
+
+    # node indices within radius_m of the point, in ascending order
+    def query_radius(self, lat: float, lon: float, radius_m: float) -> np.ndarray:
+        if self.num_points == 0:
+            return np.zeros(0, dtype=np.int64)
+        point = np.radians([[lat, lon]])
+        indices = self.tree.query_radius(point, r=radius_m / EARTH_RADIUS_M)[0]
+        return np.sort(indices)
+
+    # the k nearest node indices and their distances in meters, nearest first
+    def query_knn(self, lat: float, lon: float, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, self.num_points)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        point = np.radians([[lat, lon]])
+        distances, indices = self.tree.query(point, k=k)
+        return indices[0], distances[0] * EARTH_RADIUS_M
+
+
+def save_spatial_index(index: SpatialIndex, path: Path = SPATIAL_INDEX_PATH):
+    path = Path(path)
+    # a temporary file of its own, so concurrent saves do not replace each other's
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# returns None if there is no persisted index for this DB version (CompactGraph.index_version)
+def load_spatial_index(version: Tuple, num_points: int, path: Path = SPATIAL_INDEX_PATH) -> Optional[SpatialIndex]:
+    try:
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+    if not isinstance(index, SpatialIndex):
+        return None
+    if index.version != version or index.num_points != num_points:
+        return None
+    return index
@@ -0,0 +1,499 @@
+import datetime
+import os
+import struct
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .overpass_query import project_tags
+
+'''
+Ingestion from a local OSM extract (.osm.pbf or .osm XML) instead of Overpass.
+
+iter_osm_extract yields walkable ways in the same shape as Overpass "out meta
+geom" elements (id, version, timestamp, nodes, geometry, tags), so the result
+goes straight into stream.ingest_elements or refresh.refresh_ways.
+
+Extracts list their nodes before their ways. The first pass writes every node
+into a NodeStore: two flat files of ids and int32 coordinates (OSM precision,
+1e-7 degrees) that are memory-mapped and searched with np.searchsorted, so a
+state extract costs disk instead of RAM. The second pass resolves the node
+coordinates of the walkable ways.
+
+PBF blocks are independent, so both passes decode them in a process pool;
+workers read their block from the file themselves and results come back in
+file order. The protobuf decoding is done here (packed fields are decoded with
+numpy) so no OSM library is needed; only raw and zlib blobs are supported,
+which is what osmium, osmosis and Geofabrik produce. XML is parsed sequentially.
+'''
+
+PBF_SUFFIX = ".pbf"
+COORD_SCALE = 10_000_000
+XML_BATCH_SIZE = 50_000
+_SUPPORTED_FEATURES = {"OsmSchema-V0.6", "DenseNodes"}
+# blocks decoded ahead of the consumer, per worker
+_WINDOW_PER_WORKER = 4
+
+
+# --- protobuf wire format ---
+
+def _varint(buf, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def _int64(v: int) -> int:
+    return v - (1 << 64) if v >= 1 << 63 else v
+
+def _zigzag(v: int) -> int:
+    return (v >> 1) ^ -(v & 1)
+
+def _fields(buf):
+    """(field number, value) of a message; length-delimited values are memoryviews."""
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire}")
+        yield field, value
+
+def _packed_varints(buf) -> np.ndarray:
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # 7 payload bits per byte, shifted by the byte's position inside its varint
+    shifts = (np.arange(ends[-1] + 1) - np.repeat(starts, ends - starts + 1)) * 7
+    payload = (data[:ends[-1] + 1] & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(payload, starts)
+
+def _packed_sint64(buf) -> np.ndarray:
+    v = _packed_varints(buf)
+    return (v >> np.uint64(1)).astype(np.int64) ^ -(v & np.uint64(1)).astype(np.int64)
+
+
+# --- node store ---
+
+class NodeStore:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+        self._files = None
+        self._last_id = None
+        self._sorted = True
+
+    @property
+    def _ids_path(self) -> Path:
+        return self.directory / "node_ids.i8"
+
+    @property
+    def _coords_path(self) -> Path:
+        return self.directory / "node_coords.i4"
+
+    def append(self, ids: np.ndarray, lat_e7: np.ndarray, lon_e7: np.ndarray):
+        if not len(ids):
+            return
+        if self._files is None:
+            self._files = (open(self._ids_path, "wb"), open(self._coords_path, "wb"))
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._sorted and ((self._last_id is not None and ids[0] <= self._last_id) or np.any(ids[1:] <= ids[:-1])):
+            self._sorted = False
+        self._last_id = ids[-1]
+        ids.tofile(self._files[0])
+        np.column_stack((lat_e7, lon_e7)).astype(np.int32).tofile(self._files[1])
+        self.count += len(ids)
+
+    def finish(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+        if not self._sorted:
+            # extracts are normally sorted by id; otherwise sort once in memory, last duplicate wins
+            ids = np.fromfile(self._ids_path, dtype=np.int64)
+            coords = np.fromfile(self._coords_path, dtype=np.int32).reshape(-1, 2)
+            order = np.argsort(ids, kind="stable")[::-1]
+            ids, first = np.unique(ids[order], return_index=True)
+            ids.tofile(self._ids_path)
+            coords[order[first]].tofile(self._coords_path)
+            self.count = len(ids)
+            self._sorted = True
+
+    @staticmethod
+    def open(directory: Path) -> "_NodeLookup":
+        return _NodeLookup(Path(directory))
+
+
+class _NodeLookup:
+    def __init__(self, directory: Path):
+        ids_path = directory / "node_ids.i8"
+        if ids_path.exists() and ids_path.stat().st_size:
+            self.ids = np.memmap(ids_path, dtype=np.int64, mode="r")
+            self.coords = np.memmap(directory / "node_coords.i4", dtype=np.int32, mode="r").reshape(-1, 2)
+        else:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.coords = np.zeros((0, 2), dtype=np.int32)
+
+    def lookup(self, refs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(found mask, coordinates in 1e-7 degrees) of the node ids in refs."""
+        if not len(self.ids):
+            return np.zeros(len(refs), dtype=bool), np.zeros((len(refs), 2), dtype=np.int32)
+        idx = np.minimum(np.searchsorted(self.ids, refs), len(self.ids) - 1)
+        return self.ids[idx] == refs, self.coords[idx]
+
+
+# --- ways to elements ---
+
+_walkability = None
+
+def _is_walkable(tags: Dict) -> bool:
+    global _walkability
+    if _walkability is None:
+        from .importer import DataIngestion
+        _walkability = DataIngestion(use_cache=False)
+    return _walkability.is_walkable({"tags": tags})
+
+def _way_elements(ways: List[tuple], nodes: _NodeLookup) -> Tuple[List[Dict], int]:
+    """Overpass style elements of (id, version, timestamp, refs, tags); also returns how many were dropped."""
+    if not ways:
+        return [], 0
+    refs = np.concatenate([np.asarray(way[3], dtype=np.int64) for way in ways])
+    found, coords = nodes.lookup(refs)
+    lat = (coords[:, 0] / COORD_SCALE).tolist()
+    lon = (coords[:, 1] / COORD_SCALE).tolist()
+    found = found.tolist()
+    refs = refs.tolist()
+
+    elements = []
+    dropped = 0
+    start = 0
+    for way_id, version, timestamp, way_refs, tags in ways:
+        end = start + len(way_refs)
+        points = range(start, end)
+        start = end
+        # nodes outside a clipped extract have no geometry (None); the graph builder
+        # only joins consecutive nodes that both have it, so a way needs two of those
+        if not any(found[i] and found[i + 1] for i in points[:-1]):
+            dropped += 1
+            continue
+        el = {"type": "way", "id": way_id}
+        if version is not None:
+            el["version"] = version
+            el["timestamp"] = timestamp
+        el["nodes"] = [refs[i] for i in points]
+        el["geometry"] = [{"lat": lat[i], "lon": lon[i]} if found[i] else None for i in points]
+        el["tags"] = tags
+        elements.append(project_tags(el))
+    return elements, dropped
+
+
+# --- PBF ---
+
+def _iter_blobs(path: Path) -> Iterator[Tuple[str, int, int]]:
+    """(type, offset, size) of each blob in the file."""
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(4)
+            if not head:
+                return
+            if len(head) < 4:
+                raise ValueError(f"truncated PBF file {path}")
+            (header_len,) = struct.unpack(">I", head)
+            blob_type, size = None, 0
+            for field, value in _fields(memoryview(f.read(header_len))):
+                if field == 1:
+                    blob_type = bytes(value).decode("utf-8")
+                elif field == 3:
+                    size = value
+            offset = f.tell()
+            f.seek(size, os.SEEK_CUR)
+            yield blob_type, offset, size
+
+def _read_blob(path: Path, offset: int, size: int) -> memoryview:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        blob = memoryview(f.read(size))
+    for field, value in _fields(blob):
+        if field == 1:
+            return value
+        if field == 3:
+            return memoryview(zlib.decompress(value))
+        if field in (4, 5, 6, 7):
+            raise ValueError("only raw and zlib compressed PBF blobs are supported")
+    raise ValueError("empty PBF blob")
+
+def _check_header(data: memoryview):
+    required = {bytes(value).decode("utf-8") for field, value in _fields(data) if field == 4}
+    unsupported = required - _SUPPORTED_FEATURES
+    if unsupported:
+        raise ValueError(f"unsupported PBF features: {sorted(unsupported)}")
+
+
+class _Block:
+    def __init__(self, data: memoryview):
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        self._string_table = None
+        for field, value in _fields(data):
+            if field == 1:
+                self._string_table = value
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = _int64(value)
+            elif field == 20:
+                self.lon_offset = _int64(value)
+        self._strings = None
+
+    @property
+    def strings(self) -> List[str]:
+        if self._strings is None:
+            self._strings = [
+                bytes(value).decode("utf-8")
+                for field, value in _fields(self._string_table or memoryview(b"")) if field == 1
+            ]
+        return self._strings
+
+    def to_e7(self, raw: np.ndarray, offset: int) -> np.ndarray:
+        # nanodegrees to the 1e-7 degrees OSM stores
+        return (offset + self.granularity * raw + 50) // 100
+
+    def timestamp(self, raw: int) -> str:
+        ts = datetime.datetime.fromtimestamp(raw * self.date_granularity / 1000, tz=datetime.timezone.utc)
+        return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _decode_nodes(path: Path, offset: int, size: int):
+    """First pass worker: node ids and coordinates of a block, and whether it holds ways."""
+    block = _Block(_read_blob(path, offset, size))
+    ids, lat, lon = [], [], []
+    has_ways = False
+    for group in block.groups:
+        for field, value in _fields(group):
+            if field == 2:
+                dense = {f: v for f, v in _fields(value) if f in (1, 8, 9)}
+                ids.append(np.cumsum(_packed_sint64(dense.get(1, b""))))
+                lat.append(np.cumsum(_packed_sint64(dense.get(8, b""))))
+                lon.append(np.cumsum(_packed_sint64(dense.get(9, b""))))
+            elif field == 1:
+                node = {f: v for f, v in _fields(value)}
+                ids.append(np.array([_zigzag(node.get(1, 0))], dtype=np.int64))
+                lat.append(np.array([_zigzag(node.get(8, 0))], dtype=np.int64))
+                lon.append(np.array([_zigzag(node.get(9, 0))], dtype=np.int64))
+            elif field == 3:
+                has_ways = True
+    if not ids:
+        return None, has_ways
+    return (
+        np.concatenate(ids),
+        block.to_e7(np.concatenate(lat), block.lat_offset),
+        block.to_e7(np.concatenate(lon), block.lon_offset),
+    ), has_ways
+
+_node_lookups: Dict[Path, _NodeLookup] = {}
+
+def _decode_ways(path: Path, offset: int, size: int, store_dir: Path):
+    """Second pass worker: walkable ways of a block as elements."""
+    block = _Block(_read_blob(path, offset, size))
+    ways = []
+    for group in block.groups:
+        for field, value in _fields(group):
+            if field != 3:
+                continue
+            way_id, keys, vals, info, refs = 0, b"", b"", None, b""
+            for f, v in _fields(value):
+                if f == 1:
+                    way_id = _int64(v)
+                elif f == 2:
+                    keys = v
+                elif f == 3:
+                    vals = v
+                elif f == 4:
+                    info = v
+                elif f == 8:
+                    refs = v
+            strings = block.strings
+            tags = {strings[k]: strings[v] for k, v in zip(_packed_varints(keys).tolist(), _packed_varints(vals).tolist())}
+            if not _is_walkable(tags):
+                continue
+            version = timestamp = None
+            if info is not None:
+                meta = {f: v for f, v in _fields(info) if f in (1, 2)}
+                version = meta.get(1, -1)
+                timestamp = block.timestamp(_int64(meta.get(2, 0)))
+            ways.append((way_id, version, timestamp, np.cumsum(_packed_sint64(refs)), tags))
+
+    if store_dir not in _node_lookups:
+        _node_lookups[store_dir] = NodeStore.open(store_dir)
+    return _way_elements(ways, _node_lookups[store_dir])
+
+
+class _InlineExecutor:
+    """Runs tasks in the calling process, for max_workers=1."""
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def _ordered_map(executor, fn, tasks, window: int):
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _iter_pbf(path: Path, store: NodeStore, max_workers: int) -> Iterator[Dict]:
+    data_blobs = []
+    for blob_type, offset, size in _iter_blobs(path):
+        if blob_type == "OSMHeader":
+            _check_header(_read_blob(path, offset, size))
+        elif blob_type == "OSMData":
+            data_blobs.append((offset, size))
+
+    window = max_workers * _WINDOW_PER_WORKER
+    executor = _InlineExecutor() if max_workers == 1 else ProcessPoolExecutor(max_workers)
+    with executor:
+        way_blobs = []
+        node_results = _ordered_map(executor, _decode_nodes, [(path, o, s) for o, s in data_blobs], window)
+        for (offset, size), (nodes, has_ways) in zip(data_blobs, node_results):
+            if nodes is not None:
+                store.append(*nodes)
+            if has_ways:
+                way_blobs.append((offset, size))
+        store.finish()
+
+        dropped = 0
+        tasks = [(path, o, s, store.directory) for o, s in way_blobs]
+        for elements, block_dropped in _ordered_map(executor, _decode_ways, tasks, window):
+            dropped += block_dropped
+            yield from elements
+    _node_lookups.pop(store.directory, None)
+    if dropped:
+        print(f"Skipped {dropped} ways without 2 consecutive nodes in the extract")
+
+
+# --- XML ---
+
+def _iter_xml(path: Path, store: NodeStore) -> Iterator[Dict]:
+    ids, lat, lon = [], [], []
+    ways = []
+    nodes = None
+    dropped = 0
+    root = None
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+
+        if elem.tag == "node":
+            if nodes is not None:
+                raise ValueError(f"{path} lists nodes after ways; sort it first (osmium sort)")
+            ids.append(int(elem.get("id")))
+            lat.append(round(float(elem.get("lat")) * COORD_SCALE))
+            lon.append(round(float(elem.get("lon")) * COORD_SCALE))
+            if len(ids) >= XML_BATCH_SIZE:
+                store.append(np.array(ids), np.array(lat), np.array(lon))
+                ids, lat, lon = [], [], []
+        elif elem.tag == "way":
+            if nodes is None:
+                store.append(np.array(ids, dtype=np.int64), np.array(lat), np.array(lon))
+                ids, lat, lon = [], [], []
+                store.finish()
+                nodes = NodeStore.open(store.directory)
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            if _is_walkable(tags):
+                version = elem.get("version")
+                ways.append((
+                    int(elem.get("id")),
+                    int(version) if version is not None else None,
+                    elem.get("timestamp", ""),
+                    [int(nd.get("ref")) for nd in elem.iter("nd")],
+                    tags,
+                ))
+            if len(ways) >= XML_BATCH_SIZE:
+                elements, batch_dropped = _way_elements(ways, nodes)
+                dropped += batch_dropped
+                yield from elements
+                ways = []
+        elif elem.tag != "relation":
+            continue
+        # children of the root are done with, keep the tree from growing
+        root.clear()
+
+    if nodes is not None:
+        elements, batch_dropped = _way_elements(ways, nodes)
+        dropped += batch_dropped
+        yield from elements
+    if dropped:
+        print(f"Skipped {dropped} ways without 2 consecutive nodes in the extract")
+
+
+def iter_osm_extract(
+    path: Path,
+    node_store_dir: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+) -> Iterator[Dict]:
+    """
+    Walkable ways of a .osm.pbf or .osm extract as Overpass style elements.
+    The node store goes into a temporary directory under node_store_dir (the system temp dir by default).
+    """
+    path = Path(path)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix="osm_nodes_", dir=node_store_dir) as tmp:
+        store = NodeStore(Path(tmp))
+        if path.suffix == PBF_SUFFIX:
+            yield from _iter_pbf(path, store, max_workers)
+        else:
+            yield from _iter_xml(path, store)
+
+
+if __name__ == "__main__":
+    from .stream import ingest_elements
+
+    print(ingest_elements(iter_osm_extract(Path(sys.argv[1]))))
@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from config import Config
+
+'''
+On-disk cache of raw Overpass responses.
+
+Responses are stored gzip-compressed under the sha256 of the query with its
+whitespace collapsed, so the same query reformatted or re-indented hits the same
+entry. Entries older than ttl_s are misses, and after each store the least
+recently used entries are evicted until the cache fits in max_bytes. With
+offline=True a miss raises OverpassCacheMiss instead of going to the network,
+which lets graph builds be rerun from disk only.
+
+Responses that end in an Overpass runtime error (timeouts, out of memory) are
+never stored.
+'''
+
+OVERPASS_CACHE_DIR = Path(__file__).resolve().parent / "data" / "overpass_cache"
+
+_COPY_CHUNK = 1 << 20
+
+
+class OverpassCacheMiss(Exception):
+    pass
+
+class OverpassRuntimeError(Exception):
+    pass
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip()
+
+def query_key(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+class OverpassCache:
+    def __init__(
+        self,
+        cache_dir: Path = OVERPASS_CACHE_DIR,
+        ttl_s: Optional[float] = Config.OVERPASS_CACHE_TTL_S,
+        max_bytes: Optional[int] = Config.OVERPASS_CACHE_MAX_BYTES,
+        offline: bool = Config.OVERPASS_OFFLINE,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+
+    def path_for(self, query: str) -> Path:
+        return self.cache_dir / f"{query_key(query)}.json.gz"
+
+    def lookup(self, query: str) -> Optional[Path]:
+        """Path of a fresh cached response, or None (OverpassCacheMiss when offline)."""
+        path = self.path_for(query)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+
+        # stale entries still serve offline runs, there is nothing better to use
+        fresh = stat is not None and (self.ttl_s is None or time.time() - stat.st_mtime <= self.ttl_s)
+        if fresh or (stat is not None and self.offline):
+            # atime marks the last use for eviction, mtime keeps the fetch time for the TTL
+            os.utime(path, (time.time(), stat.st_mtime))
+            return path
+        if self.offline:
+            raise OverpassCacheMiss(f"no cached Overpass response for query {query_key(query)[:12]}")
+        return None
+
+    def store(self, query: str, stream: BinaryIO) -> Path:
+        """Compresses a raw response stream into the cache and returns its path."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path_for(query)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+
+        tail = b""
+        try:
+            with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                while True:
+                    chunk = stream.read(_COPY_CHUNK)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    tail = (tail + chunk)[-4096:]
+            # Overpass answers 200 and appends a runtime error remark when a query fails
+            if b"runtime error" in tail:
+                raise OverpassRuntimeError(f"Overpass runtime error: {tail[-300:].decode('utf-8', 'replace')}")
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+        self.evict(keep=path)
+        return path
+
+    def open(self, path: Path) -> BinaryIO:
+        return gzip.open(path, "rb")
+
+    def size_bytes(self) -> int:
+        return sum(p.stat().st_size for p in self.cache_dir.glob("*.json.gz"))
+
+    def evict(self, keep: Optional[Path] = None):
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            entries = []
+            for p in self.cache_dir.glob("*.json.gz"):
+                try:
+                    stat = p.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, p))
+            total = sum(size for _, size, _ in entries)
+            # least recently used first
+            for _, size, p in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                if p == keep:
+                    continue
+                p.unlink(missing_ok=True)
+                total -= size
+
+    def clear(self):
+        for p in self.cache_dir.glob("*.json.gz"):
+            p.unlink(missing_ok=True)
@@ -0,0 +1,54 @@
+from typing import Dict, Iterable
+
+'''
+Overpass QL for walkable ways.
+
+The queries are generated from the same rules DataIngestion.is_walkable applies,
+so the server only returns ways that survive the filter instead of every way in
+the area (the old union with ["access"!~"no|private"] matched nearly all of
+them). The filter still runs client side as a safety net.
+
+Overpass cannot drop tags from an element while keeping its geometry, so the
+tag projection happens on the client: project_tags keeps only the keys the
+feature extractors, route scoring and walkability rules read.
+'''
+
+WALKABLE_HIGHWAYS = {
+    "footway", "path", "pedestrian", "steps", "corridor",
+    "residential", "living_street", "service", "unclassified",
+    "tertiary", "secondary", "primary",
+    "track", "cycleway",
+}
+
+HARD_EXCLUDE = {"motorway", "motorway_link", "construction"}
+DENY = {"no", "private"}
+
+# read by index.inverted_index_builder.extract_features, routes.feature_extraction,
+# route naming and is_walkable
+FEATURE_TAG_KEYS = frozenset({
+    "highway", "access", "foot",
+    "lit", "surface", "smoothness", "sac_scale", "trail_visibility", "incline",
+    "wheelchair", "footway", "sidewalk", "dog", "leisure", "name",
+})
+
+def _any_of(values: Iterable[str]) -> str:
+    # anchored, otherwise "primary" also matches "primary_link"
+    return "^(" + "|".join(sorted(values)) + ")$"
+
+def walkable_ways_query(scope: str, timeout: int, prelude: str = "") -> str:
+    """
+    Overpass QL for the walkable ways in `scope`, e.g. "(s,w,n,e)", "(area.a)" or "(around:r,lat,lon)".
+    """
+    deny = _any_of(DENY)
+    return (
+        f"[out:json][timeout:{timeout}];\n"
+        f"{prelude}\n"
+        f'way{scope}["highway"~"{_any_of(WALKABLE_HIGHWAYS)}"]["access"!~"{deny}"]["foot"!~"{deny}"];\n'
+        "out meta geom;\n"
+    )
+
+def project_tags(el: Dict) -> Dict:
+    tags = el.get("tags")
+    if not tags or tags.keys() <= FEATURE_TAG_KEYS:
+        return el
+    return {**el, "tags": {k: v for k, v in tags.items() if k in FEATURE_TAG_KEYS}}
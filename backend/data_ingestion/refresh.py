@@ -0,0 +1,154 @@
+from pathlib import Path
+from typing import Iterable, List, Optional, Set
+
+from config import Config
+from .graph.graph_builder import build_graph_arrays, way_checksum
+from .graph.persist_data import (
+    DB_PATH,
+    make_connection,
+    make_tables,
+    load_tag_dictionary,
+    write_graph_arrays,
+    _temp_id_table,
+)
+from .index.inverted_index_builder import (
+    DB_PATH as INDEX_DB_PATH,
+    make_connection as index_connection,
+    create_edge_features_table,
+    insert_feature_edge_ids,
+)
+from .stream import INGEST_BATCH_SIZE
+
+'''
+Incremental re-ingestion.
+
+Every stored way keeps its OSM version and a checksum of its node ids,
+coordinates and tags (graph_builder.way_checksum), and edge ids are derived from
+(way_id, segment index). refresh_ways compares a fresh stream of Overpass
+elements against the stored ways and only rewrites the ones that were added or
+changed, removes the ones that disappeared, and drops nodes no edge uses any
+more, together with their edge_features rows. Unchanged ways are not written
+at all, so a refresh costs about as much as the diff.
+
+The checksum catches member nodes that moved, which does not bump the version
+of the way itself. Tag sets and strings that are no longer used stay in the tag
+dictionary; a full rebuild (stream.ingest_elements) compacts them.
+'''
+
+class _Refresh:
+    def __init__(self, conn, index_conn, batch_size: int):
+        self.conn = conn
+        self.index_conn = index_conn
+        self.batch_size = batch_size
+        self.dictionary = load_tag_dictionary(conn)
+        # endpoints of removed edges, deleted at the end if nothing uses them any more
+        self.orphan_candidates: Set[int] = set()
+
+    def remove_ways(self, way_ids: List[int], drop_ways: bool):
+        if not way_ids:
+            return
+        cur = self.conn.cursor()
+        _temp_id_table(cur, "refresh_ways", way_ids)
+
+        old_edges = cur.execute("""
+                                SELECT e.edge_id, e.start_node, e.end_node
+                                FROM refresh_ways r JOIN edges e ON e.way_id = r.id;
+                                """).fetchall()
+        old_edge_ids = [(edge_id,) for edge_id, _, _ in old_edges]
+        for _, start_node, end_node in old_edges:
+            self.orphan_candidates.add(start_node)
+            self.orphan_candidates.add(end_node)
+
+        cur.executemany("DELETE FROM edge_rtree WHERE edge_id = ?;", old_edge_ids)
+        cur.execute("DELETE FROM edges WHERE way_id IN (SELECT id FROM refresh_ways);")
+        if drop_ways:
+            cur.execute("DELETE FROM ways WHERE way_id IN (SELECT id FROM refresh_ways);")
+        if self.index_conn is not None:
+            self.index_conn.executemany("DELETE FROM edge_features WHERE edge_id = ?;", old_edge_ids)
+
+    def write_ways(self, ways: List[dict]):
+        if not ways:
+            return
+        self.remove_ways([way["id"] for way in ways], drop_ways=False)
+        graph = build_graph_arrays({"elements": ways})
+        write_graph_arrays(self.conn, graph, self.dictionary, batch_size=self.batch_size)
+        if self.index_conn is not None:
+            insert_feature_edge_ids(self.index_conn, graph.feature_edge_ids(), batch_size=self.batch_size, commit=False)
+
+    def remove_orphan_nodes(self) -> int:
+        cur = self.conn.cursor()
+        _temp_id_table(cur, "refresh_nodes", self.orphan_candidates)
+        orphans = cur.execute("""
+                              SELECT r.id FROM refresh_nodes r
+                              WHERE NOT EXISTS (SELECT 1 FROM edges WHERE start_node = r.id)
+                                AND NOT EXISTS (SELECT 1 FROM edges WHERE end_node = r.id);
+                              """).fetchall()
+        cur.executemany("DELETE FROM nodes WHERE node_id = ?;", orphans)
+        cur.executemany("DELETE FROM node_rtree WHERE node_id = ?;", orphans)
+        return len(orphans)
+
+
+def refresh_ways(
+    elements: Iterable[dict],
+    db_path: Path = DB_PATH,
+    index_path: Optional[Path] = INDEX_DB_PATH,
+    batch_size: int = INGEST_BATCH_SIZE,
+    ingest=None,
+) -> dict:
+    """Applies the difference between `elements` (a complete fresh fetch) and the stored ways."""
+    if ingest is None:
+        from .importer import DataIngestion
+        ingest = DataIngestion()
+
+    make_tables(db_path)
+    conn = make_connection(db_path)
+    index_conn = None
+    if index_path is not None:
+        index_conn = index_connection(index_path)
+        create_edge_features_table(index_conn)
+
+    counts = {"added": 0, "changed": 0, "unchanged": 0, "deleted": 0, "orphan_nodes": 0}
+    try:
+        stored = {
+            way_id: (version, checksum)
+            for way_id, version, checksum in conn.execute("SELECT way_id, version, checksum FROM ways;")
+        }
+        refresh = _Refresh(conn, index_conn, Config.BATCH_SIZE)
+
+        seen: Set[int] = set()
+        pending: List[dict] = []
+        for way in ingest.iter_walkable(elements):
+            way_id = way["id"]
+            if way_id in seen:
+                continue
+            seen.add(way_id)
+
+            previous = stored.get(way_id)
+            if previous is None:
+                counts["added"] += 1
+            elif previous == (way.get("version", -1), way_checksum(way)):
+                counts["unchanged"] += 1
+                continue
+            else:
+                counts["changed"] += 1
+
+            pending.append(way)
+            if len(pending) >= batch_size:
+                refresh.write_ways(pending)
+                pending = []
+        refresh.write_ways(pending)
+
+        deleted = [way_id for way_id in stored if way_id not in seen]
+        refresh.remove_ways(deleted, drop_ways=True)
+        counts["deleted"] = len(deleted)
+        counts["orphan_nodes"] = refresh.remove_orphan_nodes()
+
+        conn.commit()
+        if index_conn is not None:
+            index_conn.commit()
+    finally:
+        conn.close()
+        if index_conn is not None:
+            index_conn.close()
+
+    return counts
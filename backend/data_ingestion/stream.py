@@ -0,0 +1,148 @@
+import codecs
+import json
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from .batching import iter_batches
+from .graph.graph_builder import build_graph_arrays
+from .bulk_load import BulkLoad
+from .graph.persist_data import DB_PATH
+from .index.inverted_index_builder import DB_PATH as INDEX_DB_PATH
+
+'''
+Streaming Overpass ingestion.
+
+A county-sized Overpass response is hundreds of MB of JSON; response.json() plus
+the filtered copy plus the graph built from it held several copies at once.
+iter_overpass_elements decodes the "elements" array one element at a time from
+a file or a streamed HTTP body, and ingest_elements feeds those elements in
+batches of `batch_size` ways through filter -> build_graph_arrays -> a BulkLoad
+into fresh DB files, so memory is bounded by one batch instead of the whole payload.
+'''
+
+READ_SIZE = 1 << 16
+INGEST_BATCH_SIZE = 5000
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]}"
+
+
+class _Reader:
+    """Text buffer over a file-like object that returns str or bytes from read(n)."""
+    def __init__(self, stream, read_size: int):
+        self._stream = stream
+        self._read_size = read_size
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        raw = self._stream.read(self._read_size)
+        if not raw:
+            self.eof = True
+            return False
+        # a multi-byte character split between reads is held back by the decoder
+        chunk = self._utf8.decode(raw) if isinstance(raw, bytes) else raw
+        # drop what has been consumed so the buffer only holds the current element
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of Overpass response")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} in Overpass response at offset {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        if self.peek() not in '{["':
+            # a bare number or literal decodes from any prefix ("0." as 0), wait for its end
+            while not any(c in _DELIMITERS for c in self.buffer[self.pos:]) and self.fill():
+                pass
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # most likely cut off at the end of the buffer, read more and retry
+                if not self.fill():
+                    raise
+                continue
+            self.pos = end
+            return value
+
+
+def iter_overpass_elements(stream, read_size: int = READ_SIZE) -> Iterator[dict]:
+    """Yields the entries of the top level "elements" array of an Overpass JSON response."""
+    reader = _Reader(stream, read_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "elements":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ",":
+                        reader.pos += 1
+                        continue
+                    reader.expect("]")
+                    break
+        else:
+            value = reader.value()
+            # Overpass reports timeouts and memory errors here, the elements are then incomplete
+            if key == "remark" and value:
+                print(f"Overpass remark: {value}")
+
+        if reader.peek() == ",":
+            reader.pos += 1
+            continue
+        reader.expect("}")
+        return
+
+def iter_overpass_file(path: Path, read_size: int = READ_SIZE) -> Iterator[dict]:
+    with open(path, "rb") as f:
+        yield from iter_overpass_elements(f, read_size)
+
+
+def ingest_elements(
+    elements: Iterable[dict],
+    db_path: Path = DB_PATH,
+    index_path: Optional[Path] = INDEX_DB_PATH,
+    batch_size: int = INGEST_BATCH_SIZE,
+    ingest=None,
+) -> dict:
+    """Rebuilds the DBs from a stream of elements, batch by batch; returns node/edge/way counts."""
+    if ingest is None:
+        from .importer import DataIngestion
+        ingest = DataIngestion()
+
+    counts = {"ways": 0, "edges": 0, "nodes": 0}
+    with BulkLoad(db_path, index_path) as load:
+        for batch in iter_batches(ingest.iter_walkable(elements), batch_size):
+            graph = build_graph_arrays({"elements": batch})
+            load.add_graph_arrays(graph)
+
+            counts["ways"] += len(batch)
+            counts["edges"] += graph.num_edges
+
+        # nodes shared between batches are only stored once
+        counts["nodes"] = load.node_count()
+    return counts
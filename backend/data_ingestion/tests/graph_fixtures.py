@@ -0,0 +1,80 @@
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from ..graph import graph_store
+from ..graph.graph_builder import build_graph
+from ..graph.graph_store import GraphStore
+from ..graph.persist_data import make_tables, insert_nodes, insert_edges
+from ..index.inverted_index_builder import (make_connection as idx_conn,
+                                          create_edge_features_table, populate_edge_features)
+
+'''
+Graphs on disk for the tests.
+
+graph_files writes ways into a walk_routes.db and inverted_index.db in a
+temporary directory; temp_graph_store puts a GraphStore over them that keeps
+the snapshot, spatial index and landmarks out of data/ (pass paths to have
+them), and default_graph_store makes that store the one get_graph() and
+build_routes use until the block ends.
+'''
+
+# a n x n grid of two-way streets, about 100 m apart
+def grid_ways(n=10, step=0.0009):
+    elements = []
+    way_id = 1
+    for i in range(n):
+        for direction in (0, 1):
+            cells = [(i, j) if direction == 0 else (j, i) for j in range(n)]
+            ids = [r * n + c + 1 for r, c in cells]
+            geometry = [{"lat": 33.0 + r * step, "lon": -117.0 + c * step} for r, c in cells]
+            tags = {"highway": "footway" if i % 2 else "residential", "name": f"St {i}{direction}"}
+            if i % 3 == 0:
+                tags["lit"] = "yes"
+            for reverse in (False, True):
+                elements.append({
+                    "id": way_id,
+                    "nodes": ids[::-1] if reverse else ids,
+                    "geometry": geometry[::-1] if reverse else geometry,
+                    "tags": tags,
+                })
+                way_id += 1
+    return {"elements": elements}
+
+def write_graph(db_path, index_path, ways):
+    nodes, edges = build_graph(ways)
+    make_tables(db_path)
+    insert_nodes(nodes, db_path)
+    insert_edges(edges, db_path)
+
+    conn = idx_conn(index_path)
+    create_edge_features_table(conn)
+    populate_edge_features(conn, edges)
+    conn.close()
+
+@contextmanager
+def graph_files(ways=None):
+    """(db_path, index_path) of ways (grid_ways() by default) in a temporary directory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        index_path = Path(tmp) / "inverted_index.db"
+        write_graph(db_path, index_path, grid_ways() if ways is None else ways)
+        yield db_path, index_path
+
+@contextmanager
+def temp_graph_store(ways=None, snapshot_path=None, spatial_index_path=None, landmarks_path=None):
+    with graph_files(ways) as (db_path, index_path):
+        yield GraphStore(
+            db_path, index_path,
+            snapshot_path=snapshot_path, spatial_index_path=spatial_index_path, landmarks_path=landmarks_path,
+        )
+
+@contextmanager
+def default_graph_store(ways=None, **paths):
+    with temp_graph_store(ways, **paths) as store:
+        default_store = graph_store._default_store
+        graph_store._default_store = store
+        try:
+            yield store
+        finally:
+            graph_store._default_store = default_store
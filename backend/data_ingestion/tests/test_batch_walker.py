@@ -0,0 +1,89 @@
+import random
+from collections import Counter
+
+import numpy as np
+
+from ..graph.graph_builder import build_graph_arrays
+from .graph_fixtures import default_graph_store
+from .test_edge_sampler import WAYS, _exact
+from ...routes.batch_walker import BatchWalker
+from ...routes.edge_sampler import static_edge_weights
+from ...routes.route_builder import build_routes
+
+def test_next_edges_match_exact_distribution():
+    graph = build_graph_arrays({"elements": WAYS}).to_compact_graph()
+    center = graph.node_ids.tolist().index(1)
+    start, stop = int(graph.offsets[center]), int(graph.offsets[center + 1])
+    rows = list(range(start, stop))
+    lengths = sorted(graph.distance_m[rows].tolist())
+
+    cases = [
+        # far from the target
+        dict(remaining_m=5000.0, target_m=4000.0, visits=[]),
+        # the distance term in play, every spoke in reach
+        dict(remaining_m=5000.0, target_m=lengths[4], visits=[]),
+        # the longest spokes out of reach, left to _select_next_edge
+        dict(remaining_m=lengths[5], target_m=lengths[2], visits=[]),
+        # reuse allowed, visited spokes penalized
+        dict(remaining_m=5000.0, target_m=lengths[3], visits=[rows[0], rows[0], rows[3]], allow_edge_reuse=True),
+        # visited spokes out
+        dict(remaining_m=5000.0, target_m=5000.0, visits=[rows[1], rows[6]]),
+    ]
+    rng = random.Random(3)
+    for case in cases:
+        allow_edge_reuse = case.pop("allow_edge_reuse", False)
+        kwargs = dict(tag_bias=2.0, distance_bias=3.0, edge_reuse_penalty=1.5, allow_edge_reuse=allow_edge_reuse)
+        visit_counts = dict(Counter(case["visits"]))
+        expected = _exact(graph, start, stop, case["remaining_m"], case["target_m"], visit_counts, **kwargs)
+
+        walker = BatchWalker(
+            graph,
+            static_edge_weights(graph, ["lit"], 2.0),
+            distance_bias=3.0,
+            edge_reuse_penalty=1.5,
+            allow_edge_reuse=allow_edge_reuse,
+        )
+        n = 40000
+        edge_history = np.tile(np.asarray(case["visits"], dtype=np.int64), (n, 1))
+        node_history = np.full(edge_history.shape, center, dtype=np.int64)
+        chosen = walker.next_edges(
+            np.full(n, center, dtype=np.int64),
+            np.full(n, case["remaining_m"]),
+            np.full(n, case["target_m"]),
+            edge_history,
+            node_history,
+            rng=rng,
+        )
+        counts = Counter(chosen.tolist())
+        assert set(counts) <= set(expected)
+        for row, probability in expected.items():
+            assert abs(counts[row] / n - probability) < 0.012, (case, row, counts[row] / n, probability)
+
+def test_batched_routes_walk_the_graph():
+    with default_graph_store() as store:
+        graph = store.get()
+        routes = build_routes(
+            33.004, -116.996, 300.0, 900.0, max_routes=50, max_attempts=400, batch_walks=64, seed=5
+        )
+        assert len(routes) == 50
+        for route in routes:
+            assert 300.0 <= route.distance_m <= 900.0
+            assert len(set(route.edge_ids)) == len(route.edge_ids)
+            edges = [graph.edges[edge_id] for edge_id in route.edge_ids]
+            assert [edge.start_node for edge in edges] == list(route.node_ids[:-1])
+            assert [edge.end_node for edge in edges] == list(route.node_ids[1:])
+            assert abs(sum(edge.distance_m for edge in edges) - route.distance_m) < 1e-3
+
+        scored = build_routes(
+            33.004, -116.996, 300.0, 900.0, max_routes=10, max_attempts=600,
+            score_tag="lit", batch_walks=64, seed=7, return_scores=True,
+        )
+        assert len(scored) == 10
+        assert build_routes(
+            33.004, -116.996, 300.0, 900.0, max_routes=10, max_attempts=600,
+            score_tag="lit", batch_walks=64, seed=7, workers=2, return_scores=True,
+        ) == scored
+
+if __name__ == "__main__":
+    test_next_edges_match_exact_distribution()
+    test_batched_routes_walk_the_graph()
@@ -0,0 +1,56 @@
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from ..bulk_load import BulkLoad
+from ..graph.graph_builder import build_graph_arrays
+from ..graph.persist_data import load_compact_graph
+from .test_graph_builder import WAYS
+from .graph_fixtures import write_graph
+
+def test_bulk_load_swaps_in_finished_files():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        index_path = Path(tmp) / "inverted_index.db"
+        # the serving DB being replaced
+        write_graph(db_path, index_path, {"elements": WAYS["elements"][:1]})
+
+        graph = build_graph_arrays(WAYS)
+        with BulkLoad(db_path, index_path, batch_size=2) as load:
+            load.add_graph_arrays(graph)
+            # nothing is visible until the load commits
+            assert load_compact_graph(db_path).num_edges == 2
+
+        assert sorted(p.name for p in Path(tmp).iterdir()) == ["inverted_index.db", "walk_routes.db"]
+        assert load_compact_graph(db_path).num_edges == 3
+
+        for path in (db_path, index_path):
+            conn = sqlite3.connect(path)
+            assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "delete"
+            conn.close()
+
+        conn = sqlite3.connect(index_path)
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+        assert {"idx_edge_features_feature", "idx_edge_features_edge"} <= indexes
+        assert conn.execute("SELECT COUNT(*) FROM edge_features WHERE feature = 'lit';").fetchone()[0] == 2
+        conn.close()
+
+def test_failed_bulk_load_keeps_serving_db():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        index_path = Path(tmp) / "inverted_index.db"
+        write_graph(db_path, index_path, {"elements": WAYS["elements"][:1]})
+
+        try:
+            with BulkLoad(db_path, index_path) as load:
+                load.add_graph_arrays(build_graph_arrays(WAYS))
+                raise RuntimeError("import failed")
+        except RuntimeError:
+            pass
+
+        assert sorted(p.name for p in Path(tmp).iterdir()) == ["inverted_index.db", "walk_routes.db"]
+        assert load_compact_graph(db_path).num_edges == 2
+
+if __name__ == "__main__":
+    test_bulk_load_swaps_in_finished_files()
+    test_failed_bulk_load_keeps_serving_db()
@@ -0,0 +1,71 @@
+from ..graph.graph_builder import build_graph, build_graph_arrays, edge_id_for
+from .graph_fixtures import default_graph_store, grid_ways
+from ...routes.route_builder import build_routes
+
+def _way(way_id, node_ids, coords=None, highway="footway"):
+    coords = coords or [(33.0 + 0.001 * n, -117.0) for n in node_ids]
+    return {
+        "id": way_id,
+        "nodes": node_ids,
+        "geometry": [{"lat": lat, "lon": lon} for lat, lon in coords],
+        "tags": {"highway": highway},
+    }
+
+WAYS = [
+    # node 2 repeated; 3 and 4 at the same spot stay connected
+    _way(1, [1, 2, 2, 3, 4, 5], [(33.001, -117.0), (33.002, -117.0), (33.002, -117.0),
+                                 (33.003, -117.0), (33.003, -117.0), (33.005, -117.0)]),
+    # overlaps way 1 between 1 and 2, in both directions
+    _way(2, [1, 2, 6]),
+    _way(3, [2, 1]),
+    # island far away
+    _way(4, [100, 101]),
+    # a way made only of one repeated node
+    _way(5, [200, 200]),
+]
+
+def test_degenerate_and_duplicate_edges_are_dropped():
+    graph = build_graph_arrays({"elements": WAYS})
+    assert sorted(graph.edge_ids.tolist()) == sorted([
+        edge_id_for(1, 0), edge_id_for(1, 2), edge_id_for(1, 3), edge_id_for(1, 4),
+        edge_id_for(2, 1),
+        edge_id_for(3, 0),
+        edge_id_for(4, 0),
+    ])
+    assert (graph.start_nodes != graph.end_nodes).all()
+    assert graph.node_ids.tolist() == [1, 2, 3, 4, 5, 6, 100, 101]
+    # the ways themselves are all recorded, refresh compares them
+    assert graph.ways["way_id"].tolist() == [1, 2, 3, 4, 5]
+
+    nodes, edges = build_graph({"elements": WAYS})
+    assert sorted(edges) == sorted(graph.edge_ids.tolist())
+    assert sorted(nodes) == graph.node_ids.tolist()
+
+def test_components():
+    graph = build_graph_arrays({"elements": WAYS}).to_compact_graph()
+    components = graph.component_ids
+    index = {node_id: i for i, node_id in enumerate(graph.node_ids.tolist())}
+    assert len({components[index[n]] for n in (1, 2, 3, 4, 5, 6)}) == 1
+    assert components[index[100]] == components[index[101]] != components[index[1]]
+
+    island_length = graph.component_length_m[components[index[100]]]
+    assert 110 < island_length < 112
+
+def test_short_component_starts_with_edge_reuse():
+    # a 3 x 3 grid of two-way streets, about 2.3 km of edges in all
+    with default_graph_store(grid_ways(3)) as store:
+        graph = store.get()
+        assert graph.component_length_m.max() < 3000
+        params = dict(
+            latitude=33.0, longitude=-117.0, min_distance_m=3000, max_distance_m=4000,
+            max_routes=5, max_attempts=200, max_steps=200, workers=1, batch_walks=0,
+        )
+        assert build_routes(**params) == []
+        # walking streets again gets past the length of the whole grid
+        routes = build_routes(**params, allow_edge_reuse=True, edge_reuse_penalty=0.0)
+        assert routes and all(route.distance_m >= 3000 for route in routes)
+
+if __name__ == "__main__":
+    test_degenerate_and_duplicate_edges_are_dropped()
+    test_components()
+    test_short_component_starts_with_edge_reuse()
@@ -0,0 +1,113 @@
+from ..graph.graph_builder import build_graph, edge_id_for
+from ..graph.compact_graph import CompactGraph
+from ...routes.route_builder import Route, score_route_for_tag
+from ...routes.feature_extraction import compute_route_features, compute_routes_features
+
+# edge ids are derived from (way id, segment)
+E1, E2, E3 = edge_id_for(1, 0), edge_id_for(1, 1), edge_id_for(2, 0)
+
+WAYS = {
+    "elements":
+    [{
+        "id": 1,
+        "nodes": [100, 101, 102],
+        "geometry": [
+            {"lat": 33.0, "lon": -117.0},
+            {"lat": 33.001, "lon": -117.0},
+            {"lat": 33.002, "lon": -117.0}
+        ],
+        "tags": {"highway": "footway", "lit": "yes", "incline": "4%"}
+    },
+    {
+        "id": 2,
+        "nodes": [102, 100],
+        "geometry": [
+            {"lat": 33.002, "lon": -117.0},
+            {"lat": 33.0, "lon": -117.0}
+        ],
+        "tags": {"highway": "residential", "name": "Main St"}
+    }]
+}
+
+def test_csr_layout():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges, feature_edge_ids={"lit": [E1, E2]})
+
+    assert graph.num_nodes == 3
+    assert graph.num_edges == 3
+    assert graph.node_ids.tolist() == [100, 101, 102]
+
+    for node_id in nodes:
+        index = graph.node_index(node_id)
+        out_edge_ids = [int(graph.edge_ids[row]) for row in graph.out_edges(index)]
+        assert sorted(out_edge_ids) == sorted(e.edge_id for e in edges.values() if e.start_node == node_id)
+
+    # edges of one way share a single tag set
+    assert len(graph.tag_sets) == 2
+    assert graph.matching_edge_ids(["lit"]) == {E1, E2}
+
+def test_views_match_objects():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges)
+
+    assert set(graph.nodes) == set(nodes)
+    assert set(graph.edges) == set(edges)
+    for edge_id, edge in edges.items():
+        view = graph.edges[edge_id]
+        assert view.start_node == edge.start_node
+        assert view.end_node == edge.end_node
+        assert abs(view.distance_m - edge.distance_m) < 1e-3
+        assert view.tags == edge.tags
+    assert graph.adjacency.map.get(101) == [E2]
+
+def test_route_features_match():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges)
+    distance_m = sum(graph.edges[edge_id].distance_m for edge_id in (E1, E2, E3))
+    route = Route(node_ids=[100, 101, 102, 100], edge_ids=[E1, E2, E3], distance_m=distance_m)
+
+    assert compute_route_features(route, graph) == compute_route_features(route, graph.edges)
+
+def test_tag_masks_are_cached():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges, feature_edge_ids={"lit": [E1, E2], "incline": [E1, E2], "residential": [E3]})
+
+    mask = graph.tag_mask(["lit", "residential"])
+    assert graph.tag_mask(["residential", "lit", "lit"]) is mask
+    assert set(graph.edge_ids[mask].tolist()) == {E1, E2, E3}
+    assert not mask.flags.writeable
+    assert set(graph.edge_ids[graph.tag_mask(["lit", "incline"], match_all=True)].tolist()) == {E1, E2}
+    assert not graph.tag_mask(["lit", "residential"], match_all=True).any()
+
+    # scoring against the mask matches scoring against the id set
+    distance_m = sum(graph.edges[edge_id].distance_m for edge_id in (E1, E2, E3))
+    route = Route(node_ids=[100, 101, 102, 100], edge_ids=[E1, E2, E3], distance_m=distance_m)
+    lit = graph.tag_mask(["lit"])
+    assert abs(score_route_for_tag(route, graph, lit) - score_route_for_tag(route, graph, {E1, E2})) < 1e-9
+
+def test_batch_route_features_match():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges)
+    routes = []
+    for edge_ids in ([E1, E2, E3], [E3], [E1, E2, E3, E1, E2, E3], [E1]):
+        distance_m = sum(graph.edges[edge_id].distance_m for edge_id in edge_ids)
+        routes.append(Route(node_ids=[], edge_ids=edge_ids, distance_m=distance_m))
+
+    batch = compute_routes_features(routes, graph)
+    assert len(batch) == len(routes)
+    for route, features in zip(routes, batch):
+        expected = compute_route_features(route, graph.edges)
+        for name, value in vars(expected).items():
+            if value is None:
+                assert getattr(features, name) is None
+            else:
+                assert abs(getattr(features, name) - value) < 1e-12
+    assert batch[1].avg_incline is None
+    assert compute_routes_features([], graph) == []
+
+if __name__ == "__main__":
+    test_csr_layout()
+    test_views_match_objects()
+    test_route_features_match()
+    test_tag_masks_are_cached()
+    test_batch_route_features_match()
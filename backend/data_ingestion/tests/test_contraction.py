@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+
+from ..graph.graph_builder import build_graph_arrays
+from .graph_fixtures import default_graph_store
+from ...routes.route_builder import _build_route_from_start, build_routes
+
+def _way(way_id, node_ids, highway="footway", **extra_tags):
+    return {
+        "id": way_id,
+        "nodes": node_ids,
+        "geometry": [{"lat": 33.0 + 0.001 * (n % 10), "lon": -117.0 + 0.001 * (n // 10)} for n in node_ids],
+        "tags": {"highway": highway, **extra_tags},
+    }
+
+WAYS = [
+    # two-way street 1-2-3-4-5 drawn as a way and its reverse; 1 and 5 are junctions
+    _way(1, [1, 2, 3, 4, 5]),
+    _way(2, [5, 4, 3, 2, 1]),
+    # one-way chain out of 5, tags change at 13
+    _way(3, [5, 11, 12, 13]),
+    _way(4, [13, 14, 15, 1], "residential"),
+    # spur from 1
+    _way(5, [1, 21, 22]),
+    # closed loop with no junction
+    _way(6, [31, 32, 33, 34, 31], "path"),
+]
+
+def _graph():
+    return build_graph_arrays({"elements": WAYS}).to_compact_graph()
+
+def test_chains_become_super_edges():
+    graph = _graph()
+    walk = graph.contracted
+    assert graph.num_edges == 20
+
+    index = {int(node_id): i for i, node_id in enumerate(graph.node_ids.tolist())}
+    chains = sorted(
+        (
+            graph.node_ids[walk.edge_src[row]].item(),
+            graph.node_ids[walk.edge_dst[row]].item(),
+            len(walk.member_rows[walk.member_offsets[row]:walk.member_offsets[row + 1]]),
+        )
+        for row in range(walk.num_edges)
+    )
+    assert chains == [(1, 5, 4), (1, 22, 2), (5, 1, 4), (5, 13, 3), (13, 1, 3), (31, 31, 4)]
+
+    junctions = sorted(graph.node_ids[walk.is_junction].tolist())
+    assert junctions == [1, 5, 13, 22, 31]
+
+    # every original edge is in exactly one super-edge, lengths add up
+    assert sorted(walk.member_rows.tolist()) == list(range(graph.num_edges))
+    assert np.isclose(walk.distance_m.sum(), graph.distance_m.astype(np.float64).sum())
+    for row in range(walk.num_edges):
+        assert int(walk.offsets[walk.edge_src[row]]) <= row < int(walk.offsets[walk.edge_src[row] + 1])
+
+    # starts inside a chain move to the chain's junction
+    assert walk.start_nodes([index[3], index[5]]).tolist() == [index[5]]
+    assert sorted(walk.start_nodes([index[3]]).tolist()) == [index[1], index[5]]
+
+def test_walks_expand_to_original_routes():
+    graph = _graph()
+    random.seed(4)
+    for _ in range(50):
+        start = random.choice(graph.contracted.start_nodes(np.arange(graph.num_nodes)).tolist())
+        route = _build_route_from_start(start, graph.contracted, 100.0, 900.0, 20)
+        if route is None:
+            continue
+        rows = graph.edge_rows(route.edge_ids)
+        assert graph.node_ids[graph.edge_src[rows]].tolist() == list(route.node_ids[:-1])
+        assert graph.node_ids[graph.edge_dst[rows]].tolist() == list(route.node_ids[1:])
+        assert np.isclose(route.distance_m, graph.distance_m[rows].astype(np.float64).sum())
+
+def test_walks_end_partway_along_long_chains():
+    # a two-way trail about 4.3 km long with junctions only at its ends
+    geometry = [{"lat": 33.0 + 0.001 * n, "lon": -117.0} for n in range(40)]
+    trail = {"elements": [
+        {"id": 1, "nodes": list(range(1, 41)), "geometry": geometry, "tags": {"highway": "path"}},
+        {"id": 2, "nodes": list(range(40, 0, -1)), "geometry": geometry[::-1], "tags": {"highway": "path"}},
+    ]}
+    graph = build_graph_arrays(trail).to_compact_graph()
+    assert graph.contracted.num_edges == 2 and graph.contracted.distance_m.min() > 4000
+
+    random.seed(2)
+    routes = [_build_route_from_start(0, graph.contracted, 500.0, 1000.0, 20) for _ in range(50)]
+    # a target less than an edge short of max_distance_m cannot be reached without going over
+    routes = [route for route in routes if route is not None]
+    assert len(routes) >= 30
+    for route in routes:
+        assert 500.0 <= route.distance_m <= 1000.0
+        assert route.node_ids[0] == 1
+        rows = graph.edge_rows(route.edge_ids)
+        assert graph.node_ids[graph.edge_src[rows]].tolist() == list(route.node_ids[:-1])
+        assert graph.node_ids[graph.edge_dst[rows]].tolist() == list(route.node_ids[1:])
+        assert np.isclose(route.distance_m, graph.distance_m[rows].astype(np.float64).sum())
+
+    with default_graph_store(trail):
+        for batch_walks in (0, 8):
+            routes = build_routes(
+                33.0, -117.0, 500.0, 1000.0, max_routes=10, max_start_distance_m=100.0,
+                workers=1, batch_walks=batch_walks, seed=1,
+            )
+            assert len(routes) == 10
+            assert all(500.0 <= route.distance_m <= 1000.0 for route in routes)
+
+if __name__ == "__main__":
+    test_chains_become_super_edges()
+    test_walks_expand_to_original_routes()
+    test_walks_end_partway_along_long_chains()
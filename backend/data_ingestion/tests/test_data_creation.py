@@ -4,11 +4,8 @@ from pathlib import Path
 from ..importer import DataIngestion
 from ..graph.graph_builder import build_graph
 from ..graph.persist_data import (make_tables, insert_nodes, insert_edges, load_edges)
-from ..index.inverted_index_builder import (
-    make_connection as idx_conn,
-    create_edge_features_table,
-    populate_edge_features,
-)
+from ..stream import ingest_elements
+from ..refresh import refresh_ways
 
 def test_irvine():
     ingest = DataIngestion()
@@ -66,40 +63,35 @@ def test_oc_county():
     """
     ingest = DataIngestion()
 
-    print("Fetching OSM data for Orange County (this may take several minutes)...")
-    raw = ingest.fetch_oc_county_walkways()
-    ways = ingest.filter_for_walkability(raw)
-
-    n_elements = len(ways.get("elements", []))
-    print(f"Filtered to {n_elements} walkable ways")
-
-    print("Building graph...")
-    nodes, edges = build_graph(ways)
+    print("Fetching OSM data for Orange County tile by tile (this may take several minutes)...")
+    counts = ingest_elements(ingest.fetch_oc_county_tiled(), ingest=ingest)
 
-    print(f"Built {len(nodes)} nodes")
-    print(f"Built {len(edges)} edges")
+    print(f"Filtered to {counts['ways']} walkable ways")
+    print(f"Built {counts['nodes']} nodes")
+    print(f"Built {counts['edges']} edges")
 
-    print("Creating database tables")
-    make_tables()
+    print("Orange County graph ready. Restart the backend API to use it.")
 
-    print("Populating nodes")
-    insert_nodes(nodes)
 
-    print("Populating edges")
-    insert_edges(edges)
+def test_oc_county_refresh():
+    """
+    Refetch Orange County and apply only the ways that changed since the last import.
+    Run: python -m backend.data_ingestion.tests.test_data_creation refresh
+    """
+    ingest = DataIngestion()
 
-    print("Building inverted index for tag-based scoring...")
-    conn = idx_conn()
-    create_edge_features_table(conn)
-    populate_edge_features(conn, edges)
-    conn.close()
+    print("Streaming OSM data for Orange County and diffing against the database...")
+    counts = refresh_ways(ingest.fetch_oc_county_tiled(), ingest=ingest)
 
-    print("Orange County graph ready. Restart the backend API to use it.")
+    print(f"{counts['added']} ways added, {counts['changed']} changed, {counts['deleted']} deleted, "
+          f"{counts['unchanged']} unchanged")
 
 
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1 and sys.argv[1] == "oc":
         test_oc_county()
+    elif len(sys.argv) > 1 and sys.argv[1] == "refresh":
+        test_oc_county_refresh()
     else:
         test_irvine()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import random
+from collections import Counter
+
+from ..graph.graph_builder import build_graph_arrays
+from ...routes.edge_sampler import EdgeSampler, static_edge_weights
+from ...routes.route_builder import _select_next_edge
+
+def _way(way_id, node_ids, lat, **tags):
+    return {
+        "id": way_id,
+        "nodes": node_ids,
+        "geometry": [{"lat": 33.0, "lon": -117.0}, {"lat": 33.0 + lat, "lon": -117.0}],
+        "tags": {"highway": "footway", **tags},
+    }
+
+# a star around node 1, spokes of different lengths, every other one lit
+WAYS = [
+    _way(i, [1, 100 + i], 0.0004 * i, **({"lit": "yes"} if i % 2 else {}))
+    for i in range(1, 9)
+]
+
+class _RecordWeights:
+    """Stands in for the rng of _select_next_edge to read off the weights it draws with."""
+    def choices(self, population, weights, k):
+        total = sum(weights)
+        self.probabilities = {row: weight / total for (row, _), weight in zip(population, weights)}
+        return population[:k]
+
+def _exact(graph, start, stop, remaining_m, target_m, visits, **kwargs):
+    record = _RecordWeights()
+    _select_next_edge(
+        range(start, stop), graph, remaining_m, remaining_target_distance_m=target_m,
+        matching_mask=graph.tag_mask(["lit"]), edge_visit_counts=visits, rng=record, **kwargs,
+    )
+    return record.probabilities
+
+def test_sampler_matches_exact_distribution():
+    graph = build_graph_arrays({"elements": WAYS}).to_compact_graph()
+    center = graph.node_ids.tolist().index(1)
+    start, stop = int(graph.offsets[center]), int(graph.offsets[center + 1])
+    rows = list(range(start, stop))
+    assert len(rows) == 8
+    lengths = sorted(graph.distance_m[rows].tolist())
+
+    cases = [
+        # far from the target, plenty of distance left
+        dict(remaining_m=5000.0, target_m=4000.0, visits={}),
+        # target within reach of the spokes, the longest ones out of reach
+        dict(remaining_m=lengths[5], target_m=lengths[2], visits={}),
+        # reuse allowed, visited spokes penalized
+        dict(remaining_m=5000.0, target_m=lengths[3], visits={rows[0]: 2, rows[3]: 1}, allow_edge_reuse=True),
+        # visited spokes out, visited_nodes known
+        dict(remaining_m=5000.0, target_m=lengths[4], visits={rows[1]: 1, rows[6]: 1}),
+    ]
+    rng = random.Random(3)
+    for case in cases:
+        allow_edge_reuse = case.pop("allow_edge_reuse", False)
+        kwargs = dict(tag_bias=2.0, distance_bias=3.0, edge_reuse_penalty=1.5, allow_edge_reuse=allow_edge_reuse)
+        expected = _exact(graph, start, stop, case["remaining_m"], case["target_m"], case["visits"], **kwargs)
+
+        sampler = EdgeSampler(
+            graph,
+            static_edge_weights(graph, ["lit"], 2.0),
+            distance_bias=3.0,
+            edge_reuse_penalty=1.5,
+            allow_edge_reuse=allow_edge_reuse,
+        )
+        visited_nodes = {center} if case["visits"] else set()
+        n = 40000
+        counts = Counter(
+            sampler.next_edge(center, case["remaining_m"], case["target_m"], case["visits"], visited_nodes, rng=rng)
+            for _ in range(n)
+        )
+        assert set(counts) <= set(expected)
+        for row, probability in expected.items():
+            assert abs(counts[row] / n - probability) < 0.012, (case, row, counts[row] / n, probability)
+
+def test_sampler_without_viable_edges():
+    graph = build_graph_arrays({"elements": WAYS}).to_compact_graph()
+    center = graph.node_ids.tolist().index(1)
+    sampler = EdgeSampler(graph, static_edge_weights(graph), distance_bias=1.0)
+    assert sampler.next_edge(center, 1.0, 0.5, {}, set(), rng=random.Random(0)) is None
+    # leaves have no out-edges
+    leaf = graph.node_ids.tolist().index(101)
+    assert sampler.next_edge(leaf, 5000.0, 100.0, {}, set()) is None
+    # static weights are cached per tag set and bias
+    assert static_edge_weights(graph, ["lit"], 2.0) is static_edge_weights(graph, ("lit",), 2.0)
+    assert static_edge_weights(graph, ["lit"], 2.0) is not static_edge_weights(graph, ["lit"], 1.0)
+
+if __name__ == "__main__":
+    test_sampler_matches_exact_distribution()
+    test_sampler_without_viable_edges()
@@ -1,4 +1,10 @@
-from ..graph.graph_builder import build_graph
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.graph_builder import build_graph, build_graph_arrays, edge_id_for
+from ..graph.persist_data import make_tables, insert_nodes, insert_edges, insert_graph_arrays, load_compact_graph
 
 def test_simple_way():
     ways = {
@@ -24,5 +30,72 @@ def test_simple_way():
     assert edge.end_node == 101
     assert edge.tags["highway"] == "footway"
 
+WAYS = {
+    "elements": [
+        {
+            "id": 1,
+            "nodes": [100, 101, 102],
+            "geometry": [{"lat": 33.0, "lon": -117.0}, {"lat": 33.001, "lon": -117.0}, {"lat": 33.002, "lon": -117.0}],
+            "tags": {"highway": "footway", "lit": "yes"}
+        },
+        {
+            "id": 2,
+            "nodes": [102, 103],
+            "geometry": [{"lat": 33.002, "lon": -117.0}, {"lat": 33.002, "lon": -117.001}],
+            "tags": {"highway": "residential"}
+        },
+        {
+            "id": 3,
+            "nodes": [103],
+            "geometry": [{"lat": 33.002, "lon": -117.001}],
+            "tags": {"highway": "path"}
+        }
+    ]
+}
+
+def test_arrays_match_objects():
+    nodes, edges = build_graph(WAYS)
+    graph = build_graph_arrays(WAYS)
+
+    assert list(nodes) == [100, 101, 102, 103]
+    assert graph.node_ids.tolist() == sorted(nodes)
+    e1, e2, e3 = edge_id_for(1, 0), edge_id_for(1, 1), edge_id_for(2, 0)
+    assert graph.edge_ids.tolist() == list(edges) == [e1, e2, e3]
+    assert graph.start_nodes.tolist() == [e.start_node for e in edges.values()]
+    assert graph.end_nodes.tolist() == [e.end_node for e in edges.values()]
+    assert graph.way_ids.tolist() == [1, 1, 2]
+    assert np.allclose(graph.distance_m, [e.distance_m for e in edges.values()])
+    assert 110 < edges[e1].distance_m < 112
+    assert graph.tag_sets.tags(int(graph.edge_tag_set[2])) == {"highway": "residential"}
+    assert graph.feature_edge_ids()["lit"].tolist() == [e1, e2]
+    assert graph.ways["way_id"].tolist() == [1, 2, 3]
+
+def test_array_persistence_matches_objects():
+    nodes, edges = build_graph(WAYS)
+    graph = build_graph_arrays(WAYS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        from_objects = Path(tmp) / "objects.db"
+        make_tables(from_objects)
+        insert_nodes(nodes, from_objects)
+        insert_edges(edges, from_objects)
+
+        from_arrays = Path(tmp) / "arrays.db"
+        make_tables(from_arrays)
+        insert_graph_arrays(graph, from_arrays)
+
+        expected = load_compact_graph(from_objects)
+        loaded = load_compact_graph(from_arrays)
+        for name in ("node_ids", "lat", "lon", "offsets", "edge_ids", "edge_dst", "distance_m", "way_ids"):
+            assert np.array_equal(getattr(loaded, name), getattr(expected, name))
+        assert [loaded.edge_tags(row) for row in range(loaded.num_edges)] == \
+            [expected.edge_tags(row) for row in range(expected.num_edges)]
+
+    compact = graph.to_compact_graph()
+    assert compact.matching_edge_ids(["lit"]) == {edge_id_for(1, 0), edge_id_for(1, 1)}
+    assert len(compact.adjacency.map[102]) == 1
+
 if __name__ == "__main__":
-    test_simple_way()
\ No newline at end of file
+    test_simple_way()
+    test_arrays_match_objects()
+    test_array_persistence_matches_objects()
@@ -0,0 +1,45 @@
+import os
+
+from .graph_fixtures import temp_graph_store, write_graph
+
+WAYS = {
+    "elements":
+    [{
+        "id": 1,
+        "nodes": [100, 101, 102],
+        "geometry": [
+            {"lat": 33.0, "lon": -117.0},
+            {"lat": 33.001, "lon": -117.0},
+            {"lat": 33.002, "lon": -117.0}
+        ],
+        "tags": {"highway": "footway", "lit": "yes"}
+    }]
+}
+
+def test_store_reuses_and_reloads():
+    with temp_graph_store(WAYS) as store:
+        graph = store.get()
+
+        assert store.get() is graph
+        assert len(graph.nodes) == 3
+        assert len(graph.edges) == 2
+        assert len(graph.adjacency.map[100]) == 1
+        assert graph.matching_edge_ids(["lit"]) == set(graph.edges)
+
+        # rewriting the DB must hand out a fresh graph
+        extended = {"elements": WAYS["elements"] + [{
+            "id": 2,
+            "nodes": [102, 103],
+            "geometry": [{"lat": 33.002, "lon": -117.0}, {"lat": 33.003, "lon": -117.0}],
+            "tags": {"highway": "residential"}
+        }]}
+        write_graph(store.db_path, store.index_path, extended)
+        stat = os.stat(store.db_path)
+        os.utime(store.db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+        reloaded = store.get()
+        assert reloaded is not graph
+        assert len(reloaded.nodes) == 4
+
+if __name__ == "__main__":
+    test_store_reuses_and_reloads()
@@ -0,0 +1,85 @@
+import numpy as np
+
+from ..graph.graph_builder import build_graph_arrays
+from .graph_fixtures import default_graph_store
+from ...routes import loop_builder
+from ...routes.edge_sampler import static_edge_weights
+from ...routes.loop_builder import LoopWalker, home_distances_m
+from ...routes.route_builder import build_routes
+
+def test_home_distances_follow_edge_direction():
+    # a one-way triangle 1 -> 2 -> 3 -> 1 about 100 m a side, and a two-way spur 3 - 4
+    def way(way_id, node_ids, points):
+        return {
+            "id": way_id,
+            "nodes": node_ids,
+            "geometry": [{"lat": 33.0 + lat, "lon": -117.0 + lon} for lat, lon in points],
+            "tags": {"highway": "footway"},
+        }
+    ways = [
+        way(1, [1, 2], [(0, 0), (0.0009, 0)]),
+        way(2, [2, 3], [(0.0009, 0), (0.0009, 0.0009)]),
+        way(3, [3, 1], [(0.0009, 0.0009), (0, 0)]),
+        way(4, [3, 4], [(0.0009, 0.0009), (0.0018, 0.0009)]),
+        way(5, [4, 3], [(0.0018, 0.0009), (0.0009, 0.0009)]),
+    ]
+    graph = build_graph_arrays({"elements": ways}).to_compact_graph()
+    index = {node_id: i for i, node_id in enumerate(graph.node_ids.tolist())}
+    edge = {
+        (int(graph.node_ids[graph.edge_src[row]]), int(graph.node_ids[graph.edge_dst[row]])): float(graph.distance_m[row])
+        for row in range(graph.num_edges)
+    }
+
+    nodes, distances_m = home_distances_m(graph, index[1], 10000.0)
+    assert nodes.tolist() == sorted(index.values())
+    home = dict(zip(nodes.tolist(), distances_m.tolist()))
+    assert home[index[1]] == 0
+    # from 2 home goes on round the triangle, not back down 1 -> 2
+    assert np.isclose(home[index[2]], edge[2, 3] + edge[3, 1])
+    assert np.isclose(home[index[4]], edge[4, 3] + edge[3, 1])
+    # only the nodes reached within the limit are kept
+    nodes, _ = home_distances_m(graph, index[1], edge[3, 1] + 1.0)
+    assert nodes.tolist() == sorted([index[1], index[3]])
+
+    # a walker keeps home distances up to HOME_DISTANCE_CACHE_BYTES and looks them
+    # up in one array that only ever holds the current home's
+    cache_bytes = loop_builder.HOME_DISTANCE_CACHE_BYTES
+    loop_builder.HOME_DISTANCE_CACHE_BYTES = 1
+    try:
+        walker = LoopWalker(graph, static_edge_weights(graph), edge[3, 1] + 1.0)
+        for home_node in (index[1], index[4], index[1]):
+            nodes, distances_m = home_distances_m(graph, home_node, edge[3, 1] + 1.0)
+            expected = np.full(graph.num_nodes, np.inf)
+            expected[nodes] = distances_m
+            assert np.array_equal(np.asarray(walker._set_home(home_node)), expected)
+            assert list(walker._home_distances) == [home_node]
+    finally:
+        loop_builder.HOME_DISTANCE_CACHE_BYTES = cache_bytes
+
+def test_loops_close_within_distance():
+    with default_graph_store() as store:
+        graph = store.get()
+        attempts = 300
+        routes = build_routes(
+            33.004, -116.996, 600.0, 1200.0, max_routes=attempts, max_attempts=attempts, loop=True, seed=3
+        )
+        # nearly every attempt closes
+        assert len(routes) >= 0.8 * attempts
+        for route in routes:
+            assert route.node_ids[0] == route.node_ids[-1]
+            assert 600.0 <= route.distance_m <= 1200.0 + 1e-6
+            assert len(set(route.edge_ids)) == len(route.edge_ids)
+            edges = [graph.edges[edge_id] for edge_id in route.edge_ids]
+            assert [edge.start_node for edge in edges] == list(route.node_ids[:-1])
+            assert [edge.end_node for edge in edges] == list(route.node_ids[1:])
+
+        scored = build_routes(
+            33.004, -116.996, 600.0, 1200.0, max_routes=5, max_attempts=200,
+            score_tag="lit", loop=True, seed=3, return_scores=True,
+        )
+        assert len(scored) == 5
+        assert all(route.node_ids[0] == route.node_ids[-1] for route, _ in scored)
+
+if __name__ == "__main__":
+    test_home_distances_follow_edge_direction()
+    test_loops_close_within_distance()
@@ -0,0 +1,167 @@
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.persist_data import load_compact_graph
+from ..osm_extract import _packed_varints, iter_osm_extract
+from ..stream import ingest_elements
+
+NODES = {n: (33.0 + 0.0013 * n, -117.0 - 0.0007 * n) for n in range(1, 12)}
+NODES[5000000000] = (33.5, -117.5)
+
+# (id, version, node ids, tags); node 99 is not in the extract
+WAYS = [
+    (1, 3, [1, 2, 3], {"highway": "footway", "lit": "yes", "source": "survey"}),
+    (2, 1, [3, 4], {"highway": "motorway"}),
+    (3, 2, [4, 5, 6, 5000000000], {"highway": "residential", "sidewalk": "both", "name": "Café Row"}),
+    (4, 1, [6, 7], {"highway": "footway", "access": "private"}),
+    (5, 7, [7, 8, 99, 10, 11], {"highway": "path", "incline": "5%"}),
+    (6, 1, [99, 9], {"highway": "steps"}),
+    (7, 1, [1, 10], {"building": "yes"}),
+]
+TIMESTAMP = 1767225600  # 2026-01-01T00:00:00Z
+
+def _expected():
+    elements = []
+    for way_id, version, refs, tags in WAYS:
+        if way_id in (2, 4, 6, 7):
+            continue
+        elements.append({
+            "type": "way",
+            "id": way_id,
+            "version": version,
+            "timestamp": "2026-01-01T00:00:00Z",
+            "nodes": refs,
+            "geometry": [
+                {"lat": round(NODES[n][0], 7), "lon": round(NODES[n][1], 7)} if n in NODES else None for n in refs
+            ],
+            "tags": {k: v for k, v in tags.items() if k != "source"},
+        })
+    return elements
+
+# --- a minimal PBF writer ---
+
+def _varint(v):
+    out = bytearray()
+    while True:
+        b = v & 0x7F
+        v >>= 7
+        if v:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def _zz(v):
+    return (v << 1) ^ (v >> 63)
+
+def _field(number, value):
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+def _packed(values, signed=False, delta=False):
+    prev = 0
+    out = b""
+    for v in values:
+        out += _varint(_zz(v - prev) if signed else v)
+        if delta:
+            prev = v
+    return out
+
+def _blob(blob_type, data):
+    blob = _field(2, len(data)) + _field(3, zlib.compress(data))
+    header = _field(1, blob_type.encode()) + _field(3, len(blob))
+    return struct.pack(">I", len(header)) + header + blob
+
+def _write_pbf(path, nodes_per_block=5):
+    strings = [""]
+    def string_id(s):
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    out = _blob("OSMHeader", _field(4, b"OsmSchema-V0.6") + _field(4, b"DenseNodes"))
+    node_ids = sorted(NODES)
+    for i in range(0, len(node_ids), nodes_per_block):
+        ids = node_ids[i:i + nodes_per_block]
+        dense = (
+            _field(1, _packed(ids, signed=True, delta=True))
+            + _field(8, _packed([round(NODES[n][0] * 1e7) for n in ids], signed=True, delta=True))
+            + _field(9, _packed([round(NODES[n][1] * 1e7) for n in ids], signed=True, delta=True))
+        )
+        # granularity 100 nanodegrees, the default
+        block = _field(1, _field(1, b"")) + _field(2, _field(2, dense))
+        out += _blob("OSMData", block)
+
+    group = b""
+    for way_id, version, refs, tags in WAYS:
+        info = _field(1, version) + _field(2, TIMESTAMP)
+        group += _field(3, (
+            _field(1, way_id)
+            + _field(2, _packed([string_id(k) for k in tags]))
+            + _field(3, _packed([string_id(v) for v in tags.values()]))
+            + _field(4, info)
+            + _field(8, _packed(refs, signed=True, delta=True))
+        ))
+    table = b"".join(_field(1, s.encode("utf-8")) for s in strings)
+    out += _blob("OSMData", _field(1, table) + _field(2, group))
+    Path(path).write_bytes(out)
+
+def _write_xml(path):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for n, (lat, lon) in sorted(NODES.items()):
+        lines.append(f'  <node id="{n}" lat="{lat:.7f}" lon="{lon:.7f}" version="1"/>')
+    for way_id, version, refs, tags in WAYS:
+        lines.append(f'  <way id="{way_id}" version="{version}" timestamp="2026-01-01T00:00:00Z">')
+        lines += [f'    <nd ref="{n}"/>' for n in refs]
+        lines += [f'    <tag k="{k}" v="{v}"/>' for k, v in tags.items()]
+        lines.append("  </way>")
+    lines.append('  <relation id="1" version="1"><member type="way" ref="1" role=""/></relation>')
+    lines.append("</osm>")
+    Path(path).write_text("\n".join(lines), encoding="utf-8")
+
+def test_packed_varints():
+    values = [0, 1, 127, 128, 300, 2 ** 35, 2 ** 63 + 5]
+    assert _packed_varints(b"".join(_varint(v) for v in values)).tolist() == values
+
+def test_pbf_and_xml_match_overpass_elements():
+    with tempfile.TemporaryDirectory() as tmp:
+        pbf = Path(tmp) / "extract.osm.pbf"
+        xml = Path(tmp) / "extract.osm"
+        _write_pbf(pbf)
+        _write_xml(xml)
+
+        expected = _expected()
+        assert list(iter_osm_extract(pbf, node_store_dir=tmp, max_workers=1)) == expected
+        assert list(iter_osm_extract(pbf, node_store_dir=tmp, max_workers=2)) == expected
+        assert list(iter_osm_extract(xml, node_store_dir=tmp)) == expected
+        # the node stores are removed afterwards
+        assert sorted(p.name for p in Path(tmp).iterdir()) == ["extract.osm", "extract.osm.pbf"]
+
+def test_extract_builds_same_graph():
+    with tempfile.TemporaryDirectory() as tmp:
+        pbf = Path(tmp) / "extract.osm.pbf"
+        _write_pbf(pbf)
+        ingest_elements(iter_osm_extract(pbf, max_workers=1), Path(tmp) / "a.db", Path(tmp) / "a_index.db")
+        ingest_elements(_expected(), Path(tmp) / "b.db", Path(tmp) / "b_index.db")
+
+        a = load_compact_graph(Path(tmp) / "a.db")
+        b = load_compact_graph(Path(tmp) / "b.db")
+        for name in ("node_ids", "lat", "lon", "offsets", "edge_ids", "edge_dst", "distance_m", "way_ids"):
+            assert np.array_equal(getattr(a, name), getattr(b, name))
+
+        # way 5 is split around the missing node 99: 7 -> 8 and 10 -> 11 keep their
+        # segment indices, and nothing joins 8 to 10
+        rows = np.flatnonzero(a.way_ids == 5)
+        segments = {(int(a.node_ids[a.edge_src[row]]), int(a.node_ids[a.edge_dst[row]])) for row in rows}
+        assert segments == {(7, 8), (10, 11)}
+        assert sorted(int(edge_id) & 0xFFF for edge_id in a.edge_ids[rows]) == [0, 3]
+
+if __name__ == "__main__":
+    test_packed_varints()
+    test_pbf_and_xml_match_overpass_elements()
+    test_extract_builds_same_graph()
@@ -0,0 +1,89 @@
+import io
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from ..overpass_cache import OverpassCache, OverpassCacheMiss, OverpassRuntimeError
+from .test_tiled_fetch import BBOX, WAYS, _ingest, _serve
+
+QUERY = """
+[out:json][timeout:60];
+way["highway"="footway"](33.0,-117.2,33.2,-117.0);
+out meta geom;
+"""
+
+def test_store_and_lookup():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = OverpassCache(Path(tmp), ttl_s=60, max_bytes=None)
+        assert cache.lookup(QUERY) is None
+
+        path = cache.store(QUERY, io.BytesIO(b'{"elements": []}'))
+        # reformatting the query does not change the key
+        assert cache.lookup("  ".join(QUERY.split())) == path
+        with cache.open(path) as f:
+            assert f.read() == b'{"elements": []}'
+
+        # past the TTL it is a miss, offline it is still served
+        os.utime(path, (time.time(), time.time() - 120))
+        assert cache.lookup(QUERY) is None
+        assert OverpassCache(Path(tmp), ttl_s=60, offline=True).lookup(QUERY) == path
+
+def test_offline_miss_and_runtime_error():
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            OverpassCache(Path(tmp), offline=True).lookup(QUERY)
+        except OverpassCacheMiss:
+            pass
+        else:
+            assert False, "offline lookups of unknown queries must fail"
+
+        cache = OverpassCache(Path(tmp))
+        try:
+            cache.store(QUERY, io.BytesIO(b'{"elements": [], "remark": "runtime error: Query timed out"}'))
+        except OverpassRuntimeError:
+            pass
+        else:
+            assert False, "failed responses must not be cached"
+        assert list(Path(tmp).iterdir()) == []
+
+def test_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = OverpassCache(Path(tmp), max_bytes=None)
+        payload = os.urandom(2000)
+        paths = []
+        for i in range(3):
+            paths.append(cache.store(f"{QUERY} // {i}", io.BytesIO(payload)))
+            os.utime(paths[-1], (1000 + i, time.time()))
+        # use the oldest entry so the second one becomes least recently used
+        cache.lookup(f"{QUERY} // 0")
+
+        cache.max_bytes = 2 * paths[0].stat().st_size
+        cache.store(f"{QUERY} // 3", io.BytesIO(payload))
+        assert [p.exists() for p in paths] == [True, False, False]
+        assert cache.size_bytes() <= cache.max_bytes
+
+def test_tiled_fetch_uses_cache():
+    server = _serve()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = OverpassCache(Path(tmp) / "cache")
+            first = list(_ingest(server, cache).fetch_tiled(BBOX, tile_deg=0.1, checkpoint_dir=Path(tmp) / "a"))
+            assert server.requests == 4
+
+            # a new run with its own checkpoints is served from the cache
+            second = list(_ingest(server, cache).fetch_tiled(BBOX, tile_deg=0.1, checkpoint_dir=Path(tmp) / "b"))
+            assert server.requests == 4
+            assert first == second and len(second) == len(WAYS)
+
+            cache.offline = True
+            assert _ingest(server, cache).fetch_routes(33.1, -117.1, 500) == {}
+            assert server.requests == 4
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_store_and_lookup()
+    test_offline_miss_and_runtime_error()
+    test_evicts_least_recently_used()
+    test_tiled_fetch_uses_cache()
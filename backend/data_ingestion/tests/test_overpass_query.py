@@ -0,0 +1,36 @@
+import itertools
+import re
+
+from ..importer import DataIngestion
+from ..overpass_query import FEATURE_TAG_KEYS, project_tags, walkable_ways_query
+
+def _server_side_match(query, tags):
+    """Evaluates the way[...] tag filters of a query the way Overpass does."""
+    for key, op, pattern in re.findall(r'\["([^"]+)"(!?~)"([^"]+)"\]', query):
+        value = tags.get(key)
+        matches = value is not None and re.search(pattern, value) is not None
+        if op == "~" and not matches:
+            return False
+        if op == "!~" and matches:
+            return False
+    return True
+
+def test_query_matches_walkability_filter():
+    ingest = DataIngestion(use_cache=False)
+    query = walkable_ways_query("(33.0,-117.2,33.2,-117.0)", 60)
+    highways = [None, "footway", "primary", "primary_link", "motorway", "trunk", "service", "services", "building"]
+    for highway, access, foot in itertools.product(highways, [None, "yes", "no", "private"], [None, "designated", "no"]):
+        tags = {k: v for k, v in (("highway", highway), ("access", access), ("foot", foot)) if v is not None}
+        assert _server_side_match(query, tags) == ingest.is_walkable({"tags": tags}), tags
+
+def test_tags_are_projected():
+    el = {"type": "way", "id": 1, "tags": {"highway": "footway", "lit": "yes", "source": "survey", "tiger:cfcc": "A41"}}
+    assert project_tags(el)["tags"] == {"highway": "footway", "lit": "yes"}
+    assert el["tags"]["source"] == "survey"
+
+    walkable = list(DataIngestion(use_cache=False).iter_walkable([el]))
+    assert walkable[0]["tags"].keys() <= FEATURE_TAG_KEYS
+
+if __name__ == "__main__":
+    test_query_matches_walkability_filter()
+    test_tags_are_projected()
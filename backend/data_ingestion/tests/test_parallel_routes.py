@@ -0,0 +1,66 @@
+import gc
+
+from ..graph.graph_store import GraphStore
+from ..graph.snapshot import shared_snapshot_path
+from .graph_fixtures import default_graph_store, graph_files, grid_ways
+from ...routes import route_builder
+from ...routes.route_builder import _attached_graph, build_routes
+
+def _build(**kwargs):
+    return build_routes(33.004, -116.996, 300.0, 900.0, max_routes=10, max_attempts=600, return_scores=True, **kwargs)
+
+def test_seeded_runs_match_for_any_worker_count():
+    with default_graph_store():
+        for kwargs in ({}, {"score_tag": "lit"}, {"score_tag": "lit", "route_similarity_threshold": 0.5}):
+            serial = _build(seed=7, workers=1, **kwargs)
+            assert len(serial) == 10
+            assert _build(seed=7, workers=3, **kwargs) == serial
+            assert _build(seed=8, workers=1, **kwargs) != serial
+
+        # with few routes to find, tasks that find more make up for the others
+        # (a fixed share of max_routes per task found 594 here)
+        scarce = dict(min_distance_m=4000.0, max_distance_m=4200.0, max_routes=600, max_attempts=1000, seed=1)
+        assert len(build_routes(33.004, -116.996, **scarce)) == 600
+
+def test_shared_snapshot_is_removed_with_graph():
+    with graph_files() as (db_path, index_path):
+        graph = GraphStore(db_path, index_path, snapshot_path=None, spatial_index_path=None, landmarks_path=None).get()
+
+        path = shared_snapshot_path(graph)
+        assert shared_snapshot_path(graph) == path and path.exists()
+        del graph
+        gc.collect()
+        assert not path.exists()
+
+def test_attached_graphs_are_bounded_and_dropped_with_their_file():
+    with graph_files(grid_ways(4)) as (db_path, index_path):
+        graphs = [
+            GraphStore(db_path, index_path, snapshot_path=None, spatial_index_path=None, landmarks_path=None).get()
+            for _ in range(3)
+        ]
+        paths = [str(shared_snapshot_path(graph)) for graph in graphs]
+
+        attached = route_builder._attached_graphs
+        cache_size = route_builder.ATTACHED_GRAPH_CACHE_SIZE
+        saved = dict(attached)
+        attached.clear()
+        route_builder.ATTACHED_GRAPH_CACHE_SIZE = 2
+        try:
+            for path in paths:
+                _attached_graph(path)
+            # least recently used out first
+            assert list(attached) == paths[1:]
+            # a snapshot removed with its graph is let go of on the next use
+            del graphs[1]
+            gc.collect()
+            _attached_graph(paths[2])
+            assert list(attached) == paths[2:]
+        finally:
+            route_builder.ATTACHED_GRAPH_CACHE_SIZE = cache_size
+            attached.clear()
+            attached.update(saved)
+
+if __name__ == "__main__":
+    test_seeded_runs_match_for_any_worker_count()
+    test_shared_snapshot_is_removed_with_graph()
+    test_attached_graphs_are_bounded_and_dropped_with_their_file()
@@ -0,0 +1,115 @@
+import random
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from ..graph.graph_builder import build_graph_arrays
+from ..index.landmarks import LandmarkTable, distance_matrix, load_landmarks, save_landmarks
+from .graph_fixtures import default_graph_store, grid_ways
+from ...routes.point_to_point import PointToPointSearch, build_point_to_point_routes, edge_cost_factors
+from ...routes.route_builder import _route_edge_overlap_ratio
+
+def _cost_matrix(walk_graph, factors):
+    n = len(walk_graph.offsets) - 1
+    # parallel edges: keep the cheapest
+    costs = {}
+    for row, (u, v) in enumerate(zip(walk_graph.edge_src.tolist(), walk_graph.edge_dst.tolist())):
+        cost = float(walk_graph.distance_m[row]) * float(factors[row])
+        costs[u, v] = min(cost, costs.get((u, v), np.inf))
+    (us, vs), values = zip(*costs.keys()), list(costs.values())
+    return csr_matrix((values, (us, vs)), shape=(n, n))
+
+def test_astar_matches_dijkstra():
+    graph = build_graph_arrays(grid_ways(12)).to_compact_graph()
+    walk_graph = graph.contracted
+    junctions = np.flatnonzero(np.diff(walk_graph.offsets) > 0).tolist()
+    rng = random.Random(4)
+    for tags, tag_penalty in (((), 0.0), (("lit",), 2.0)):
+        factors = edge_cost_factors(walk_graph, tags=tags, tag_penalty=tag_penalty)
+        assert factors.min() >= 1.0
+        matrix = _cost_matrix(walk_graph, factors)
+        for _ in range(20):
+            source, target = rng.sample(junctions, 2)
+            search = PointToPointSearch(graph, factors, target)
+            rows, distance_m = search.shortest(source)
+            assert int(walk_graph.edge_src[rows[0]]) == source and int(walk_graph.edge_dst[rows[-1]]) == target
+            assert all(walk_graph.edge_dst[a] == walk_graph.edge_src[b] for a, b in zip(rows, rows[1:]))
+            cost = sum(float(walk_graph.distance_m[row]) * float(factors[row]) for row in rows)
+            expected = dijkstra(matrix, indices=source)[target]
+            assert abs(cost - expected) < 1e-3 * expected
+            assert np.isclose(distance_m, walk_graph.distance_m[rows].sum())
+            # the landmark bound never overestimates
+            assert search._bound(source) <= expected + 1e-3
+
+def test_landmarks_round_trip():
+    graph = build_graph_arrays(grid_ways(6)).to_compact_graph()
+    table = LandmarkTable.build(graph, num_landmarks=4)
+    assert len(table.landmarks) == 4 and len(set(table.landmarks.tolist())) == 4
+    expected = dijkstra(distance_matrix(graph.contracted), indices=int(table.landmarks[1]))
+    assert np.allclose(table.from_m[1][np.isfinite(expected)], expected[np.isfinite(expected)])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "landmarks.pkl"
+        save_landmarks(table, path)
+        assert load_landmarks(table.version, graph.num_nodes, path).landmarks.tolist() == table.landmarks.tolist()
+        assert load_landmarks(("other",), graph.num_nodes, path) is None
+
+        # concurrent first uses build one table, keyed on the DB signature only
+        arrays = build_graph_arrays(grid_ways(6))
+        graph = arrays.to_compact_graph(version=("db", "index", "snapshot"))
+        graph.landmarks_path = path
+        tables = []
+        threads = [threading.Thread(target=lambda: tables.append(graph.landmarks)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(built) for built in tables}) == 1 and tables[0].version == ("db",)
+        assert sorted(p.name for p in Path(tmp).iterdir()) == ["landmarks.pkl"]
+        saved = path.stat().st_mtime_ns, path.stat().st_ino
+        rebuilt = arrays.to_compact_graph(version=("db", "other index", "other snapshot"))
+        rebuilt.landmarks_path = path
+        assert rebuilt.landmarks.landmarks.tolist() == tables[0].landmarks.tolist()
+        assert (path.stat().st_mtime_ns, path.stat().st_ino) == saved
+
+def test_point_to_point_routes():
+    with default_graph_store() as store:
+        graph = store.get()
+        start, end = (33.0, -117.0), (33.0081, -116.9919)
+        routes = build_point_to_point_routes(*start, *end, max_routes=3, route_similarity_threshold=0.7)
+        assert len(routes) >= 2
+        first = routes[0]
+        nodes = graph.nodes
+        assert (nodes[first.node_ids[0]].lat, nodes[first.node_ids[0]].lon) == start
+        assert np.allclose((nodes[first.node_ids[-1]].lat, nodes[first.node_ids[-1]].lon), end)
+        # corner to corner of a 10 x 10 grid is 18 blocks whichever way
+        assert len(first.edge_ids) == 18
+        for i, route in enumerate(routes):
+            edges = [graph.edges[edge_id] for edge_id in route.edge_ids]
+            assert [edge.start_node for edge in edges] == list(route.node_ids[:-1])
+            assert [edge.end_node for edge in edges] == list(route.node_ids[1:])
+            assert route.distance_m <= 1.5 * first.distance_m
+            for kept in routes[:i]:
+                assert _route_edge_overlap_ratio(route.edge_ids, set(kept.edge_ids), graph) < 0.7
+
+        # with a penalty off lit streets the route keeps to them where it can
+        lit = graph.tag_mask(["lit"])
+        plain = build_point_to_point_routes(*start, *end, max_routes=1)[0]
+        scored = build_point_to_point_routes(
+            *start, *end, max_routes=1, score_tag="lit", tag_penalty=3.0, return_scores=True
+        )
+        (lit_route, lit_score), = scored
+        def lit_share(route):
+            rows = graph.edge_rows(route.edge_ids)
+            return graph.distance_m[rows][lit[rows]].sum() / route.distance_m
+        assert np.isclose(lit_score, lit_share(lit_route))
+        assert lit_share(lit_route) >= lit_share(plain)
+        assert build_point_to_point_routes(*start, *end, max_distance_m=100.0) == []
+
+if __name__ == "__main__":
+    test_astar_matches_dijkstra()
+    test_landmarks_round_trip()
+    test_point_to_point_routes()
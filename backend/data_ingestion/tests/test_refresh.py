@@ -0,0 +1,83 @@
+import copy
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.graph_builder import edge_id_for
+from ..graph.persist_data import load_compact_graph
+from ..importer import DataIngestion
+from ..index.inverted_index_builder import make_connection as idx_conn, load_feature_edge_ids
+from ..refresh import refresh_ways
+from ..stream import ingest_elements
+
+def _way(way_id, node_ids, highway, version=1, **extra_tags):
+    return {
+        "type": "way",
+        "id": way_id,
+        "version": version,
+        "timestamp": "2026-01-01T00:00:00Z",
+        "nodes": node_ids,
+        "geometry": [{"lat": 33.0 + 0.001 * n, "lon": -117.0} for n in node_ids],
+        "tags": {"highway": highway, **extra_tags},
+    }
+
+BEFORE = [
+    _way(10, [1, 2, 3], "footway", lit="yes"),
+    _way(11, [3, 4], "residential"),
+    _way(12, [4, 5, 6], "path"),
+    _way(13, [6, 7], "steps"),
+]
+
+def _after():
+    ways = copy.deepcopy(BEFORE)
+    # retagged with a new version
+    ways[1] = _way(11, [3, 4], "residential", version=2, lit="yes")
+    # member node moved, the way keeps its version
+    ways[3]["geometry"][1]["lat"] += 0.0005
+    # way 12 deleted, way 14 added
+    del ways[2]
+    ways.append(_way(14, [8, 9], "footway"))
+    return ways
+
+def _state(db_path, index_path):
+    graph = load_compact_graph(db_path)
+    conn = idx_conn(index_path)
+    features = {f: sorted(ids) for f, ids in load_feature_edge_ids(conn).items()}
+    conn.close()
+    return graph, features
+
+def test_refresh_matches_full_rebuild():
+    ingest = DataIngestion()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        index_path = Path(tmp) / "inverted_index.db"
+        ingest_elements(BEFORE, db_path, index_path, ingest=ingest)
+
+        counts = refresh_ways(_after(), db_path, index_path, batch_size=2, ingest=ingest)
+        assert counts == {"added": 1, "changed": 2, "unchanged": 1, "deleted": 1, "orphan_nodes": 1}
+
+        rebuilt_db = Path(tmp) / "rebuilt.db"
+        rebuilt_index = Path(tmp) / "rebuilt_index.db"
+        ingest_elements(_after(), rebuilt_db, rebuilt_index, ingest=ingest)
+
+        refreshed, refreshed_features = _state(db_path, index_path)
+        expected, expected_features = _state(rebuilt_db, rebuilt_index)
+        for name in ("node_ids", "lat", "lon", "offsets", "edge_ids", "edge_dst", "distance_m", "way_ids"):
+            assert np.array_equal(getattr(refreshed, name), getattr(expected, name))
+        assert refreshed_features == expected_features
+        assert refreshed.edges[edge_id_for(10, 1)].tags == {"highway": "footway", "lit": "yes"}
+
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT version FROM ways WHERE way_id = 11;").fetchone() == (2,)
+        assert conn.execute("SELECT COUNT(*) FROM node_rtree;").fetchone() == (refreshed.num_nodes,)
+        conn.close()
+
+        # nothing changed since the last refresh
+        counts = refresh_ways(_after(), db_path, index_path, ingest=ingest)
+        assert counts["unchanged"] == 4
+        assert counts["added"] == counts["changed"] == counts["deleted"] == 0
+
+if __name__ == "__main__":
+    test_refresh_matches_full_rebuild()
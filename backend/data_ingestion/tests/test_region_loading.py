@@ -0,0 +1,69 @@
+import sqlite3
+
+from config import Config
+from ..graph.graph_builder import _haversine_distance_m
+from ..graph.persist_data import load_subgraph, make_tables
+from .graph_fixtures import default_graph_store, temp_graph_store
+from ...routes.route_builder import MILES_TO_METERS, build_routes, routes_to_geojson
+
+# a 10 x 10 grid of two-way streets, about 100 m apart
+def test_subgraph_holds_edges_starting_in_radius():
+    with temp_graph_store() as store:
+        full = store.get()
+        lat, lon, radius_m = 33.004, -116.996, 250.0
+        region = load_subgraph(lat, lon, radius_m, db_path=store.db_path, index_path=store.index_path)
+
+        full_nodes = full.nodes
+        expected = {
+            edge_id for edge_id, edge in full.edges.items()
+            if _haversine_distance_m(lat, lon, full_nodes[edge.start_node].lat, full_nodes[edge.start_node].lon) <= radius_m
+        }
+        assert 0 < len(expected) < full.num_edges
+        assert set(region.edges) == expected
+
+        for edge_id in expected:
+            edge = region.edges[edge_id]
+            assert edge.end_node in region.nodes
+            assert edge.tags == full.edges[edge_id].tags
+
+        assert region.matching_edge_ids(["lit"]) == full.matching_edge_ids(["lit"]) & expected
+        assert len(region.spatial_index.query_radius(lat, lon, radius_m)) == \
+            len(full.spatial_index.query_radius(lat, lon, radius_m))
+
+def test_region_cache_and_rtree_rebuild():
+    with temp_graph_store() as store:
+        db_path, index_path = store.db_path, store.index_path
+        region = store.get_region(33.004, -116.996, 300.0, tile_m=500)
+        assert store.get_region(33.0041, -116.9961, 200.0, tile_m=500) is region
+        assert store.get_region(33.004, -116.996, 2000.0, tile_m=500) is not region
+
+        # a database from before the R*Tree gets its index filled on make_tables
+        conn = sqlite3.connect(db_path)
+        conn.execute("DELETE FROM node_rtree;")
+        conn.execute("DELETE FROM edge_rtree;")
+        conn.commit()
+        conn.close()
+        make_tables(db_path)
+        rebuilt = load_subgraph(33.004, -116.996, 250.0, db_path=db_path, index_path=index_path)
+        assert rebuilt.num_edges > 0
+
+def test_routes_come_with_the_region_they_were_walked_on():
+    with default_graph_store() as store:
+        region_mode = Config.GRAPH_REGION_MODE
+        Config.GRAPH_REGION_MODE = True
+        try:
+            routes, graph = build_routes(
+                33.004, -116.996, 300.0, 900.0, max_routes=5, max_start_distance_m=200.0, return_graph=True
+            )
+            assert routes and graph is store.get_region(33.004, -116.996, 200.0 + 900.0)
+            assert len(routes_to_geojson(routes, graph)["features"]) == len(routes)
+            # no start node can reach min_distance_m in this grid
+            routes, graph = build_routes(33.004, -116.996, 50000.0, 60000.0, return_graph=True)
+            assert routes == [] and graph is store.get_region(33.004, -116.996, MILES_TO_METERS + 60000.0)
+        finally:
+            Config.GRAPH_REGION_MODE = region_mode
+
+if __name__ == "__main__":
+    test_subgraph_holds_edges_starting_in_radius()
+    test_region_cache_and_rtree_rebuild()
+    test_routes_come_with_the_region_they_were_walked_on()
@@ -0,0 +1,172 @@
+import random
+
+from ..graph.edge import Edge
+from ..graph.graph_builder import build_graph_arrays
+from ...routes.profile_search import ProfileSearch
+from ...routes.route_builder import Route, score_routes_for_user_profile
+from ...routes.route_features import FeatureValues, RouteFeatureBatch, RouteFeatures
+from ...users.user_profile import UserProfile
+
+def _profile(**overrides):
+    values = dict(
+        user_id="test",
+        current_steps=500,
+        step_goal=3000,
+        step_length_m=0.7,
+        requires_wheelchair=False,
+        avoid_steps=False,
+        min_length_m=None,
+        max_length_m=None,
+        max_difficulty=0.4,
+        bringing_dog=False,
+        accessibility_weight=0.8,
+        urban_weight=1.0,
+        difficulty_weight=0.5,
+        safety_weight=1.1,
+        step_goal_weight=1.0,
+    )
+    values.update(overrides)
+    return UserProfile(**values)
+
+PROFILES = [
+    _profile(),
+    _profile(requires_wheelchair=True),
+    _profile(avoid_steps=True, max_difficulty=None),
+    _profile(step_goal=None),
+    _profile(current_steps=5000),
+]
+
+def _random_features(rng):
+    return RouteFeatures(
+        length_m=rng.uniform(100, 6000),
+        sidewalk_ratio=rng.random(),
+        lit_ratio=rng.random(),
+        residential_ratio=rng.random(),
+        major_road_ratio=rng.random(),
+        trail_ratio=rng.random(),
+        paved_ratio=rng.random(),
+        rough_surface_ratio=rng.random(),
+        accessible_ratio=rng.random(),
+        steps_ratio=rng.choice([0.0, rng.random() * 0.1]),
+        dog_friendly_ratio=rng.random(),
+        avg_incline=rng.choice([None, 0.0, rng.uniform(-0.1, 0.1)]),
+    )
+
+def test_batch_scores_match_scalar():
+    rng = random.Random(7)
+    features = [_random_features(rng) for _ in range(300)]
+    batch = RouteFeatureBatch.from_features(features)
+    assert [batch[i] for i in range(len(batch))] == features
+
+    for name in ("urban_score", "accessibility_score", "difficulty_score", "safety_score"):
+        assert getattr(batch, name).tolist() == [getattr(f, name) for f in features]
+    for profile in PROFILES:
+        assert profile.score_batch(batch).tolist() == [profile.score(f) for f in features]
+        assert profile.allowed_batch(batch).tolist() == [profile.allowed(f) for f in features]
+
+def test_rank_matches_sort():
+    rng = random.Random(3)
+    # repeated features give tied scores
+    features = [_random_features(rng) for _ in range(40)] * 3
+    rng.shuffle(features)
+    batch = RouteFeatureBatch.from_features(features)
+
+    for profile in PROFILES:
+        scored = [(i, profile.score(f), profile.allowed(f)) for i, f in enumerate(features)]
+        expected = sorted((s for s in scored if s[2]), key=lambda s: s[1], reverse=True)
+        expected += sorted((s for s in scored if not s[2]), key=lambda s: s[1], reverse=True)
+        expected = [i for i, _, _ in expected]
+
+        for k in (None, 0, 1, 7, 60, 200):
+            indices, scores = profile.rank_batch(batch, k=k)
+            assert indices.tolist() == expected[:k]
+            assert scores.tolist() == [profile.score(features[i]) for i in expected[:k]]
+
+def test_disallowed_repeats_listed_once():
+    edges = {
+        10: Edge(10, None, None, 100.0, 1, {"highway": "steps"}),
+        11: Edge(11, None, None, 100.0, 2, {"highway": "footway"}),
+    }
+    stairs = Route(node_ids=[1, 2], edge_ids=[10], distance_m=100.0)
+    path = Route(node_ids=[2, 3], edge_ids=[11], distance_m=100.0)
+    routes = [stairs, path, stairs, path, stairs]
+
+    scored = score_routes_for_user_profile(routes, _profile(), edges=edges)
+    assert len(scored) == 5
+    scored = score_routes_for_user_profile(routes, _profile(avoid_steps=True), edges=edges)
+    assert [route for route, _ in scored] == [path, path, stairs]
+    scored = score_routes_for_user_profile(routes, _profile(avoid_steps=True), edges=edges, top_k=1)
+    assert [route for route, _ in scored] == [path]
+
+def test_score_upper_bound_is_sound():
+    rng = random.Random(11)
+    for _ in range(300):
+        a, b = _random_features(rng), _random_features(rng)
+        pairs = [(getattr(a, name), getattr(b, name)) for name in vars(a)]
+        # incline bounds are on its absolute value
+        pairs[-1] = tuple(abs(incline or 0.0) for incline in pairs[-1])
+        low = FeatureValues(*(min(pair) for pair in pairs))
+        high = FeatureValues(*(max(pair) for pair in pairs))
+        inside = RouteFeatures(*(rng.uniform(*sorted(pair)) for pair in pairs))
+        for profile in PROFILES:
+            assert profile.score_upper_bound(low, high) >= profile.score(inside) - 1e-12
+            if profile.allowed(inside):
+                assert profile.might_be_allowed(low, high)
+
+def _walk(search, graph, rows):
+    search.reset()
+    distance_m = 0.0
+    for row in rows:
+        search.add_edge(row, float(graph.distance_m[row]))
+        distance_m += float(graph.distance_m[row])
+    return distance_m
+
+def test_profile_search_keeps_top_k_and_prunes():
+    ways = [
+        {
+            "id": way_id,
+            "nodes": [10 * way_id + n for n in range(3)],
+            "geometry": [{"lat": 33.0 + 0.001 * n, "lon": -117.0 + 0.001 * way_id} for n in range(3)],
+            "tags": tags,
+        }
+        for way_id, tags in (
+            (1, {"highway": "footway", "surface": "asphalt", "lit": "yes"}),
+            (2, {"highway": "footway", "surface": "asphalt"}),
+            (3, {"highway": "steps"}),
+        )
+    ]
+    graph = build_graph_arrays({"elements": ways}).to_compact_graph()
+    rows = {way_id: [row for row in range(graph.num_edges) if graph.way_ids[row] == way_id] for way_id in (1, 2, 3)}
+    profile = _profile(requires_wheelchair=True, avoid_steps=True, step_goal=None, step_goal_weight=0.0)
+    search = ProfileSearch(graph, profile, k=2)
+
+    routes = {}
+    for way_id in (1, 2, 3, 1):
+        distance_m = _walk(search, graph, rows[way_id])
+        routes[way_id] = Route(node_ids=[10 * way_id + n for n in range(3)], edge_ids=graph.edge_ids[rows[way_id]].tolist(), distance_m=distance_m)
+        search.offer(routes[way_id])
+    assert search.num_finished == 4
+    ranked = search.ranked()
+    # the lit footway scores higher, the steps are not allowed, the repeat is ignored
+    assert [route for route, _ in ranked] == [routes[1], routes[2]]
+
+    # with the heap full of allowed routes, a walk on steps is hopeless right away
+    distance_m = _walk(search, graph, rows[3][:1])
+    assert search.hopeless(distance_m, 300.0, 400.0)
+    # a walk that could still be anything is not
+    distance_m = _walk(search, graph, rows[1][:1])
+    assert not search.hopeless(distance_m, 300.0, 5000.0)
+    # one that cannot become as good as the worst route kept is, but only then
+    search = ProfileSearch(graph, profile, k=1)
+    _walk(search, graph, rows[1])
+    search.offer(routes[1])
+    distance_m = _walk(search, graph, rows[2])
+    assert search.hopeless(distance_m, distance_m, distance_m + 1.0)
+    assert not search.hopeless(distance_m, distance_m, distance_m * 3)
+
+if __name__ == "__main__":
+    test_batch_scores_match_scalar()
+    test_rank_matches_sort()
+    test_disallowed_repeats_listed_once()
+    test_score_upper_bound_is_sound()
+    test_profile_search_keeps_top_k_and_prunes()
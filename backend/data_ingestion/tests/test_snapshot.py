@@ -0,0 +1,61 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.compact_graph import CompactGraph
+from ..graph.graph_builder import build_graph, edge_id_for
+from ..graph.graph_store import GraphStore
+from ..graph.snapshot import SnapshotError, open_snapshot, write_snapshot
+from .graph_fixtures import graph_files
+from .test_graph_store import WAYS
+
+def test_snapshot_round_trip():
+    nodes, edges = build_graph(WAYS)
+    e1, e2 = edge_id_for(1, 0), edge_id_for(1, 1)
+    graph = CompactGraph.from_objects(nodes, edges, feature_edge_ids={"lit": [e1, e2], "footway": [e2]})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_snapshot(graph, Path(tmp) / "graph.snapshot")
+        mapped = open_snapshot(path, verify=True)
+
+        for name in ("node_ids", "lat", "lon", "offsets", "edge_ids", "edge_dst", "distance_m"):
+            assert np.array_equal(getattr(mapped, name), getattr(graph, name))
+        assert mapped.edges[e2].tags == edges[e2].tags
+        assert mapped.matching_edge_ids(["lit"]) == {e1, e2}
+        assert mapped.matching_edge_ids(["footway"]) == {e2}
+        assert not mapped.distance_m.flags.writeable
+
+def test_corrupt_snapshot_is_rejected():
+    nodes, edges = build_graph(WAYS)
+    graph = CompactGraph.from_objects(nodes, edges)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_snapshot(graph, Path(tmp) / "graph.snapshot")
+        data = bytearray(path.read_bytes())
+        data[-1] ^= 0xFF
+        path.write_bytes(bytes(data))
+
+        try:
+            open_snapshot(path, verify=True)
+        except SnapshotError:
+            pass
+        else:
+            raise AssertionError("corrupt snapshot was accepted")
+
+def test_store_prefers_current_snapshot():
+    with graph_files(WAYS) as (db_path, index_path):
+        snapshot_path = db_path.with_name("walk_graph.snapshot")
+        store = GraphStore(
+            db_path, index_path, snapshot_path=snapshot_path, spatial_index_path=None, landmarks_path=None
+        )
+        write_snapshot(store.get(), snapshot_path, db_path=db_path, index_path=index_path)
+
+        graph = store.get()
+        assert hasattr(graph, "_mmap")
+        assert graph.matching_edge_ids(["lit"]) == set(graph.edges)
+
+if __name__ == "__main__":
+    test_snapshot_round_trip()
+    test_corrupt_snapshot_is_rejected()
+    test_store_prefers_current_snapshot()
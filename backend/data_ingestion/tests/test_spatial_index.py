@@ -0,0 +1,90 @@
+import random
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.graph_builder import _haversine_distance_m, build_graph_arrays
+from ..index.spatial import SpatialIndex, save_spatial_index, load_spatial_index
+from .graph_fixtures import grid_ways
+
+def _random_points(n=500, seed=7):
+    rng = random.Random(seed)
+    lat = np.array([33.6 + rng.random() * 0.1 for _ in range(n)])
+    lon = np.array([-117.9 + rng.random() * 0.1 for _ in range(n)])
+    return lat, lon
+
+def test_radius_matches_brute_force():
+    lat, lon = _random_points()
+    index = SpatialIndex(lat, lon)
+
+    center = (33.65, -117.85)
+    expected = [
+        i for i in range(len(lat))
+        if _haversine_distance_m(center[0], center[1], lat[i], lon[i]) <= 1500.0
+    ]
+    assert index.query_radius(center[0], center[1], 1500.0).tolist() == expected
+
+def test_knn_matches_brute_force():
+    lat, lon = _random_points()
+    index = SpatialIndex(lat, lon)
+
+    distances = [_haversine_distance_m(33.65, -117.85, lat[i], lon[i]) for i in range(len(lat))]
+    indices, distances_m = index.query_knn(33.65, -117.85, 5)
+    assert indices.tolist() == sorted(range(len(lat)), key=distances.__getitem__)[:5]
+    assert abs(distances_m[0] - min(distances)) < 1e-6
+
+def test_persisted_index_is_keyed_on_version():
+    lat, lon = _random_points()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "spatial_index.pkl"
+        save_spatial_index(SpatialIndex(lat, lon, version=("v1",)), path)
+
+        assert load_spatial_index(("v1",), len(lat), path) is not None
+        assert load_spatial_index(("v2",), len(lat), path) is None
+
+def test_concurrent_saves_and_builds():
+    lat, lon = _random_points()
+    index = SpatialIndex(lat, lon, version=("v1",))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "spatial_index.pkl"
+        errors = []
+        def save():
+            try:
+                save_spatial_index(index, path)
+            except Exception as e:
+                errors.append(e)
+        for _ in range(5):
+            threads = [threading.Thread(target=save) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert not errors
+        assert [p.name for p in Path(tmp).iterdir()] == ["spatial_index.pkl"]
+
+        # one graph, many first requests: built once, keyed on the DB signature only
+        arrays = build_graph_arrays(grid_ways(6))
+        graph = arrays.to_compact_graph(version=("db", "index", "snapshot"))
+        graph.spatial_index_path = path
+        indexes = []
+        threads = [threading.Thread(target=lambda: indexes.append(graph.spatial_index)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(built) for built in indexes}) == 1
+        # a rebuilt tag index or snapshot reuses the persisted index
+        assert load_spatial_index(("db",), graph.num_nodes, path) is not None
+        saved = path.stat().st_mtime_ns, path.stat().st_ino
+        rebuilt = arrays.to_compact_graph(version=("db", "other index", "other snapshot"))
+        rebuilt.spatial_index_path = path
+        assert rebuilt.spatial_index.version == ("db",)
+        assert (path.stat().st_mtime_ns, path.stat().st_ino) == saved
+
+if __name__ == "__main__":
+    test_radius_matches_brute_force()
+    test_knn_matches_brute_force()
+    test_persisted_index_is_keyed_on_version()
+    test_concurrent_saves_and_builds()
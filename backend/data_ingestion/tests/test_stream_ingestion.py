@@ -0,0 +1,75 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ..graph.graph_builder import build_graph_arrays
+from ..graph.persist_data import load_compact_graph
+from ..importer import DataIngestion
+from ..stream import ingest_elements, iter_overpass_elements, iter_overpass_file
+
+def _way(way_id, node_ids, highway, **extra_tags):
+    return {
+        "type": "way",
+        "id": way_id,
+        "nodes": node_ids,
+        "geometry": [{"lat": 33.0 + 0.001 * n, "lon": -117.0 - 0.0005 * (n % 7)} for n in node_ids],
+        "tags": {"highway": highway, "name": "Café Row", **extra_tags},
+    }
+
+RESPONSE = {
+    "version": 0.6,
+    "generator": "Overpass API",
+    "osm3s": {"timestamp_osm_base": "2026-01-01T00:00:00Z", "copyright": "OpenStreetMap contributors"},
+    "elements": [
+        _way(1, [1, 2, 3], "footway", lit="yes"),
+        _way(2, [3, 4], "motorway"),
+        _way(3, [4, 5, 6, 7], "residential", sidewalk="both"),
+        _way(4, [7, 8], "footway", access="private"),
+        _way(5, [7, 1], "path", incline="5%"),
+        _way(6, [2, 9, 10], "steps"),
+    ],
+    "remark": "",
+}
+
+def test_elements_stream_in_small_reads():
+    raw = json.dumps(RESPONSE, indent=1, ensure_ascii=False).encode("utf-8")
+    # read sizes that split keys, numbers and the multi-byte character
+    for read_size in (1, 3, 7, 64, 1 << 16):
+        assert list(iter_overpass_elements(io.BytesIO(raw), read_size)) == RESPONSE["elements"]
+
+    assert list(iter_overpass_elements(io.StringIO('{"elements": []}'))) == []
+    assert list(iter_overpass_elements(io.StringIO("{}"))) == []
+
+    truncated = raw[:len(raw) // 2]
+    try:
+        list(iter_overpass_elements(io.BytesIO(truncated), 16))
+    except ValueError:
+        pass
+    else:
+        assert False, "a truncated response must not pass silently"
+
+def test_saved_response_ingests_like_whole_build():
+    ingest = DataIngestion()
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = Path(tmp) / "overpass.json"
+        saved.write_text(json.dumps(RESPONSE), encoding="utf-8")
+
+        db_path = Path(tmp) / "walk_routes.db"
+        index_path = Path(tmp) / "inverted_index.db"
+        counts = ingest_elements(iter_overpass_file(saved, 32), db_path, index_path, batch_size=2, ingest=ingest)
+
+        expected = build_graph_arrays(ingest.filter_for_walkability(RESPONSE)).to_compact_graph()
+        assert counts == {"ways": 4, "edges": expected.num_edges, "nodes": expected.num_nodes}
+
+        loaded = load_compact_graph(db_path)
+        for name in ("node_ids", "lat", "lon", "offsets", "edge_ids", "edge_dst", "distance_m", "way_ids"):
+            assert np.array_equal(getattr(loaded, name), getattr(expected, name))
+        assert [loaded.edge_tags(row) for row in range(loaded.num_edges)] == \
+            [expected.edge_tags(row) for row in range(expected.num_edges)]
+
+if __name__ == "__main__":
+    test_elements_stream_in_small_reads()
+    test_saved_response_ingests_like_whole_build()
@@ -0,0 +1,58 @@
+import json
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from ..graph.graph_builder import build_graph
+from ..graph.persist_data import (make_tables, insert_nodes, insert_edges, load_edges,
+                                  load_compact_graph)
+from .test_graph_store import WAYS
+
+def test_ways_share_one_tag_set():
+    nodes, edges = build_graph(WAYS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        make_tables(db_path)
+        insert_nodes(nodes, db_path)
+        insert_edges(edges, db_path)
+        # inserting again must not duplicate strings or tag sets
+        insert_edges(edges, db_path)
+
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT COUNT(*) FROM ways").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(DISTINCT tag_set_id) FROM tag_set_items").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM tag_strings").fetchone()[0] == 4
+        conn.close()
+
+        loaded = load_edges(db_path)
+        first, second = loaded.values()
+        assert first.tags == {"highway": "footway", "lit": "yes"}
+        assert first.tags is second.tags
+
+        graph = load_compact_graph(db_path)
+        assert graph.edges[first.edge_id].tags is graph.edges[second.edge_id].tags
+
+def test_legacy_edge_tags_are_migrated():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "walk_routes.db"
+        conn = sqlite3.connect(db_path)
+        conn.execute("""CREATE TABLE edges (edge_id INTEGER PRIMARY KEY, start_node INTEGER NOT NULL,
+                        end_node INTEGER NOT NULL, distance_m REAL NOT NULL DEFAULT 0.0,
+                        way_id INTEGER NOT NULL, tags TEXT NOT NULL);""")
+        conn.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?)", [
+            (1, 100, 101, 10.0, 7, json.dumps({"highway": "steps"})),
+            (2, 101, 102, 12.0, 7, json.dumps({"highway": "steps"})),
+        ])
+        conn.commit()
+        conn.close()
+
+        make_tables(db_path)
+
+        loaded = load_edges(db_path)
+        assert loaded[2].tags == {"highway": "steps"}
+        assert loaded[1].tags is loaded[2].tags
+
+if __name__ == "__main__":
+    test_ways_share_one_tag_set()
+    test_legacy_edge_tags_are_migrated()
@@ -0,0 +1,120 @@
+import json
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from ..importer import DataIngestion, OverpassFetchError, split_bbox
+
+BBOX = (33.0, -117.2, 33.2, -117.0)
+
+# a way every 0.02 degrees of latitude, each spanning 0.04 degrees of longitude
+WAYS = [
+    {
+        "type": "way",
+        "id": i + 1,
+        "nodes": [2 * i + 1, 2 * i + 2],
+        "geometry": [{"lat": 33.01 + 0.02 * (i // 5), "lon": -117.19 + 0.04 * (i % 5)},
+                     {"lat": 33.01 + 0.02 * (i // 5), "lon": -117.15 + 0.04 * (i % 5)}],
+        "tags": {"highway": "footway"},
+    }
+    for i in range(50)
+]
+
+class OverpassStandIn(BaseHTTPRequestHandler):
+    """Answers way(s,w,n,e) queries from WAYS; see the server attributes for injected failures."""
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        query = parse_qs(body)["data"][0]
+        south, west, north, east = map(float, re.search(
+            r"\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)", query).groups())
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            rate_limited = server.rate_limited > 0
+            server.rate_limited -= 1
+        if rate_limited:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        if server.broken_south is not None and south == server.broken_south:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        elements = [
+            way for way in WAYS
+            if any(south <= p["lat"] <= north and west <= p["lon"] <= east for p in way["geometry"])
+        ]
+        payload = json.dumps({"version": 0.6, "elements": elements}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def _serve():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassStandIn)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.rate_limited = 0
+    server.broken_south = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _ingest(server, cache=None):
+    ingest = DataIngestion(cache=cache, use_cache=cache is not None)
+    ingest.overpass_url = f"http://127.0.0.1:{server.server_address[1]}/api/interpreter"
+    return ingest
+
+def test_split_bbox_covers_box():
+    tiles = split_bbox(BBOX, 0.05)
+    assert len(tiles) == 16
+    assert min(t[0] for t in tiles) == 33.0 and max(t[2] for t in tiles) == 33.2
+    assert split_bbox(BBOX, 1.0) == [BBOX]
+
+def test_tiles_are_deduped_and_retried():
+    server = _serve()
+    try:
+        server.rate_limited = 3
+        with tempfile.TemporaryDirectory() as tmp:
+            elements = list(_ingest(server).fetch_tiled(
+                BBOX, tile_deg=0.05, max_workers=4, backoff_s=0.01, checkpoint_dir=Path(tmp)))
+        # ways crossing tile borders come back from several tiles
+        assert sorted(el["id"] for el in elements) == [way["id"] for way in WAYS]
+        assert server.requests == 16 + 3
+    finally:
+        server.shutdown()
+
+def test_failed_run_resumes():
+    server = _serve()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            server.broken_south = 33.1
+            try:
+                _ingest(server).fetch_tiled(BBOX, tile_deg=0.1, max_retries=1, backoff_s=0.01, checkpoint_dir=Path(tmp))
+            except OverpassFetchError:
+                pass
+            else:
+                assert False, "a tile that keeps failing must fail the fetch"
+            assert len(list(Path(tmp).glob("tile_*.json"))) == 2
+
+            server.broken_south = None
+            server.requests = 0
+            elements = list(_ingest(server).fetch_tiled(BBOX, tile_deg=0.1, checkpoint_dir=Path(tmp)))
+            assert server.requests == 2
+            assert len(elements) == len(WAYS)
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_split_bbox_covers_box()
+    test_tiles_are_deduped_and_retried()
+    test_failed_run_resumes()
@@ -0,0 +1,273 @@
+import random
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+from .edge_sampler import MAX_REJECTIONS, StaticEdgeWeights
+from .route_builder import Route, _final_partial_hop, _route_from_rows, _select_next_edge
+from ..data_ingestion.graph.compact_graph import CompactGraph
+from ..data_ingestion.graph.contraction import ContractedGraph
+
+'''
+Lockstep random walks for build_routes.
+
+_build_route_from_start takes one walk one hop at a time. BatchWalker advances
+a whole batch of walks together: every live walk has taken the same number of
+hops, so current node, distance so far, target distance and the edges and nodes
+walked so far are arrays with one row per live walk, and each hop is a handful
+of array operations over all of them. Walks that reach their target or dead-end
+are retired and dropped from the arrays.
+
+next_edges is EdgeSampler.next_edge over all live walks at once: a proposal is
+drawn from the static cumulative weights inside each walk's CSR block and
+accepted against the same per-hop bound. A walk's visited edges are the row of
+its own edge history; comparing a proposal against it costs O(hops) per walk
+where a bitset over all edges of a county graph would cost far more memory than
+the walks themselves. Near the target, where the closeness scale depends on
+which out-edges are still viable, the scale is reduced over each walk's CSR
+block. Walks still rejected after MAX_REJECTIONS rounds go to _select_next_edge
+one by one, so the sampled distribution stays exact.
+'''
+
+# columns of edge history allocated at once, doubled when the walks get longer
+HISTORY_CHUNK = 32
+
+class BatchWalker:
+    """_build_route_from_start for a batch of walks, in lockstep."""
+
+    def __init__(
+        self,
+        walk_graph: Union[CompactGraph, ContractedGraph],
+        weights: StaticEdgeWeights,
+        distance_bias: float = 0.0,
+        edge_reuse_penalty: float = 0.0,
+        allow_edge_reuse: bool = False,
+    ):
+        self.graph = walk_graph
+        self.weights = weights
+        self.distance_bias = distance_bias
+        self.edge_reuse_penalty = edge_reuse_penalty
+        self.allow_edge_reuse = allow_edge_reuse
+        self.num_fallbacks = 0
+        self._offsets = np.asarray(walk_graph.offsets, dtype=np.int64)
+        self._distance_m = np.asarray(walk_graph.distance_m, dtype=np.float64)
+        self._edge_dst = np.asarray(walk_graph.edge_dst, dtype=np.int64)
+
+    def _viable_distance_scale_m(
+        self,
+        walks: np.ndarray,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        remaining_distance_m: np.ndarray,
+        edge_history: np.ndarray,
+    ) -> np.ndarray:
+        """max(longest viable out-edge, 1) of each of walks, as _select_next_edge normalizes closeness."""
+        degree = stops[walks] - starts[walks]
+        first = np.zeros(len(walks), dtype=np.int64)
+        np.cumsum(degree[:-1], out=first[1:])
+        owner = np.repeat(walks, degree)
+        rows = np.arange(degree.sum()) - np.repeat(first, degree) + np.repeat(starts[walks], degree)
+        edge_distance_m = self._distance_m[rows]
+        viable = edge_distance_m <= remaining_distance_m[owner]
+        if not self.allow_edge_reuse:
+            viable &= ~(edge_history[owner] == rows[:, None]).any(axis=1)
+        max_viable_distance_m = np.maximum.reduceat(np.where(viable, edge_distance_m, 1.0), first)
+        return np.maximum(max_viable_distance_m, 1.0)
+
+    def next_edges(
+        self,
+        node_indices: np.ndarray,
+        remaining_distance_m: np.ndarray,
+        remaining_target_distance_m: np.ndarray,
+        edge_history: np.ndarray,
+        node_history: np.ndarray,
+        rng=random,
+        generator: Optional[np.random.Generator] = None,
+    ) -> np.ndarray:
+        """
+        The next edge row of every walk, -1 where no edge fits. edge_history holds
+        the rows each walk has taken so far, node_history the nodes it has left
+        through them.
+        """
+        if generator is None:
+            generator = np.random.default_rng(rng.getrandbits(64))
+        weights = self.weights
+        starts = self._offsets[node_indices]
+        stops = self._offsets[node_indices + 1]
+        choice = np.full(len(node_indices), -1, dtype=np.int64)
+        check_visits = not self.allow_edge_reuse
+        penalize = self.edge_reuse_penalty > 0
+
+        pending = np.flatnonzero(starts < stops)
+        distance_bias = np.zeros(len(node_indices))
+        target_m = np.maximum(remaining_target_distance_m, 0.0)
+        distance_scale_m = np.ones(len(node_indices))
+        bound = np.ones(len(node_indices))
+        if self.distance_bias > 0 and len(pending):
+            node_max_distance_m = weights.node_max_distance_m[node_indices[pending]]
+            scale_m = np.maximum(node_max_distance_m, 1.0)
+            # the longest out-edge bounds the scale; twice that short of the target
+            # closeness is 0 for every edge whatever the exact scale, and while the
+            # longest edge is viable it is the exact scale
+            node_visited = (node_history[pending] == node_indices[pending, None]).any(axis=1)
+            viable = node_max_distance_m <= remaining_distance_m[pending]
+            if check_visits:
+                viable &= ~node_visited
+            slow = np.flatnonzero((target_m[pending] < 2.0 * scale_m) & ~viable)
+            if len(slow):
+                scale_m[slow] = self._viable_distance_scale_m(
+                    pending[slow], starts, stops, remaining_distance_m, edge_history
+                )
+            closeness_bound = 1.0 - np.minimum(np.maximum(target_m[pending] - scale_m, 0.0) / scale_m, 1.0)
+            distance_scale_m[pending] = scale_m
+            distance_bias[pending] = self.distance_bias * (closeness_bound > 0)
+            bound[pending] = 1.0 + distance_bias[pending] * closeness_bound
+
+        cumulative = weights.cumulative
+        for _ in range(MAX_REJECTIONS):
+            if not len(pending):
+                break
+            start = starts[pending]
+            stop = stops[pending]
+            low = cumulative[start]
+            draws = low + generator.random(len(pending)) * (cumulative[stop] - low)
+            rows = np.clip(np.searchsorted(cumulative, draws, side="right") - 1, start, stop - 1)
+            edge_distance_m = self._distance_m[rows]
+            visits = (edge_history[pending] == rows[:, None]).sum(axis=1)
+            ok = edge_distance_m <= remaining_distance_m[pending]
+            if check_visits:
+                ok &= visits == 0
+
+            static_weight = weights.static_weight[rows]
+            weight = static_weight.copy()
+            walk_bias = distance_bias[pending]
+            if walk_bias.any():
+                distance_delta = np.abs(edge_distance_m - target_m[pending])
+                weight += walk_bias * (1.0 - np.minimum(distance_delta / distance_scale_m[pending], 1.0))
+            if penalize:
+                weight /= 1.0 + self.edge_reuse_penalty * visits
+            accepted = ok & (
+                generator.random(len(pending)) * static_weight * bound[pending] < np.maximum(weight, 0.0001)
+            )
+            choice[pending[accepted]] = rows[accepted]
+            pending = pending[~accepted]
+
+        self.num_fallbacks += len(pending)
+        for walk in pending.tolist():
+            edge_visit_counts: Dict[int, int] = {}
+            for row in edge_history[walk].tolist():
+                if row >= 0:
+                    edge_visit_counts[row] = edge_visit_counts.get(row, 0) + 1
+            row = _select_next_edge(
+                range(int(starts[walk]), int(stops[walk])),
+                self.graph,
+                float(remaining_distance_m[walk]),
+                remaining_target_distance_m=float(remaining_target_distance_m[walk]),
+                matching_mask=weights.matching_mask,
+                tag_bias=weights.tag_bias,
+                distance_bias=self.distance_bias,
+                edge_visit_counts=edge_visit_counts,
+                edge_reuse_penalty=self.edge_reuse_penalty,
+                allow_edge_reuse=self.allow_edge_reuse,
+                rng=rng,
+            )
+            if row is not None:
+                choice[walk] = row
+        return choice
+
+    def _finish(
+        self,
+        node_indices: List[int],
+        walk_rows: List[int],
+        distance_m: float,
+        profile_search=None,
+        last_members: Optional[int] = None,
+        last_distance_m: Optional[float] = None,
+    ) -> Route:
+        """The Route of a finished walk, offered to profile_search; last_members as in _route_from_rows."""
+        route = _route_from_rows(self.graph, node_indices, walk_rows, distance_m, last_members)
+        if profile_search is not None:
+            profile_search.reset()
+            for row in walk_rows[:-1]:
+                profile_search.add_edge(row, float(self._distance_m[row]))
+            last_row = walk_rows[-1]
+            if last_distance_m is None:
+                last_distance_m = float(self._distance_m[last_row])
+            profile_search.add_edge(last_row, last_distance_m, last_members)
+            profile_search.offer(route)
+        return route
+
+    def walk(
+        self,
+        start_node_indices: Sequence[int],
+        min_distance_m: float,
+        max_distance_m: float,
+        max_steps: int,
+        profile_search=None,
+        rng=random,
+    ) -> List[Optional[Route]]:
+        """One walk per start node, the Route it found (or None) in start order."""
+        generator = np.random.default_rng(rng.getrandbits(64))
+        num_walks = len(start_node_indices)
+        results: List[Optional[Route]] = [None] * num_walks
+
+        walk_ids = np.arange(num_walks)
+        node = np.asarray(start_node_indices, dtype=np.int64)
+        distance_m = np.zeros(num_walks)
+        target_distance_m = generator.uniform(min_distance_m, max_distance_m, num_walks)
+        # -1 marks columns a walk has not reached yet
+        edge_history = np.full((num_walks, HISTORY_CHUNK), -1, dtype=np.int64)
+        node_history = np.full((num_walks, HISTORY_CHUNK + 1), -1, dtype=np.int64)
+        node_history[:, 0] = node
+
+        for hop in range(1, max_steps + 1):
+            if not len(walk_ids):
+                break
+            if hop > edge_history.shape[1]:
+                edge_history = np.pad(edge_history, ((0, 0), (0, edge_history.shape[1])), constant_values=-1)
+                node_history = np.pad(node_history, ((0, 0), (0, node_history.shape[1] - 1)), constant_values=-1)
+            rows = self.next_edges(
+                node,
+                max_distance_m - distance_m,
+                target_distance_m - distance_m,
+                edge_history[:, :hop - 1],
+                node_history[:, :hop - 1],
+                rng=rng,
+                generator=generator,
+            )
+            moved = rows >= 0
+            # walks no chain fits whole end partway along one, as _build_route_from_start does
+            for i in np.flatnonzero(~moved).tolist():
+                walk_rows = edge_history[i, :hop - 1].tolist()
+                partial_hop = _final_partial_hop(
+                    self.graph, int(node[i]), float(distance_m[i]), float(target_distance_m[i]), max_distance_m,
+                    set(walk_rows), allow_edge_reuse=self.allow_edge_reuse, rng=rng,
+                )
+                if partial_hop is not None:
+                    row, last_members, prefix_m = partial_hop
+                    results[int(walk_ids[i])] = self._finish(
+                        node_history[i, :hop].tolist(), walk_rows + [row], float(distance_m[i]) + prefix_m,
+                        profile_search, last_members, prefix_m,
+                    )
+            walk_ids, node, distance_m, target_distance_m = (
+                walk_ids[moved], node[moved], distance_m[moved], target_distance_m[moved]
+            )
+            rows, edge_history, node_history = rows[moved], edge_history[moved], node_history[moved]
+
+            edge_history[:, hop - 1] = rows
+            distance_m += self._distance_m[rows]
+            node = self._edge_dst[rows]
+            node_history[:, hop] = node
+
+            finished = distance_m >= target_distance_m
+            for i in np.flatnonzero(finished).tolist():
+                results[int(walk_ids[i])] = self._finish(
+                    node_history[i, :hop + 1].tolist(), edge_history[i, :hop].tolist(), float(distance_m[i]),
+                    profile_search,
+                )
+            live = ~finished
+            walk_ids, node, distance_m, target_distance_m = (
+                walk_ids[live], node[live], distance_m[live], target_distance_m[live]
+            )
+            edge_history, node_history = edge_history[live], node_history[live]
+        return results
@@ -0,0 +1,226 @@
+import random
+import threading
+import weakref
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set, Union
+
+import numpy as np
+
+from .route_builder import _select_next_edge
+from ..data_ingestion.graph.compact_graph import CompactGraph, TAG_MASK_CACHE_SIZE
+from ..data_ingestion.graph.contraction import ContractedGraph
+
+'''
+Per-hop edge sampling for build_routes.
+
+_select_next_edge weighs every out-edge of the current node on every hop:
+
+    weight = (1 + tag_bias * matches + distance_bias * closeness) / (1 + edge_reuse_penalty * visits)
+
+over the edges that still fit the remaining distance (and are unvisited unless
+reuse is allowed). The first two terms only depend on the edge and the tag set
+of the request, so EdgeSampler draws from them with one cumulative array over
+all edge rows, built once per graph, tag set and tag_bias: a node's out-edges
+are a contiguous block of rows and a bisect inside the block picks one.
+
+The rest is a rejection step. An edge is accepted with probability
+weight / (static weight * (1 + distance_bias * closeness bound)), and 0 for
+edges that do not fit. The bound is the best closeness any edge of the block can
+reach (0 for most of a walk, while the target is further away than two of the
+longest edges) and the reuse divisor is at least 1, so this is at most 1 and
+accepted edges follow the same distribution as _select_next_edge.
+When the block is mostly out of reach (near the end of a walk, or after a lot of
+reuse) a few rejections in a row hand the hop to _select_next_edge itself.
+'''
+
+# proposals per hop before falling back to the exact weighting
+MAX_REJECTIONS = 8
+
+@dataclass(frozen=True)
+class StaticEdgeWeights:
+    # weight of every edge row before the per-hop terms, and its running sum
+    # (cumulative[i] = static_weight[:i].sum())
+    static_weight: np.ndarray
+    cumulative: np.ndarray
+    # per node, the longest out-edge (-inf without any)
+    node_max_distance_m: np.ndarray
+    matching_mask: Optional[np.ndarray]
+    tag_bias: float
+
+
+def _static_edge_weights(
+    walk_graph: Union[CompactGraph, ContractedGraph],
+    matching_mask: Optional[np.ndarray],
+    tag_bias: float,
+) -> StaticEdgeWeights:
+    static_weight = np.ones(len(walk_graph.edge_dst), dtype=np.float64)
+    if matching_mask is not None and tag_bias > 0:
+        static_weight += tag_bias * matching_mask
+    cumulative = np.zeros(len(static_weight) + 1, dtype=np.float64)
+    np.cumsum(static_weight, out=cumulative[1:])
+
+    offsets = walk_graph.offsets
+    node_max_distance_m = np.full(len(offsets) - 1, -np.inf)
+    has_edges = offsets[:-1] < offsets[1:]
+    if has_edges.any():
+        node_max_distance_m[has_edges] = np.maximum.reduceat(
+            np.asarray(walk_graph.distance_m, dtype=np.float64), offsets[:-1][has_edges]
+        )
+    return StaticEdgeWeights(static_weight, cumulative, node_max_distance_m, matching_mask, tag_bias)
+
+
+_static_weights: "weakref.WeakKeyDictionary[object, OrderedDict]" = weakref.WeakKeyDictionary()
+_static_weights_lock = threading.Lock()
+
+def static_edge_weights(
+    walk_graph: Union[CompactGraph, ContractedGraph],
+    tags: Iterable[str] = (),
+    tag_bias: float = 0.0,
+) -> StaticEdgeWeights:
+    """StaticEdgeWeights of walk_graph for a tag set, cached like tag masks."""
+    key = (tuple(sorted(set(tags))), float(tag_bias))
+    with _static_weights_lock:
+        cache = _static_weights.setdefault(walk_graph, OrderedDict())
+        weights = cache.get(key)
+        if weights is not None:
+            cache.move_to_end(key)
+            return weights
+
+    matching_mask = walk_graph.tag_mask(key[0]) if key[0] else None
+    weights = _static_edge_weights(walk_graph, matching_mask, tag_bias)
+
+    with _static_weights_lock:
+        cache[key] = weights
+        while len(cache) > TAG_MASK_CACHE_SIZE:
+            cache.popitem(last=False)
+    return weights
+
+
+class EdgeSampler:
+    """_select_next_edge for one build_routes request, in O(1) expected time per hop."""
+
+    def __init__(
+        self,
+        walk_graph: Union[CompactGraph, ContractedGraph],
+        weights: StaticEdgeWeights,
+        distance_bias: float = 0.0,
+        edge_reuse_penalty: float = 0.0,
+        allow_edge_reuse: bool = False,
+    ):
+        self.graph = walk_graph
+        self.weights = weights
+        self.distance_bias = distance_bias
+        self.edge_reuse_penalty = edge_reuse_penalty
+        self.allow_edge_reuse = allow_edge_reuse
+        self.num_fallbacks = 0
+        # memoryviews index to plain Python numbers, a hop reads a handful of them
+        self._offsets = memoryview(np.ascontiguousarray(walk_graph.offsets))
+        self._distance_m = memoryview(np.ascontiguousarray(walk_graph.distance_m))
+        self._static_weight = memoryview(weights.static_weight)
+        self._cumulative = memoryview(weights.cumulative)
+        self._node_max_distance_m = memoryview(weights.node_max_distance_m)
+
+    def _distance_scale_m(
+        self,
+        node_index: int,
+        start: int,
+        stop: int,
+        remaining_distance_m: float,
+        edge_visit_counts: Optional[Dict[int, int]],
+        visited_nodes: Optional[Set[int]],
+    ) -> float:
+        """max(longest viable out-edge, 1), as _select_next_edge normalizes closeness."""
+        node_max_distance_m = self._node_max_distance_m[node_index]
+        check_visits = edge_visit_counts is not None and not self.allow_edge_reuse
+        if node_max_distance_m <= remaining_distance_m and (
+            not check_visits or (visited_nodes is not None and node_index not in visited_nodes)
+        ):
+            return max(node_max_distance_m, 1.0)
+        distance_m = self._distance_m
+        max_viable_distance_m = max(
+            (
+                distance_m[row] for row in range(start, stop)
+                if distance_m[row] <= remaining_distance_m
+                and not (check_visits and edge_visit_counts.get(row, 0))
+            ),
+            default=1.0,
+        )
+        return max(max_viable_distance_m, 1.0)
+
+    def next_edge(
+        self,
+        node_index: int,
+        remaining_distance_m: float,
+        remaining_target_distance_m: Optional[float] = None,
+        edge_visit_counts: Optional[Dict[int, int]] = None,
+        visited_nodes: Optional[Set[int]] = None,
+        rng=random,
+    ) -> Optional[int]:
+        """
+        The next edge row out of node_index, None if no edge fits. visited_nodes,
+        the nodes the walk has left through edges in edge_visit_counts, lets a hop
+        skip scanning the block for visited edges.
+        """
+        start = self._offsets[node_index]
+        stop = self._offsets[node_index + 1]
+        if start == stop:
+            return None
+        distance_bias = (
+            self.distance_bias if remaining_target_distance_m is not None and self.distance_bias > 0 else 0.0
+        )
+        closeness_bound = 0.0
+        if distance_bias:
+            distance_scale_m = self._distance_scale_m(
+                node_index, start, stop, remaining_distance_m, edge_visit_counts, visited_nodes
+            )
+            target_m = max(remaining_target_distance_m, 0.0)
+            # no viable edge is longer than the scale, so none gets closer to the
+            # target than target_m - distance_scale_m; far from it closeness is 0 for all
+            closeness_bound = 1.0 - min(max(target_m - distance_scale_m, 0.0) / distance_scale_m, 1.0)
+            if not closeness_bound:
+                distance_bias = 0.0
+        penalize = edge_visit_counts is not None and self.edge_reuse_penalty > 0
+        check_visits = edge_visit_counts is not None and not self.allow_edge_reuse
+        bound = 1.0 + distance_bias * closeness_bound
+        distance_m = self._distance_m
+        cumulative = self._cumulative
+        low = cumulative[start]
+        total = cumulative[stop] - low
+
+        for _ in range(MAX_REJECTIONS):
+            row = bisect_right(cumulative, low + rng.random() * total, start, stop) - 1
+            edge_distance_m = distance_m[row]
+            if edge_distance_m > remaining_distance_m:
+                continue
+            visits = edge_visit_counts.get(row, 0) if edge_visit_counts is not None else 0
+            if visits and check_visits:
+                continue
+            if not distance_bias and not (penalize and visits):
+                return row
+
+            static_weight = self._static_weight[row]
+            weight = static_weight
+            if distance_bias:
+                distance_delta = abs(edge_distance_m - target_m)
+                weight += distance_bias * (1.0 - min(distance_delta / distance_scale_m, 1.0))
+            if penalize:
+                weight /= 1.0 + (self.edge_reuse_penalty * visits)
+            if rng.random() * static_weight * bound < max(weight, 0.0001):
+                return row
+
+        self.num_fallbacks += 1
+        return _select_next_edge(
+            range(start, stop),
+            self.graph,
+            remaining_distance_m,
+            remaining_target_distance_m=remaining_target_distance_m,
+            matching_mask=self.weights.matching_mask,
+            tag_bias=self.weights.tag_bias,
+            distance_bias=self.distance_bias,
+            edge_visit_counts=edge_visit_counts,
+            edge_reuse_penalty=self.edge_reuse_penalty,
+            allow_edge_reuse=self.allow_edge_reuse,
+            rng=rng,
+        )
@@ -1,11 +1,22 @@
+import weakref
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
 from .route_builder import Route
-from .route_features import RouteFeatures
+from .route_features import RouteFeatureBatch, RouteFeatures
 from ..data_ingestion.graph.edge import Edge
+from ..data_ingestion.graph.compact_graph import CompactGraph
+from ..data_ingestion.graph.contraction import ContractedGraph
 
 # whether a path is "dog-friendly" is more complex than simply using the "dog" tag
 def edge_dog_score(edge):
+    return tags_dog_score(edge.tags)
+
+def tags_dog_score(t):
     score = 0.1  # base assumption: most places are somewhat dog-walkable
-    t = edge.tags
 
     hw = t.get("highway")
 
@@ -38,98 +49,201 @@ def edge_dog_score(edge):
     return max(0.0, min(1.0, score))
 
 
-'''
-input: Route object and dictionary of edges
-output: RouteFeatures object
-The function assigns a ratio for each feature of a route 
-which is relative to the length of the route.
-We can use these features in scoring and compare those scores with personal models.
-'''
-def compute_route_features(route: Route, edges: dict[int, Edge]) -> RouteFeatures:
-    total = route.distance_m
-
-    sidewalk = lit = residential = major_road = trail = paved = rough = accessible = steps = dog = 0.0
-    incline_sum = 0.0
-    incline_count = 0
-
-    for eid in route.edge_ids:
-        e = edges[eid]
-        d = e.distance_m
-        t = e.tags
+# columns of the per tag set feature table, in RouteFeatures order
+FEATURE_COLUMNS = (
+    "sidewalk", "lit", "residential", "major_road", "trail",
+    "paved", "rough", "accessible", "steps", "dog",
+)
 
-        hw = t.get("highway")
-        surface = t.get("surface")
+def tags_route_features(t) -> Tuple[Tuple[bool, ...], Optional[float]]:
+    """The FEATURE_COLUMNS predicates of one edge's tags, and its parsed incline (None if absent or invalid)."""
+    hw = t.get("highway")
+    surface = t.get("surface")
 
+    flags = (
         # sidewalks
-        if (
-            t.get("sidewalk") not in ("no", None)
-            or t.get("footway") == "sidewalk"
-            or hw in ("footway", "pedestrian")
-        ):
-            sidewalk += d
-
+        t.get("sidewalk") not in ("no", None)
+        or t.get("footway") == "sidewalk"
+        or hw in ("footway", "pedestrian"),
         # lighting (assume residential areas are often lit)
-        if t.get("lit") == "yes" or hw in ("residential", "living_street"):
-            lit += d
-
+        t.get("lit") == "yes" or hw in ("residential", "living_street"),
         # residential environments
-        if hw in ("residential", "living_street", "service"):
-            residential += d
-
+        hw in ("residential", "living_street", "service"),
         # major roads
-        if hw in ("primary", "secondary", "trunk", "tertiary"):
-            major_road += d
-
+        hw in ("primary", "secondary", "trunk", "tertiary"),
         # trails / walking paths
-        if hw in ("footway", "path", "track"):
-            trail += d
-
+        hw in ("footway", "path", "track"),
         # paved surfaces
-        if surface in ("asphalt", "concrete", "paved", "bricks") or hw in ("residential", "service"):
-            paved += d
-
+        surface in ("asphalt", "concrete", "paved", "bricks") or hw in ("residential", "service"),
         # rough terrain
-        if (
-            surface in ("gravel", "dirt", "sand", "ground", "unpaved")
-            or t.get("smoothness") in ("bad", "very_bad")
-        ):
-            rough += d
-
+        surface in ("gravel", "dirt", "sand", "ground", "unpaved")
+        or t.get("smoothness") in ("bad", "very_bad"),
         # accessibility
-        if (
-            t.get("wheelchair") == "yes"
-            or t.get("smoothness") in ("excellent", "good")
-            or hw in ("footway", "pedestrian")
-        ):
-            accessible += d
-
+        t.get("wheelchair") == "yes"
+        or t.get("smoothness") in ("excellent", "good")
+        or hw in ("footway", "pedestrian"),
         # steps
-        if hw == "steps":
-            steps += d
-
+        hw == "steps",
         # dog friendliness
-        if edge_dog_score(e) >= 0.3:
-            dog += d
+        tags_dog_score(t) >= 0.3,
+    )
 
-        # incline
-        if "incline" in t:
-            try:
-                incline_sum += float(t["incline"].strip("%")) / 100
-                incline_count += 1
-            except ValueError:
-                pass
+    incline = None
+    if "incline" in t:
+        try:
+            incline = float(t["incline"].strip("%")) / 100
+        except ValueError:
+            pass
+    return flags, incline
 
+
+def _route_features(total: float, sums: Sequence[float], incline_sum: float, incline_count: int) -> RouteFeatures:
     return RouteFeatures(
         length_m=total,
-        sidewalk_ratio=sidewalk / total,
-        lit_ratio=lit / total,
-        residential_ratio=residential / total,
-        major_road_ratio=major_road / total,
-        trail_ratio=trail / total,
-        paved_ratio=paved / total,
-        rough_surface_ratio=rough / total,
-        accessible_ratio=accessible / total,
-        steps_ratio=steps / total,
-        dog_friendly_ratio=dog / total,
+        sidewalk_ratio=sums[0] / total,
+        lit_ratio=sums[1] / total,
+        residential_ratio=sums[2] / total,
+        major_road_ratio=sums[3] / total,
+        trail_ratio=sums[4] / total,
+        paved_ratio=sums[5] / total,
+        rough_surface_ratio=sums[6] / total,
+        accessible_ratio=sums[7] / total,
+        steps_ratio=sums[8] / total,
+        dog_friendly_ratio=sums[9] / total,
         avg_incline=(incline_sum / incline_count) if incline_count else None,
-    )
\ No newline at end of file
+    )
+
+
+'''
+input: Route object and dictionary of edges
+output: RouteFeatures object
+The function assigns a ratio for each feature of a route 
+which is relative to the length of the route.
+We can use these features in scoring and compare those scores with personal models.
+'''
+def compute_route_features(route: Route, edges: Union[dict[int, Edge], CompactGraph]) -> RouteFeatures:
+    sums = [0.0] * len(FEATURE_COLUMNS)
+    incline_sum = 0.0
+    incline_count = 0
+
+    if isinstance(edges, CompactGraph):
+        rows = edges.edge_rows(route.edge_ids)
+        edge_data = zip(edges.distance_m[rows].tolist(), [edges.edge_tags(row) for row in rows])
+    else:
+        edge_data = ((edges[eid].distance_m, edges[eid].tags) for eid in route.edge_ids)
+
+    for d, t in edge_data:
+        flags, incline = tags_route_features(t)
+        for i, flag in enumerate(flags):
+            if flag:
+                sums[i] += d
+        if incline is not None:
+            incline_sum += incline
+            incline_count += 1
+
+    return _route_features(route.distance_m, sums, incline_sum, incline_count)
+
+
+# graph -> (tag set x FEATURE_COLUMNS flags, tag set x (incline, has incline)), built once per graph
+_tag_set_tables: "weakref.WeakKeyDictionary[CompactGraph, Tuple[np.ndarray, np.ndarray]]" = weakref.WeakKeyDictionary()
+
+def _tag_set_tables_for(graph: CompactGraph) -> Tuple[np.ndarray, np.ndarray]:
+    tables = _tag_set_tables.get(graph)
+    if tables is None:
+        num_tag_sets = len(graph.tag_sets)
+        flags = np.zeros((num_tag_sets, len(FEATURE_COLUMNS)), dtype=np.float64)
+        incline = np.zeros((num_tag_sets, 2), dtype=np.float64)
+        for tag_set_id in range(num_tag_sets):
+            row_flags, row_incline = tags_route_features(graph.tag_sets[tag_set_id])
+            flags[tag_set_id] = row_flags
+            if row_incline is not None:
+                incline[tag_set_id] = (row_incline, 1.0)
+        tables = _tag_set_tables[graph] = (flags, incline)
+    return tables
+
+@dataclass(frozen=True)
+class WalkFeatureTables:
+    """What a walk needs to keep running feature sums, per edge of the graph it walks."""
+    edge_tag_set: np.ndarray
+    # original edges behind each (super-)edge, all with the same tag set
+    edge_members: np.ndarray
+    # per tag set: FEATURE_COLUMNS flags, and (incline, has incline)
+    flags: List[List[float]]
+    incline: List[List[float]]
+    max_abs_incline: float
+
+_walk_feature_tables: "weakref.WeakKeyDictionary[object, WalkFeatureTables]" = weakref.WeakKeyDictionary()
+
+def walk_feature_tables(walk_graph: Union[CompactGraph, ContractedGraph]) -> WalkFeatureTables:
+    tables = _walk_feature_tables.get(walk_graph)
+    if tables is None:
+        if isinstance(walk_graph, ContractedGraph):
+            graph = walk_graph.graph
+            # contraction only merges edges with the same tag set
+            first_members = walk_graph.member_rows[walk_graph.member_offsets[:-1]]
+            edge_tag_set = graph.edge_tag_set[first_members]
+            edge_members = np.diff(walk_graph.member_offsets)
+        else:
+            graph = walk_graph
+            edge_tag_set = graph.edge_tag_set
+            edge_members = np.ones(graph.num_edges, dtype=np.int64)
+        flags, incline = _tag_set_tables_for(graph)
+        max_abs_incline = float(np.abs(incline[:, 0]).max()) if len(incline) else 0.0
+        tables = _walk_feature_tables[walk_graph] = WalkFeatureTables(
+            edge_tag_set, edge_members, flags.tolist(), incline.tolist(), max_abs_incline
+        )
+    return tables
+
+def compute_route_feature_batch(
+    routes: Sequence[Route], graph: Union[dict[int, Edge], CompactGraph]
+) -> RouteFeatureBatch:
+    """
+    compute_route_features for a batch of routes on one graph, as columns.
+    On a CompactGraph the predicates are evaluated once per tag set, and every route's
+    sums come from one sparse route x tag set matrix of edge distances (and one of
+    edge counts for the incline).
+    """
+    if not isinstance(graph, CompactGraph):
+        return RouteFeatureBatch.from_features([compute_route_features(route, graph) for route in routes])
+    flags, incline = _tag_set_tables_for(graph)
+
+    lengths = np.fromiter((len(route.edge_ids) for route in routes), dtype=np.int64, count=len(routes))
+    indptr = np.zeros(len(routes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    rows = graph.edge_rows(edge_id for route in routes for edge_id in route.edge_ids)
+    tag_sets = graph.edge_tag_set[rows]
+    shape = (len(routes), len(flags))
+
+    # duplicate (route, tag set) entries add up in the products
+    by_distance = csr_matrix((graph.distance_m[rows].astype(np.float64), tag_sets, indptr), shape=shape)
+    by_count = csr_matrix((np.ones(len(rows)), tag_sets, indptr), shape=shape)
+    sums = np.asarray(by_distance @ flags)
+    incline_sum, incline_count = np.asarray(by_count @ incline).T
+
+    total = np.fromiter((route.distance_m for route in routes), dtype=np.float64, count=len(routes))
+    ratios = sums / total[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_incline = np.where(incline_count > 0, incline_sum / incline_count, np.nan)
+    return RouteFeatureBatch(
+        length_m=total,
+        sidewalk_ratio=ratios[:, 0],
+        lit_ratio=ratios[:, 1],
+        residential_ratio=ratios[:, 2],
+        major_road_ratio=ratios[:, 3],
+        trail_ratio=ratios[:, 4],
+        paved_ratio=ratios[:, 5],
+        rough_surface_ratio=ratios[:, 6],
+        accessible_ratio=ratios[:, 7],
+        steps_ratio=ratios[:, 8],
+        dog_friendly_ratio=ratios[:, 9],
+        avg_incline=avg_incline,
+    )
+
+def compute_routes_features(
+    routes: Sequence[Route], graph: Union[dict[int, Edge], CompactGraph]
+) -> List[RouteFeatures]:
+    """compute_route_feature_batch, one RouteFeatures per route."""
+    if not isinstance(graph, CompactGraph):
+        return [compute_route_features(route, graph) for route in routes]
+    batch = compute_route_feature_batch(routes, graph)
+    return [batch[i] for i in range(len(batch))]
@@ -0,0 +1,206 @@
+import math
+import random
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from .edge_sampler import StaticEdgeWeights
+from .route_builder import Route, _route_from_rows
+from ..data_ingestion.graph.compact_graph import CompactGraph
+from ..data_ingestion.graph.contraction import ContractedGraph
+from ..data_ingestion.index.landmarks import distance_matrix
+
+'''
+Round-trip routes for build_routes(loop=True).
+
+A random walk ends wherever it runs out of distance, so hardly any of them
+bring the user back to the start. A loop walk knows, for every node around its
+start, the shortest distance back home: one Dijkstra over the reversed walk
+graph from the start node, cut off at max_distance_m, so it only touches the
+nodes a loop could reach at all.
+
+With that a walk at distance_m only takes edges after which it can still get
+home in time,
+
+    distance_m + edge + home[edge end] <= max_distance_m
+
+and weighs them by how close that projected loop length comes to the walk's
+target length (drawn from [min_distance_m, max_distance_m] as for open walks):
+
+    weight = static weight * exp(-|target - projected| / (LOOP_STEER_RATIO * target))
+
+Early on every projected length is short of the target and edges leading away
+from home are preferred; once it is reached edges that keep the loop at its
+target, the way home, are. The walk ends the first time it is back home having
+walked min_distance_m. Going back down a street the walk came up counts as
+reusing that edge for edge_reuse_penalty, so loops are not out-and-back.
+
+Home distances are cached per start node for the request, the reversed graph
+per walk graph. Only the nodes the search reached are kept (their indices and
+distances, 12 bytes a node), and the cache holds at most
+HOME_DISTANCE_CACHE_BYTES of them, least recently used out first. A walk looks
+its home's distances up by node index in one node-sized array of the walker,
+filled in when the walk starts from a different home than the last one.
+'''
+
+# how sharply projected loop lengths away from the target lose weight, as a share of the target
+LOOP_STEER_RATIO = 0.1
+# bytes of home distances kept per request
+HOME_DISTANCE_CACHE_BYTES = 64 << 20
+
+_reversed_graphs: "weakref.WeakKeyDictionary[object, csr_matrix]" = weakref.WeakKeyDictionary()
+
+def _reversed_graph(walk_graph: Union[CompactGraph, ContractedGraph]) -> csr_matrix:
+    """walk_graph with every edge turned around, the shortest of parallel edges kept."""
+    matrix = _reversed_graphs.get(walk_graph)
+    if matrix is None:
+        matrix = _reversed_graphs[walk_graph] = distance_matrix(walk_graph, reverse=True)
+    return matrix
+
+
+def home_distances_m(
+    walk_graph: Union[CompactGraph, ContractedGraph],
+    home_node_index: int,
+    limit_m: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The nodes with a walk to home_node_index of at most limit_m, ascending, and the shortest one of each."""
+    distances_m = dijkstra(_reversed_graph(walk_graph), directed=True, indices=home_node_index, limit=limit_m)
+    reached = np.flatnonzero(np.isfinite(distances_m))
+    return reached.astype(np.int32), distances_m[reached]
+
+
+class LoopWalker:
+    """Closed walks from a start node back to it, for one build_routes request."""
+
+    def __init__(
+        self,
+        walk_graph: Union[CompactGraph, ContractedGraph],
+        weights: StaticEdgeWeights,
+        max_distance_m: float,
+        edge_reuse_penalty: float = 0.0,
+        allow_edge_reuse: bool = False,
+    ):
+        self.graph = walk_graph
+        self.weights = weights
+        self.max_distance_m = max_distance_m
+        self.edge_reuse_penalty = edge_reuse_penalty
+        self.allow_edge_reuse = allow_edge_reuse
+        self._offsets = memoryview(np.ascontiguousarray(walk_graph.offsets))
+        self._distance_m = memoryview(np.ascontiguousarray(walk_graph.distance_m, dtype=np.float64))
+        self._edge_dst = memoryview(np.ascontiguousarray(walk_graph.edge_dst))
+        self._static_weight = memoryview(weights.static_weight)
+        self._home_distances: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._home_distance_bytes = 0
+        # home distances of _home_node by node index, inf elsewhere
+        self._home = np.full(len(walk_graph.offsets) - 1, np.inf)
+        self._home_view = memoryview(self._home)
+        self._home_node: Optional[int] = None
+        self._home_nodes = np.zeros(0, dtype=np.int32)
+
+    def home_distances_m(self, home_node_index: int) -> Tuple[np.ndarray, np.ndarray]:
+        home = self._home_distances.get(home_node_index)
+        if home is not None:
+            self._home_distances.move_to_end(home_node_index)
+            return home
+        home = home_distances_m(self.graph, home_node_index, self.max_distance_m)
+        self._home_distances[home_node_index] = home
+        self._home_distance_bytes += home[0].nbytes + home[1].nbytes
+        while self._home_distance_bytes > HOME_DISTANCE_CACHE_BYTES and len(self._home_distances) > 1:
+            _, (nodes, distances_m) = self._home_distances.popitem(last=False)
+            self._home_distance_bytes -= nodes.nbytes + distances_m.nbytes
+        return home
+
+    def _set_home(self, home_node_index: int) -> memoryview:
+        if home_node_index != self._home_node:
+            self._home[self._home_nodes] = np.inf
+            nodes, distances_m = self.home_distances_m(home_node_index)
+            self._home[nodes] = distances_m
+            self._home_node = home_node_index
+            self._home_nodes = nodes
+        return self._home_view
+
+    def walk(
+        self,
+        start_node_index: int,
+        min_distance_m: float,
+        max_steps: int,
+        profile_search=None,
+        rng=random,
+    ) -> Optional[Route]:
+        home = self._set_home(start_node_index)
+        offsets = self._offsets
+        distance = self._distance_m
+        edge_dst = self._edge_dst
+        static_weight = self._static_weight
+        max_distance_m = self.max_distance_m
+        penalty = self.edge_reuse_penalty
+
+        target_distance_m = rng.uniform(min_distance_m, max_distance_m)
+        steer_m = max(LOOP_STEER_RATIO * target_distance_m, 1.0)
+        node_indices = [start_node_index]
+        edge_rows: List[int] = []
+        edge_visit_counts: Dict[int, int] = {}
+        # (from, to) of the edges walked, to spot going back the same way
+        walked: Set[Tuple[int, int]] = set()
+        distance_m = 0.0
+        node = start_node_index
+        if profile_search is not None:
+            profile_search.reset()
+
+        for _ in range(max_steps):
+            candidates = []
+            weights = []
+            for row in range(offsets[node], offsets[node + 1]):
+                edge_distance_m = distance[row]
+                next_node = edge_dst[row]
+                projected_m = distance_m + edge_distance_m + home[next_node]
+                if projected_m > max_distance_m:
+                    continue
+                visits = edge_visit_counts.get(row, 0)
+                if visits and not self.allow_edge_reuse:
+                    continue
+                weight = static_weight[row] * math.exp(-abs(target_distance_m - projected_m) / steer_m)
+                visits += (next_node, node) in walked
+                if visits and penalty > 0:
+                    weight /= 1.0 + penalty * visits
+                candidates.append(row)
+                weights.append(max(weight, 1e-12))
+            if not candidates:
+                return None
+
+            row = rng.choices(candidates, weights=weights, k=1)[0]
+            next_node = edge_dst[row]
+            edge_distance_m = distance[row]
+            edge_rows.append(row)
+            edge_visit_counts[row] = edge_visit_counts.get(row, 0) + 1
+            walked.add((node, next_node))
+            distance_m += edge_distance_m
+            node_indices.append(next_node)
+            node = next_node
+            if profile_search is not None:
+                profile_search.add_edge(row, edge_distance_m)
+            if node == start_node_index and distance_m >= min_distance_m:
+                route = _route_from_rows(self.graph, node_indices, edge_rows, distance_m)
+                if profile_search is not None:
+                    profile_search.offer(route)
+                return route
+        return None
+
+
+if __name__ == "__main__":
+    import time
+
+    from .route_builder import PRESET_PARAMS, build_routes
+
+    # loop routes per second against open walks that happen to end where they started
+    params = dict(PRESET_PARAMS, user_id=None, max_routes=100000, max_attempts=5000, workers=1, batch_walks=0)
+    for loop in (False, True):
+        started = time.perf_counter()
+        routes = build_routes(**params, loop=loop)
+        elapsed = time.perf_counter() - started
+        loops = sum(1 for route in routes if route.node_ids[0] == route.node_ids[-1])
+        print(f"loop={loop}: {loops} loops of {len(routes)} routes in {elapsed:.2f} s ({loops / elapsed:.1f} loops/s)")
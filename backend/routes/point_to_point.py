@@ -0,0 +1,302 @@
+import dataclasses
+import heapq
+import math
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .feature_extraction import _tag_set_tables_for, compute_route_feature_batch, walk_feature_tables
+from .route_builder import (
+    Route,
+    _haversine_distance_m,
+    _normalize_tags,
+    _route_edge_overlap_ratio,
+    _route_from_rows,
+    _score_tags_for_user_profile,
+    score_route_for_tag,
+)
+from .route_features import RouteFeatureBatch
+from ..data_ingestion.graph.compact_graph import CompactGraph, TAG_MASK_CACHE_SIZE
+from ..data_ingestion.graph.contraction import ContractedGraph
+from ..data_ingestion.graph.graph_store import get_graph_for_area
+from ..users.manage_user_profiles import load_user_profile
+from ..users.user_profile import UserProfile
+
+'''
+A-to-B walking routes.
+
+build_point_to_point_routes snaps both points to the nearest junction of the
+contracted walk graph and runs A* between them. An edge costs its length times
+a factor of at least 1:
+
+    with a user profile   1 + PROFILE_PENALTY * how far the edge's tag set falls
+                          short of the best one under UserProfile.score (as a
+                          one-edge route), DISALLOWED_FACTOR where the profile
+                          would not allow a route made of it (steps for a
+                          wheelchair user)
+    with score tags       times 1 + tag_penalty on edges without any of them
+
+so the cheapest route is the shortest one that keeps to nice streets. Factors
+are per tag set and cached per walk graph and profile like tag masks.
+
+The heuristic is the ALT bound from the graph's landmark tables (see
+index/landmarks.py) over the ACTIVE_LANDMARKS landmarks that bound the source
+best, times the smallest factor. Costs never fall below length times that
+factor, so the bound stays admissible and consistent, and A* settles few nodes
+off the route.
+
+Alternatives come from the penalty method: after each route its edges cost
+1 + ALTERNATIVE_PENALTY times more and A* runs again. A new route is kept when it
+overlaps every kept one less than route_similarity_threshold (by length, as in
+build_routes) and is at most max_stretch times as long as the first.
+'''
+
+PROFILE_PENALTY = 1.0
+DISALLOWED_FACTOR = 10.0
+ACTIVE_LANDMARKS = 4
+ALTERNATIVE_PENALTY = 0.5
+# A* runs per requested route before giving up on more alternatives
+ALTERNATIVE_TRIES = 4
+# nearest nodes considered when snapping a point to a junction
+SNAP_CANDIDATES = 16
+
+
+def _tag_set_cost_factors(graph: CompactGraph, user_profile: Optional[UserProfile]) -> np.ndarray:
+    """Per tag set of graph, the profile's cost factor (all 1 without a profile)."""
+    flags, incline = _tag_set_tables_for(graph)
+    if user_profile is None or not len(flags):
+        return np.ones(len(flags))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_incline = np.where(incline[:, 1] > 0, incline[:, 0], np.nan)
+    # every tag set as a route made only of it, of the profile's shortest length
+    length_m = user_profile.min_length_m or 1.0
+    batch = RouteFeatureBatch(
+        length_m=np.full(len(flags), float(length_m)),
+        sidewalk_ratio=flags[:, 0],
+        lit_ratio=flags[:, 1],
+        residential_ratio=flags[:, 2],
+        major_road_ratio=flags[:, 3],
+        trail_ratio=flags[:, 4],
+        paved_ratio=flags[:, 5],
+        rough_surface_ratio=flags[:, 6],
+        accessible_ratio=flags[:, 7],
+        steps_ratio=flags[:, 8],
+        dog_friendly_ratio=flags[:, 9],
+        avg_incline=avg_incline,
+    )
+    scores = user_profile.score_batch(batch)
+    spread = scores.max() - scores.min()
+    shortfall = (scores.max() - scores) / spread if spread > 0 else np.zeros(len(scores))
+    factors = 1.0 + PROFILE_PENALTY * shortfall
+    factors[~user_profile.allowed_batch(batch)] = DISALLOWED_FACTOR
+    return factors
+
+
+_cost_factors: "weakref.WeakKeyDictionary[object, OrderedDict]" = weakref.WeakKeyDictionary()
+_cost_factors_lock = threading.Lock()
+
+def edge_cost_factors(
+    walk_graph: Union[CompactGraph, ContractedGraph],
+    user_profile: Optional[UserProfile] = None,
+    tags: Sequence[str] = (),
+    tag_penalty: float = 0.0,
+) -> np.ndarray:
+    """Per edge of walk_graph, what a meter of it costs (at least 1)."""
+    tags = tuple(sorted(set(tags)))
+    profile_key = dataclasses.astuple(user_profile) if user_profile is not None else None
+    key = (profile_key, tags, float(tag_penalty))
+    with _cost_factors_lock:
+        cache = _cost_factors.setdefault(walk_graph, OrderedDict())
+        factors = cache.get(key)
+        if factors is not None:
+            cache.move_to_end(key)
+            return factors
+
+    graph = walk_graph.graph if isinstance(walk_graph, ContractedGraph) else walk_graph
+    factors = _tag_set_cost_factors(graph, user_profile)[walk_feature_tables(walk_graph).edge_tag_set]
+    if tags and tag_penalty > 0:
+        factors = factors * np.where(walk_graph.tag_mask(tags), 1.0, 1.0 + tag_penalty)
+    factors.setflags(write=False)
+
+    with _cost_factors_lock:
+        cache[key] = factors
+        while len(cache) > TAG_MASK_CACHE_SIZE:
+            cache.popitem(last=False)
+    return factors
+
+
+class PointToPointSearch:
+    """A* from one junction to another over graph.contracted, with ALT bounds."""
+
+    def __init__(self, graph: CompactGraph, cost_factors: np.ndarray, target: int):
+        walk_graph = graph.contracted
+        self.graph = graph
+        self.walk_graph = walk_graph
+        self.target = target
+        self.num_settled = 0
+        self._offsets = memoryview(np.ascontiguousarray(walk_graph.offsets))
+        self._edge_src = memoryview(np.ascontiguousarray(walk_graph.edge_src))
+        self._edge_dst = memoryview(np.ascontiguousarray(walk_graph.edge_dst))
+        self._distance_m = memoryview(np.ascontiguousarray(walk_graph.distance_m, dtype=np.float64))
+        self._cost_m = memoryview(np.ascontiguousarray(walk_graph.distance_m * cost_factors, dtype=np.float64))
+        self._min_factor = float(cost_factors.min()) if len(cost_factors) else 1.0
+        self._landmarks = graph.landmarks
+        self._source: Optional[int] = None
+        self._active = []
+        # bounds to the target per node, for the current source's active landmarks
+        self._bounds: Dict[int, float] = {}
+
+    def _set_source(self, source: int):
+        table = self._landmarks
+        self._source = source
+        self._active = []
+        self._bounds = {}
+        if not len(table.landmarks):
+            return
+        for i in table.active(source, self.target, ACTIVE_LANDMARKS).tolist():
+            from_t = float(table.from_m[i, self.target])
+            to_t = float(table.to_m[i, self.target])
+            if math.isfinite(from_t) and math.isfinite(to_t):
+                self._active.append((memoryview(table.from_m[i]), from_t, memoryview(table.to_m[i]), to_t))
+
+    def _bound(self, node: int) -> float:
+        bound = self._bounds.get(node)
+        if bound is None:
+            bound = 0.0
+            for from_m, from_t, to_m, to_t in self._active:
+                bound = max(bound, from_t - from_m[node], to_m[node] - to_t)
+            bound = self._bounds[node] = bound * self._min_factor
+        return bound
+
+    def shortest(self, source: int, penalties: Optional[Dict[int, float]] = None) -> Optional[Tuple[List[int], float]]:
+        """The cheapest edge rows from source to the target and their length, None if unreachable."""
+        if source != self._source:
+            self._set_source(source)
+        penalties = penalties or {}
+        target = self.target
+        offsets, edge_dst, cost_m = self._offsets, self._edge_dst, self._cost_m
+        bound = self._bound
+
+        best_cost = {source: 0.0}
+        parent: Dict[int, int] = {}
+        settled = set()
+        heap = [(bound(source), 0.0, source)]
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == target:
+                rows = []
+                while node != source:
+                    row = parent[node]
+                    rows.append(row)
+                    node = self._edge_src[row]
+                rows.reverse()
+                return rows, sum(self._distance_m[row] for row in rows)
+            settled.add(node)
+            self.num_settled += 1
+            for row in range(offsets[node], offsets[node + 1]):
+                next_node = edge_dst[row]
+                if next_node in settled:
+                    continue
+                next_cost = cost + cost_m[row] * penalties.get(row, 1.0)
+                if next_cost < best_cost.get(next_node, math.inf):
+                    best_cost[next_node] = next_cost
+                    parent[next_node] = row
+                    heapq.heappush(heap, (next_cost + bound(next_node), next_cost, next_node))
+        return None
+
+
+def _nearest_junction(graph: CompactGraph, latitude: float, longitude: float) -> Optional[int]:
+    node_indices, _ = graph.spatial_index.query_knn(latitude, longitude, SNAP_CANDIDATES)
+    junctions = graph.contracted.start_nodes(node_indices)
+    return int(junctions[0]) if len(junctions) else None
+
+
+def build_point_to_point_routes(
+    start_latitude: float,
+    start_longitude: float,
+    end_latitude: float,
+    end_longitude: float,
+    max_routes: int = 3,
+    max_distance_m: Optional[float] = None,
+    user_id: Optional[str] = None,
+    score_tag: Optional[Union[str, Sequence[str]]] = None,
+    tag_penalty: float = 1.0,
+    route_similarity_threshold: float = 0.7,
+    max_stretch: float = 1.5,
+    return_scores: bool = False,
+) -> Union[List[Route], List[Tuple[Route, float]]]:
+    """Walking routes from start to end, cheapest first, see the module notes.
+
+    Routes longer than ``max_distance_m`` are dropped. ``return_scores`` pairs
+    each route with its profile (or tag) score like build_routes does, 0 without either.
+    """
+    if max_routes <= 0:
+        return []
+    if not 0 < route_similarity_threshold <= 1:
+        raise ValueError("route_similarity_threshold must be in the range (0, 1]")
+    if max_stretch < 1:
+        raise ValueError("max_stretch must be at least 1")
+    if tag_penalty < 0:
+        raise ValueError("tag_penalty must be non-negative")
+
+    user_profile: Optional[UserProfile] = None
+    if user_id:
+        user_profile = load_user_profile(user_id)
+        tags = _score_tags_for_user_profile(user_profile)
+    else:
+        tags = _normalize_tags(score_tag)
+
+    # no route of interest strays farther from the midpoint than half its length
+    straight_m = _haversine_distance_m(start_latitude, start_longitude, end_latitude, end_longitude)
+    reach_m = max_distance_m if max_distance_m is not None else straight_m * max_stretch * 1.5
+    graph = get_graph_for_area(
+        (start_latitude + end_latitude) / 2, (start_longitude + end_longitude) / 2, reach_m / 2 + 500.0
+    )
+    source = _nearest_junction(graph, start_latitude, start_longitude)
+    target = _nearest_junction(graph, end_latitude, end_longitude)
+    if source is None or target is None:
+        return []
+
+    walk_graph = graph.contracted
+    search = PointToPointSearch(graph, edge_cost_factors(walk_graph, user_profile, tags, tag_penalty), target)
+    routes: List[Route] = []
+    penalties: Dict[int, float] = {}
+    first_distance_m = None
+    for _ in range(max_routes * ALTERNATIVE_TRIES):
+        found = search.shortest(source, penalties)
+        if found is None:
+            break
+        rows, distance_m = found
+        for row in rows:
+            penalties[row] = penalties.get(row, 1.0) * (1.0 + ALTERNATIVE_PENALTY)
+        if first_distance_m is None:
+            first_distance_m = distance_m
+        elif distance_m > max_stretch * first_distance_m:
+            continue
+        if max_distance_m is not None and distance_m > max_distance_m:
+            continue
+        route = _route_from_rows(walk_graph, [source], rows, distance_m)
+        if any(
+            _route_edge_overlap_ratio(route.edge_ids, set(kept.edge_ids), graph) >= route_similarity_threshold
+            for kept in routes
+        ):
+            continue
+        routes.append(route)
+        if len(routes) >= max_routes or not rows:
+            break
+
+    if not return_scores:
+        return routes
+    if user_profile is not None and routes:
+        scores = user_profile.score_batch(compute_route_feature_batch(routes, graph)).tolist()
+    elif tags:
+        matching_mask = graph.tag_mask(tags)
+        scores = [score_route_for_tag(route, graph, matching_mask) for route in routes]
+    else:
+        scores = [0.0] * len(routes)
+    return list(zip(routes, scores))
@@ -0,0 +1,123 @@
+import heapq
+from typing import Iterable, List, Optional, Set, Tuple, Union
+
+from .feature_extraction import FEATURE_COLUMNS, _route_features, walk_feature_tables
+from .route_builder import Route
+from .route_features import FeatureValues
+from ..data_ingestion.graph.compact_graph import CompactGraph
+from ..data_ingestion.graph.contraction import ContractedGraph
+from ..users.user_profile import UserProfile
+
+'''
+Streaming top-k for build_routes with a user profile.
+
+Every walk keeps running RouteFeatures sums. A finished route is scored from
+them and goes into a heap of the k best, ordered like score_routes_for_user_profile
+ranks: allowed routes first, then by score, then the earlier route. A walk in
+progress has a best case: whatever the distance it has left is made of, its
+ratios and length stay within bounds, and so does UserProfile.score. Once the heap
+is full, a walk whose best case cannot beat the heap's worst route stops there.
+'''
+
+class ProfileSearch:
+    def __init__(self, walk_graph: Union[CompactGraph, ContractedGraph], user_profile: UserProfile, k: int):
+        self.tables = walk_feature_tables(walk_graph)
+        self.user_profile = user_profile
+        self.k = k
+        # (allowed, score, -order, route key, route); the smallest entry is the worst route
+        self.heap: List[Tuple[bool, float, int, Tuple[int, ...], Route]] = []
+        self.route_keys: Set[Tuple[int, ...]] = set()
+        self.num_finished = 0
+        self.num_pruned = 0
+        self.reset()
+
+    @property
+    def num_candidates(self) -> int:
+        return self.num_finished + self.num_pruned
+
+    def reset(self):
+        """Start the sums of a new walk."""
+        self.sums = [0.0] * len(FEATURE_COLUMNS)
+        self.incline_sum = 0.0
+        self.incline_count = 0
+
+    def add_edge(self, edge_row: int, distance_m: float, members: Optional[int] = None):
+        """Walk edge_row, or with members only that many original edges of it."""
+        tag_set = int(self.tables.edge_tag_set[edge_row])
+        for i, flag in enumerate(self.tables.flags[tag_set]):
+            if flag:
+                self.sums[i] += distance_m
+        incline, has_incline = self.tables.incline[tag_set]
+        if has_incline:
+            if members is None:
+                members = int(self.tables.edge_members[edge_row])
+            self.incline_sum += members * incline
+            self.incline_count += members
+
+    def hopeless(self, distance_m: float, target_distance_m: float, max_distance_m: float) -> bool:
+        """Can the current walk, now at distance_m, no longer make it into the heap?"""
+        if self.k <= 0:
+            return True
+        if len(self.heap) < self.k:
+            return False
+        worst_allowed, worst_score = self.heap[0][:2]
+
+        # the walk ends between its target and max_distance_m
+        left_m = max_distance_m - distance_m
+        low = FeatureValues(max(distance_m, target_distance_m), *[s / max_distance_m for s in self.sums], None)
+        high = FeatureValues(
+            max_distance_m,
+            *[min(1.0, (s + left_m) / max_distance_m) for s in self.sums],
+            self.tables.max_abs_incline,
+        )
+        might_be_allowed = self.user_profile.might_be_allowed(low, high)
+        if might_be_allowed != worst_allowed:
+            return worst_allowed
+        # while most of the walk is still unknown the score bound is too loose to
+        # prune anything; skip its cost until then
+        if left_m > distance_m:
+            return False
+        return self.user_profile.score_upper_bound(low, high) <= worst_score
+
+    def offer(self, route: Route):
+        """Score a finished walk from its sums and keep it if it is among the k best."""
+        self.num_finished += 1
+        route_key = tuple(route.edge_ids)
+        if self.k <= 0 or route_key in self.route_keys:
+            return
+        features = _route_features(route.distance_m, self.sums, self.incline_sum, self.incline_count)
+        entry = (
+            self.user_profile.allowed(features),
+            self.user_profile.score(features),
+            -self.num_finished,
+            route_key,
+            route,
+        )
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            self.route_keys.remove(heapq.heapreplace(self.heap, entry)[3])
+        else:
+            return
+        self.route_keys.add(route_key)
+
+    def best(self) -> List[Tuple[bool, float, Route]]:
+        """(allowed, score, route) of the kept routes, best first."""
+        return [(allowed, score, route) for allowed, score, _, _, route in sorted(self.heap, reverse=True)]
+
+    def ranked(self) -> List[Tuple[Route, float]]:
+        return [(route, score) for _, score, route in self.best()]
+
+
+def merge_best(bests: Iterable[List[Tuple[bool, float, Route]]], k: int) -> List[Tuple[bool, float, Route]]:
+    """The k best of several ProfileSearch.best lists, ties in list order, each route once."""
+    merged = []
+    route_keys: Set[Tuple[int, ...]] = set()
+    for allowed, score, route in heapq.merge(*bests, key=lambda entry: (not entry[0], -entry[1])):
+        if len(merged) >= k:
+            break
+        route_key = tuple(route.edge_ids)
+        if route_key not in route_keys:
+            route_keys.add(route_key)
+            merged.append((allowed, score, route))
+    return merged
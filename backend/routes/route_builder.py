@@ -1,27 +1,29 @@
 import json
 import heapq
 import math
+import os
 import random
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import sqlite3
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from typing import Container, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Union
 
-from backend.data_ingestion.graph.adjacency import Adjacency
+import numpy as np
+
+from backend.data_ingestion.graph.compact_graph import CompactGraph
+from backend.data_ingestion.graph.contraction import ContractedGraph
 from backend.data_ingestion.graph.edge import Edge
 from backend.data_ingestion.graph.node import Node
-from backend.data_ingestion.graph.persist_data import load_edges, load_nodes
+from backend.data_ingestion.graph.graph_store import get_graph, get_graph_for_area
+from backend.data_ingestion.graph.snapshot import open_snapshot, shared_snapshot_path
 from backend.users.user_profile import UserProfile
 from backend.users.manage_user_profiles import load_user_profile
+from config import Config
 
 MILES_TO_METERS = 1609.344
-INVERTED_INDEX_PATH = (
-    Path(__file__).resolve().parents[1]
-    / "data_ingestion"
-    / "index"
-    / "inverted_index.db"
-)
 
 def _haversine_distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     radius_m = 6371000
@@ -43,6 +45,22 @@ class Route:
     edge_ids: Sequence[int]
     distance_m: float
 
+EdgeLookup = Union[Dict[int, Edge], CompactGraph]
+
+def _edge_distances_m(edge_ids: Iterable[int], edges: EdgeLookup) -> List[float]:
+    if isinstance(edges, CompactGraph):
+        return edges.distance_m[edges.edge_rows(edge_ids)].tolist()
+    return [edges[edge_id].distance_m for edge_id in edge_ids]
+
+def _edge_tags(edge_id: int, edges: EdgeLookup) -> Optional[Mapping]:
+    if isinstance(edges, CompactGraph):
+        try:
+            return edges.edge_tags(edges.edge_row(edge_id))
+        except KeyError:
+            return None
+    edge = edges.get(edge_id)
+    return edge.tags if edge is not None else None
+
 def _normalize_tags(tags: Optional[Union[str, Sequence[str]]]) -> List[str]:
     if tags is None:
         return []
@@ -50,34 +68,11 @@ def _normalize_tags(tags: Optional[Union[str, Sequence[str]]]) -> List[str]:
         return [tag.strip() for tag in tags.split(",") if tag.strip()]
     return [tag.strip() for tag in tags if tag and tag.strip()]
 
-def _load_tag_edge_ids(tag: str, db_path: Path = INVERTED_INDEX_PATH) -> Set[int]:
-    if not tag:
-        return set()
-
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT edge_id
-            FROM edge_features
-            WHERE feature = ?
-            """,
-            (tag,),
-        )
-        return {row[0] for row in cursor.fetchall()}
-
-def _load_matching_edge_ids(
-    tags: Optional[Union[str, Sequence[str]]],
-    db_path: Path = INVERTED_INDEX_PATH,
-) -> Set[int]:
+def _load_matching_edge_ids(tags: Optional[Union[str, Sequence[str]]]) -> Set[int]:
     normalized_tags = _normalize_tags(tags)
     if not normalized_tags:
         return set()
-
-    matching_edge_ids: Set[int] = set()
-    for tag in normalized_tags:
-        matching_edge_ids.update(_load_tag_edge_ids(tag, db_path=db_path))
-    return matching_edge_ids
+    return get_graph().matching_edge_ids(normalized_tags)
 
 def _score_tags_for_user_profile(user_profile: UserProfile) -> List[str]:
     tags: List[str] = []
@@ -112,13 +107,23 @@ def _score_tags_from_user_id(user_id: str) -> List[str]:
     user_profile = load_user_profile(user_id)
     return _score_tags_for_user_profile(user_profile)
 
-def score_route_for_tag(route: Route, edges: Dict[int, Edge], matching_edge_ids: Set[int]) -> float:
+def score_route_for_tag(
+    route: Route,
+    edges: EdgeLookup,
+    matching_edge_ids: Union[Set[int], np.ndarray],
+) -> float:
     if route.distance_m <= 0:
         return 0.0
 
+    if isinstance(matching_edge_ids, np.ndarray):
+        # a CompactGraph.tag_mask over edge rows
+        rows = edges.edge_rows(route.edge_ids)
+        matched = matching_edge_ids[rows]
+        return float(edges.distance_m[rows][matched].sum(dtype=np.float64)) / route.distance_m
+
     matched_distance_m = sum(
-        edges[edge_id].distance_m
-        for edge_id in route.edge_ids
+        distance_m
+        for edge_id, distance_m in zip(route.edge_ids, _edge_distances_m(route.edge_ids, edges))
         if edge_id in matching_edge_ids
     )
     return matched_distance_m / route.distance_m
@@ -127,12 +132,15 @@ def score_route_for_tag(route: Route, edges: Dict[int, Edge], matching_edge_ids:
 def score_routes_for_tag(
     routes: Sequence[Route],
     tag: Union[str, Sequence[str]],
-    edges: Optional[Dict[int, Edge]] = None,
+    edges: Optional[EdgeLookup] = None,
 ) -> List[Tuple[Route, float]]:
     if edges is None:
-        edges = load_edges()
+        edges = get_graph().edges
 
-    matching_edge_ids = _load_matching_edge_ids(tag)
+    if isinstance(edges, CompactGraph):
+        matching_edge_ids = edges.tag_mask(_normalize_tags(tag))
+    else:
+        matching_edge_ids = _load_matching_edge_ids(tag)
     scored_routes = [
         (route, score_route_for_tag(route, edges, matching_edge_ids)) for route in routes
     ]
@@ -141,120 +149,115 @@ def score_routes_for_tag(
 def score_routes_for_user_profile(
     routes: Sequence[Route],
     user_profile: UserProfile,
-    edges: Optional[Dict[int, Edge]] = None,
+    edges: Optional[EdgeLookup] = None,
+    top_k: Optional[int] = None,
 ) -> List[Tuple[Route, float]]:
-    from backend.routes.feature_extraction import compute_route_features
+    from backend.routes.feature_extraction import compute_route_feature_batch
 
     if edges is None:
-        edges = load_edges()
-
-    allowed_scored_routes: List[Tuple[Route, float]] = []
-    disallowed_scored_routes: List[Tuple[Route, float]] = []
-    for route in routes:
-        features = compute_route_features(route, edges)
-        score = user_profile.score(features)
-        if user_profile.allowed(features):
-            allowed_scored_routes.append((route, score))
-        else:
-            disallowed_scored_routes.append((route, score))
-
-    allowed_scored_routes = sorted(allowed_scored_routes, key=lambda x: x[1], reverse=True)
-
-    disallowed_scored_routes = sorted(disallowed_scored_routes, key=lambda x: x[1], reverse=True)
-    selected_route_keys = {
-        (tuple(route.node_ids), tuple(route.edge_ids), route.distance_m)
-        for route, _ in allowed_scored_routes
-    }
-    combined_scored_routes = allowed_scored_routes[:]
-
-    for route, score in disallowed_scored_routes:
+        edges = get_graph().edges
+
+    batch = compute_route_feature_batch(routes, edges)
+    # a route repeated among the disallowed ones is listed once (copies of a
+    # route are all allowed or all disallowed)
+    keep = np.ones(len(routes), dtype=bool)
+    seen_route_keys = set()
+    for index in np.flatnonzero(~user_profile.allowed_batch(batch)).tolist():
+        route = routes[index]
         route_key = (tuple(route.node_ids), tuple(route.edge_ids), route.distance_m)
-        if route_key in selected_route_keys:
-            continue
-        combined_scored_routes.append((route, score))
-        selected_route_keys.add(route_key)
+        if route_key in seen_route_keys:
+            keep[index] = False
+        seen_route_keys.add(route_key)
 
-    return combined_scored_routes
+    indices, scores = user_profile.rank_batch(batch, k=top_k, keep=keep)
+    return [(routes[index], score) for index, score in zip(indices.tolist(), scores.tolist())]
 
 def _candidate_start_nodes(
-    nodes: Dict[int, Node],
+    graph: CompactGraph,
     latitude: float,
     longitude: float,
     max_start_distance_m: float,
+    min_distance_m: float = 0.0,
+    allow_edge_reuse: bool = False,
 ) -> List[int]:
-    return [
-        node_id
-        for node_id, node in nodes.items()
-        if _haversine_distance_m(latitude, longitude, node.lat, node.lon)
-        <= max_start_distance_m
-    ]
+    node_indices = graph.spatial_index.query_radius(latitude, longitude, max_start_distance_m)
+    if allow_edge_reuse:
+        # walking an edge again can make a walk longer than its whole component
+        return node_indices.tolist()
+    # a walk cannot be longer than all the edges of its component put together
+    long_enough = graph.component_length_m[graph.component_ids[node_indices]] >= min_distance_m
+    return node_indices[long_enough].tolist()
 
 
 def _select_next_edge(
-    edge_ids: Iterable[int],
-    edges: Dict[int, Edge],
+    edge_rows: range,
+    graph: Union[CompactGraph, ContractedGraph],
     remaining_distance_m: float,
     remaining_target_distance_m: Optional[float] = None,
-    matching_edge_ids: Optional[Set[int]] = None,
+    matching_mask: Optional[np.ndarray] = None,
     tag_bias: float = 0.0,
     distance_bias: float = 0.0,
     edge_visit_counts: Optional[Dict[int, int]] = None,
     edge_reuse_penalty: float = 0.0,
     allow_edge_reuse: bool = False,
+    rng=random,
 ) -> Optional[int]:
+    # out-edges of a node are a contiguous block of rows
+    distances_m = graph.distance_m[edge_rows.start:edge_rows.stop].tolist()
     viable_edges = [
-        edge_id
-        for edge_id in edge_ids
-        if edges[edge_id].distance_m <= remaining_distance_m
+        (edge_row, distance_m)
+        for edge_row, distance_m in zip(edge_rows, distances_m)
+        if distance_m <= remaining_distance_m
     ]
     if not allow_edge_reuse and edge_visit_counts is not None:
         viable_edges = [
-            edge_id for edge_id in viable_edges if edge_visit_counts.get(edge_id, 0) == 0
+            (edge_row, distance_m)
+            for edge_row, distance_m in viable_edges
+            if edge_visit_counts.get(edge_row, 0) == 0
         ]
     if not viable_edges:
         return None
     has_weighted_signals = (
-        matching_edge_ids is not None
+        matching_mask is not None
         or remaining_target_distance_m is not None
         or (edge_visit_counts is not None and edge_reuse_penalty > 0)
         or tag_bias > 0
         or distance_bias > 0
     )
     if not has_weighted_signals:
-        return random.choice(viable_edges)
+        return rng.choice(viable_edges)[0]
 
-    max_viable_edge_distance = max(edges[edge_id].distance_m for edge_id in viable_edges)
+    max_viable_edge_distance = max(distance_m for _, distance_m in viable_edges)
     distance_scale_m = max(max_viable_edge_distance, 1.0)
     weights = []
-    for edge_id in viable_edges:
-        edge = edges[edge_id]
+    for edge_row, distance_m in viable_edges:
         weight = 1.0
 
-        if matching_edge_ids is not None and edge_id in matching_edge_ids and tag_bias > 0:
+        if matching_mask is not None and tag_bias > 0 and matching_mask[edge_row]:
             weight += tag_bias
 
         if remaining_target_distance_m is not None and distance_bias > 0:
-            distance_delta = abs(edge.distance_m - max(remaining_target_distance_m, 0.0))
+            distance_delta = abs(distance_m - max(remaining_target_distance_m, 0.0))
             closeness = 1.0 - min(distance_delta / distance_scale_m, 1.0)
             weight += distance_bias * closeness
 
         if edge_visit_counts is not None and edge_reuse_penalty > 0:
-            prior_visits = edge_visit_counts.get(edge_id, 0)
+            prior_visits = edge_visit_counts.get(edge_row, 0)
             weight /= 1.0 + (edge_reuse_penalty * prior_visits)
 
         weights.append(max(weight, 0.0001))
 
-    return random.choices(viable_edges, weights=weights, k=1)[0]
+    return rng.choices(viable_edges, weights=weights, k=1)[0][0]
 
-def _edge_set_distance_m(edge_ids: Iterable[int], edges: Dict[int, Edge]) -> float:
+def _edge_set_distance_m(edge_ids: Iterable[int], edges: EdgeLookup) -> float:
     unique_edge_ids = set(edge_ids)
-    return sum(edges[edge_id].distance_m for edge_id in unique_edge_ids)
+    return sum(_edge_distances_m(unique_edge_ids, edges))
 
 
 def _route_edge_overlap_ratio(
     candidate_edge_ids: Sequence[int],
     existing_edge_set: Set[int],
-    edges: Dict[int, Edge],
+    edges: EdgeLookup,
 ) -> float:
     candidate_edge_set = set(candidate_edge_ids)
     if not candidate_edge_set:
@@ -271,7 +274,7 @@ def _route_edge_overlap_ratio(
 
 def _select_diverse_top_routes(
     scored_routes: Sequence[Tuple[Route, float]],
-    edges: Dict[int, Edge],
+    edges: EdgeLookup,
     max_routes: int,
     route_similarity_threshold: float,
 ) -> List[Tuple[Route, float]]:
@@ -298,52 +301,433 @@ def _select_diverse_top_routes(
 
     return selected_scored_routes
 
+def _route_from_rows(
+    graph: Union[CompactGraph, ContractedGraph],
+    node_indices: List[int],
+    edge_rows: List[int],
+    distance_m: float,
+    last_members: Optional[int] = None,
+) -> Route:
+    if isinstance(graph, ContractedGraph):
+        # super-edges back to the original nodes and edges for scoring and geometry
+        node_indices, edge_rows = graph.expand(node_indices[0], edge_rows, last_members)
+        graph = graph.graph
+    return Route(
+        node_ids=graph.node_ids[node_indices].tolist(),
+        edge_ids=graph.edge_ids[edge_rows].tolist(),
+        distance_m=distance_m,
+    )
+
+
+def _final_partial_hop(
+    graph: Union[CompactGraph, ContractedGraph],
+    node_index: int,
+    distance_m: float,
+    target_distance_m: float,
+    max_distance_m: float,
+    visited_rows: Container[int],
+    allow_edge_reuse: bool = False,
+    rng=random,
+) -> Optional[Tuple[int, int, float]]:
+    """
+    For a contracted walk that no super-edge out of node_index fits whole: one
+    whose chain reaches target_distance_m within max_distance_m partway along, as
+    (super-edge row, original edges walked, their length). An uncontracted walk
+    would have stopped at that point of the chain too.
+    """
+    if not isinstance(graph, ContractedGraph):
+        return None
+    hops = []
+    for row in range(int(graph.offsets[node_index]), int(graph.offsets[node_index + 1])):
+        if not allow_edge_reuse and row in visited_rows:
+            continue
+        members, prefix_m = graph.prefix(row, target_distance_m - distance_m)
+        if target_distance_m <= distance_m + prefix_m <= max_distance_m:
+            hops.append((row, members, prefix_m))
+    return rng.choice(hops) if hops else None
+
+
 def _build_route_from_start(
-    start_node_id: int,
-    edges: Dict[int, Edge],
-    adjacency: Adjacency,
+    start_node_index: int,
+    graph: Union[CompactGraph, ContractedGraph],
     min_distance_m: float,
     max_distance_m: float,
     max_steps: int,
-    matching_edge_ids: Optional[Set[int]] = None,
+    matching_mask: Optional[np.ndarray] = None,
     tag_bias: float = 0.0,
     distance_bias: float = 0.0,
     edge_reuse_penalty: float = 0.0,
     allow_edge_reuse: bool = False,
+    profile_search=None,
+    edge_sampler=None,
+    rng=random,
 ) -> Optional[Route]:
-    node_ids = [start_node_id]
-    edge_ids: List[int] = []
+    node_indices = [start_node_index]
+    edge_rows: List[int] = []
     distance_m = 0.0
-    current_node_id = start_node_id
-    target_distance_m = (min_distance_m + max_distance_m) / 2
+    current_node_index = start_node_index
     edge_visit_counts: Dict[int, int] = {}
+    # nodes left through an edge in edge_visit_counts
+    visited_nodes: Set[int] = set()
+    offsets = graph.offsets
+
+    target_distance_m = rng.uniform(min_distance_m, max_distance_m)
+    if profile_search is not None:
+        profile_search.reset()
+
+    for hop in range(1, max_steps + 1):
+        if edge_sampler is not None:
+            next_edge_row = edge_sampler.next_edge(
+                current_node_index,
+                max_distance_m - distance_m,
+                remaining_target_distance_m=target_distance_m - distance_m,
+                edge_visit_counts=edge_visit_counts,
+                visited_nodes=visited_nodes,
+                rng=rng,
+            )
+        else:
+            next_edge_row = _select_next_edge(
+                range(offsets[current_node_index], offsets[current_node_index + 1]),
+                graph,
+                max_distance_m - distance_m,
+                remaining_target_distance_m=target_distance_m - distance_m,
+                matching_mask=matching_mask,
+                tag_bias=tag_bias,
+                distance_bias=distance_bias,
+                edge_visit_counts=edge_visit_counts,
+                edge_reuse_penalty=edge_reuse_penalty,
+                allow_edge_reuse=allow_edge_reuse,
+                rng=rng,
+            )
+        last_members = None
+        if next_edge_row is None:
+            # every chain out of here overshoots max_distance_m whole, end partway along one
+            partial_hop = _final_partial_hop(
+                graph, current_node_index, distance_m, target_distance_m, max_distance_m,
+                edge_visit_counts, allow_edge_reuse=allow_edge_reuse, rng=rng,
+            )
+            if partial_hop is None:
+                break
+            next_edge_row, last_members, edge_distance_m = partial_hop
+        else:
+            edge_distance_m = float(graph.distance_m[next_edge_row])
+        edge_rows.append(next_edge_row)
+        edge_visit_counts[next_edge_row] = edge_visit_counts.get(next_edge_row, 0) + 1
+        visited_nodes.add(current_node_index)
+        distance_m += edge_distance_m
+        current_node_index = int(graph.edge_dst[next_edge_row])
+        node_indices.append(current_node_index)
+        if profile_search is not None:
+            profile_search.add_edge(next_edge_row, edge_distance_m, last_members)
+        if distance_m >= target_distance_m:
+            route = _route_from_rows(graph, node_indices, edge_rows, distance_m, last_members)
+            if profile_search is not None:
+                profile_search.offer(route)
+            return route
+        # checking at hops 1, 2, 4, 8, ... keeps the bound's cost small next to the walk
+        if profile_search is not None and hop & (hop - 1) == 0 and profile_search.hopeless(
+            distance_m, target_distance_m, max_distance_m
+        ):
+            profile_search.num_pruned += 1
+            return None
+    return None
+
 
-    target_distance_m = random.uniform(min_distance_m, max_distance_m)
-
-    for _ in range(max_steps):
-        next_edge_id = _select_next_edge(
-            adjacency.map.get(current_node_id, []),
-            edges,
-            max_distance_m - distance_m,
-            remaining_target_distance_m=target_distance_m - distance_m,
-            matching_edge_ids=matching_edge_ids,
-            tag_bias=tag_bias,
-            distance_bias=distance_bias,
-            edge_visit_counts=edge_visit_counts,
-            edge_reuse_penalty=edge_reuse_penalty,
-            allow_edge_reuse=allow_edge_reuse,
+@dataclass(frozen=True)
+class _RouteSearch:
+    """What build_routes walks and keeps, everything a generation task needs besides the graph."""
+    min_distance_m: float
+    max_distance_m: float
+    max_steps: int
+    tag_bias: float
+    distance_bias: float
+    edge_reuse_penalty: float
+    allow_edge_reuse: bool
+    user_profile: Optional[UserProfile]
+    score_tags: List[str]
+    max_routes: int
+    candidate_route_limit: int
+    route_similarity_threshold: float
+    # walks advanced together by a BatchWalker, 0 walks one at a time
+    batch_walks: int = 0
+    # round trips back to the start node, see loop_builder.py
+    loop: bool = False
+
+
+def _generate_routes(
+    graph: CompactGraph,
+    start_nodes: Sequence[int],
+    search: _RouteSearch,
+    max_attempts: int,
+    route_limit: Optional[int],
+    deadline: Optional[float],
+    rng=random,
+) -> list:
+    """
+    The attempt loop of build_routes. Returns, best first:
+        with a user profile     (allowed, score, route) of the profile's top candidates
+        with score tags         (tag score, route) of the top candidates
+        otherwise               the routes in the order they were found
+    """
+    # the walk runs over the contracted graph, routes come back with the original edges
+    walk_graph = graph.contracted
+    matching_mask: Optional[np.ndarray] = None
+    walk_matching_mask: Optional[np.ndarray] = None
+    if search.score_tags:
+        matching_mask = graph.tag_mask(search.score_tags)
+        walk_matching_mask = walk_graph.tag_mask(search.score_tags)
+
+    routes: List[Route] = []
+    scored_routes_heap: List[Tuple[float, int, Tuple[int, ...], Route]] = []
+    scored_route_keys: Set[Tuple[int, ...]] = set()
+    scored_route_edge_sets: Dict[Tuple[int, ...], Set[int]] = {}
+    heap_counter = 0
+    candidate_route_limit = search.candidate_route_limit
+    route_similarity_threshold = search.route_similarity_threshold
+    profile_search = None
+    if search.user_profile is not None:
+        from .profile_search import ProfileSearch
+
+        # without the similarity filter only the first max_routes are ever taken
+        profile_search = ProfileSearch(
+            walk_graph,
+            search.user_profile,
+            k=search.max_routes if route_similarity_threshold >= 1.0 else candidate_route_limit,
         )
-        if next_edge_id is None:
+    from .edge_sampler import EdgeSampler, static_edge_weights
+
+    # the tag bias is fixed for the whole request, only the per-hop terms are left to each step
+    edge_sampler = EdgeSampler(
+        walk_graph,
+        static_edge_weights(walk_graph, search.score_tags, search.tag_bias),
+        distance_bias=search.distance_bias,
+        edge_reuse_penalty=search.edge_reuse_penalty,
+        allow_edge_reuse=search.allow_edge_reuse,
+    )
+
+    def keep(route: Optional[Route]):
+        # profile_search already scored the route as the walk finished
+        nonlocal heap_counter
+        if route is None or profile_search is not None:
+            return
+        if matching_mask is None:
+            routes.append(route)
+            return
+        route_key = tuple(route.edge_ids)
+        if route_key in scored_route_keys:
+            return
+
+        route_edge_set = set(route.edge_ids)
+        if route_similarity_threshold < 1.0 and any(
+            _route_edge_overlap_ratio(route.edge_ids, existing_edge_set, graph)
+            >= route_similarity_threshold
+            for existing_edge_set in scored_route_edge_sets.values()
+        ):
+            return
+
+        score = score_route_for_tag(route, graph, matching_mask)
+        if candidate_route_limit > 0:
+            if len(scored_routes_heap) < candidate_route_limit:
+                heapq.heappush(scored_routes_heap, (score, heap_counter, route_key, route))
+                scored_route_keys.add(route_key)
+                scored_route_edge_sets[route_key] = route_edge_set
+                heap_counter += 1
+            elif score > scored_routes_heap[0][0]:
+                _, _, evicted_key, _ = heapq.heapreplace(
+                    scored_routes_heap, (score, heap_counter, route_key, route)
+                )
+                scored_route_keys.remove(evicted_key)
+                scored_route_edge_sets.pop(evicted_key, None)
+                scored_route_keys.add(route_key)
+                scored_route_edge_sets[route_key] = route_edge_set
+                heap_counter += 1
+
+    def generated_routes() -> int:
+        return len(routes) if profile_search is None else profile_search.num_candidates
+
+    batch_walker = None
+    loop_walker = None
+    if search.loop:
+        from .loop_builder import LoopWalker
+
+        loop_walker = LoopWalker(
+            walk_graph,
+            edge_sampler.weights,
+            search.max_distance_m,
+            edge_reuse_penalty=search.edge_reuse_penalty,
+            allow_edge_reuse=search.allow_edge_reuse,
+        )
+    elif search.batch_walks > 1:
+        from .batch_walker import BatchWalker
+
+        batch_walker = BatchWalker(
+            walk_graph,
+            edge_sampler.weights,
+            distance_bias=search.distance_bias,
+            edge_reuse_penalty=search.edge_reuse_penalty,
+            allow_edge_reuse=search.allow_edge_reuse,
+        )
+    attempts = 0
+    while attempts < max_attempts:
+        if deadline is not None and time.monotonic() >= deadline:
             break
-        edge = edges[next_edge_id]
-        edge_ids.append(next_edge_id)
-        edge_visit_counts[next_edge_id] = edge_visit_counts.get(next_edge_id, 0) + 1
-        distance_m += edge.distance_m
-        current_node_id = edge.end_node
-        node_ids.append(current_node_id)
-        if distance_m >= target_distance_m:
-            return Route(node_ids=node_ids, edge_ids=edge_ids, distance_m=distance_m)
-    return None
+        if route_limit is not None and generated_routes() >= route_limit:
+            break
+
+        if batch_walker is not None:
+            num_walks = min(search.batch_walks, max_attempts - attempts)
+            attempts += num_walks
+            batch_routes = batch_walker.walk(
+                rng.choices(start_nodes, k=num_walks),
+                search.min_distance_m,
+                search.max_distance_m,
+                search.max_steps,
+                profile_search=profile_search,
+                rng=rng,
+            )
+            for route in batch_routes:
+                if route_limit is not None and profile_search is None and generated_routes() >= route_limit:
+                    break
+                keep(route)
+            continue
+
+        attempts += 1
+        start_node_index = rng.choice(start_nodes)
+        if loop_walker is not None:
+            keep(loop_walker.walk(
+                start_node_index, search.min_distance_m, search.max_steps, profile_search=profile_search, rng=rng
+            ))
+            continue
+        keep(_build_route_from_start(
+            start_node_index,
+            walk_graph,
+            search.min_distance_m,
+            search.max_distance_m,
+            search.max_steps,
+            matching_mask=walk_matching_mask,
+            tag_bias=search.tag_bias,
+            distance_bias=search.distance_bias,
+            edge_reuse_penalty=search.edge_reuse_penalty,
+            allow_edge_reuse=search.allow_edge_reuse,
+            profile_search=profile_search,
+            edge_sampler=edge_sampler,
+            rng=rng,
+        ))
+
+    if profile_search is not None:
+        return profile_search.best()
+    if matching_mask is not None:
+        return [(score, route) for score, _, _, route in sorted(scored_routes_heap, key=lambda x: x[0], reverse=True)]
+    return routes
+
+
+# graphs mapped by this (worker) process, by snapshot path, least recently used first;
+# the parent holds at most its cached regions and the whole graph
+ATTACHED_GRAPH_CACHE_SIZE = Config.REGION_CACHE_SIZE + 1
+_attached_graphs: "OrderedDict[str, Tuple[Tuple[int, int], CompactGraph]]" = OrderedDict()
+_route_pool: Optional[ProcessPoolExecutor] = None
+_route_pool_workers = 0
+_route_pool_lock = threading.Lock()
+
+def _attached_graph(snapshot_path: str) -> CompactGraph:
+    # temporary snapshots of region graphs are removed with their graph in the
+    # parent, let go of their mappings so the files are freed
+    for path in [path for path in _attached_graphs if not os.path.exists(path)]:
+        del _attached_graphs[path]
+
+    stat = os.stat(snapshot_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    attached = _attached_graphs.get(snapshot_path)
+    if attached is None or attached[0] != signature:
+        attached = _attached_graphs[snapshot_path] = (signature, open_snapshot(Path(snapshot_path)))
+        while len(_attached_graphs) > ATTACHED_GRAPH_CACHE_SIZE:
+            _attached_graphs.popitem(last=False)
+    _attached_graphs.move_to_end(snapshot_path)
+    return attached[1]
+
+def _generate_routes_task(
+    snapshot_path: str,
+    start_nodes: Sequence[int],
+    search: _RouteSearch,
+    max_attempts: int,
+    route_limit: Optional[int],
+    deadline: Optional[float],
+    rng_seed: int,
+) -> list:
+    return _generate_routes(
+        _attached_graph(snapshot_path), start_nodes, search, max_attempts, route_limit, deadline, random.Random(rng_seed)
+    )
+
+def _get_route_pool(workers: int) -> ProcessPoolExecutor:
+    global _route_pool, _route_pool_workers
+    with _route_pool_lock:
+        if _route_pool is None or _route_pool_workers != workers:
+            if _route_pool is not None:
+                _route_pool.shutdown(wait=False)
+            _route_pool = ProcessPoolExecutor(max_workers=workers)
+            _route_pool_workers = workers
+        return _route_pool
+
+def _generate_routes_parallel(
+    graph: CompactGraph,
+    start_nodes: Sequence[int],
+    search: _RouteSearch,
+    max_attempts: int,
+    route_limit: Optional[int],
+    deadline: Optional[float],
+    workers: int,
+    seed: Optional[int],
+) -> list:
+    """
+    _generate_routes split into tasks of Config.ROUTE_TASK_ATTEMPTS attempts, each
+    with its own random stream spawned from seed, run in a pool of worker processes
+    that map the graph from a snapshot file instead of receiving it pickled. The
+    tasks' results are merged like one run would rank them, in task order on ties,
+    so a seed gives the same result for any number of workers.
+    """
+    num_tasks = max(1, math.ceil(max_attempts / Config.ROUTE_TASK_ATTEMPTS))
+    task_seeds = [
+        int.from_bytes(child.generate_state(4).tobytes(), "little")
+        for child in np.random.SeedSequence(seed).spawn(num_tasks)
+    ]
+    task_attempts = [max_attempts // num_tasks + (i < max_attempts % num_tasks) for i in range(num_tasks)]
+    # every task may find all the routes, tasks that find few are made up for by the
+    # others and the merge below cuts the result to route_limit
+    task_route_limit = route_limit
+
+    if workers == 1:
+        results = [
+            _generate_routes(graph, start_nodes, search, attempts, task_route_limit, deadline, random.Random(task_seed))
+            for attempts, task_seed in zip(task_attempts, task_seeds)
+        ]
+    else:
+        snapshot_path = str(shared_snapshot_path(graph))
+        pool = _get_route_pool(workers)
+        futures = [
+            pool.submit(
+                _generate_routes_task,
+                snapshot_path, start_nodes, search, attempts, task_route_limit, deadline, task_seed,
+            )
+            for attempts, task_seed in zip(task_attempts, task_seeds)
+        ]
+        results = [future.result() for future in futures]
+
+    if search.user_profile is not None:
+        from .profile_search import merge_best
+
+        k = search.max_routes if search.route_similarity_threshold >= 1.0 else search.candidate_route_limit
+        return merge_best(results, k)
+    if search.score_tags:
+        merged = []
+        route_keys: Set[Tuple[int, ...]] = set()
+        for score, route in heapq.merge(*results, key=lambda entry: -entry[0]):
+            route_key = tuple(route.edge_ids)
+            if route_key not in route_keys and len(merged) < search.candidate_route_limit:
+                route_keys.add(route_key)
+                merged.append((score, route))
+        return merged
+    routes = [route for task_routes in results for route in task_routes]
+    return routes if route_limit is None else routes[:route_limit]
 
 
 def build_routes(
@@ -364,12 +748,39 @@ def build_routes(
     edge_reuse_penalty: float = 2.0,
     allow_edge_reuse: bool = False,
     return_scores: bool = False,
-) -> Union[List[Route], List[Tuple[Route, float]]]:
+    workers: int = Config.ROUTE_WORKERS,
+    seed: Optional[int] = None,
+    batch_walks: int = Config.ROUTE_BATCH_WALKS,
+    loop: bool = False,
+    return_graph: bool = False,
+) -> Union[List[Route], List[Tuple[Route, float]], Tuple[list, CompactGraph]]:
     """Build candidate routes.
 
+    Walks run over ``graph.contracted``, from junction to junction. They start
+    at the junctions within ``max_start_distance_m``, or where there are none at
+    the junctions the chains through that area start from, which can be farther
+    away. ``max_steps`` counts junction-to-junction hops, not original edges. A
+    walk that every chain ahead would take past ``max_distance_m`` ends partway
+    along one, so a long trail without junctions still gives routes (loops
+    cannot, they have to get back to their start).
+
     If ``time_budget_s`` is provided, route generation runs until the time budget
     (or ``max_attempts``) is reached. In that mode, ``max_routes`` controls only
     how many routes are returned.
+
+    With ``workers`` > 1 or a ``seed`` the attempts run as tasks in a process
+    pool, see _generate_routes_parallel; the same seed gives the same routes for
+    any number of workers.
+
+    With ``batch_walks`` > 1 the attempts are walked that many at a time in
+    lockstep, see batch_walker.py.
+
+    With ``loop`` every route ends back at its start node, see loop_builder.py;
+    loops are walked one at a time whatever ``batch_walks`` is.
+
+    With ``return_graph`` the result comes as ``(routes, graph)``, graph being the
+    one the routes were walked on; hand it to routes_to_geojson rather than
+    looking the area up again.
     """
     user_profile: Optional[UserProfile] = None
     if user_id:
@@ -392,116 +803,59 @@ def build_routes(
         raise ValueError("route_similarity_threshold must be in the range (0, 1]")
     if edge_reuse_penalty < 0:
         raise ValueError("edge_reuse_penalty must be non-negative")
-
-    nodes = load_nodes()
-    edges = load_edges()
-    adjacency = Adjacency(edges.values())
-    start_nodes = _candidate_start_nodes(
-        nodes, latitude, longitude, max_start_distance_m
-    )
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if batch_walks < 0:
+        raise ValueError("batch_walks must be non-negative")
+
+    # a walk never ends farther from its start than the distance walked
+    graph = get_graph_for_area(latitude, longitude, max_start_distance_m + max_distance_m)
+    # the walk runs over the contracted graph, routes come back with the original edges
+    walk_graph = graph.contracted
+    start_nodes = walk_graph.start_nodes(_candidate_start_nodes(
+        graph, latitude, longitude, max_start_distance_m, min_distance_m, allow_edge_reuse
+    )).tolist()
     if not start_nodes:
-        return []
+        return ([], graph) if return_graph else []
 
-    matching_edge_ids: Optional[Set[int]] = None
     if user_id:
         normalized_score_tags = _score_tags_from_user_id(user_id)
     else:
         normalized_score_tags = _normalize_tags(score_tag)
-    if normalized_score_tags:
-        matching_edge_ids = _load_matching_edge_ids(normalized_score_tags)
 
-    routes: List[Route] = []
-    scored_routes_heap: List[Tuple[float, int, Tuple[int, ...], Route]] = []
-    scored_route_keys: Set[Tuple[int, ...]] = set()
-    scored_route_edge_sets: Dict[Tuple[int, ...], Set[int]] = {}
-    heap_counter = 0
     candidate_route_limit = max_routes
     if (user_profile is not None or normalized_score_tags) and max_routes > 0:
         candidate_route_limit = min(max(max_routes * 10, 100), 5000)
     generated_route_limit = candidate_route_limit if user_profile is not None else max_routes
-    attempts = 0
-    start_time = time.monotonic()
-    while attempts < max_attempts:
-        if time_budget_s is not None and (time.monotonic() - start_time) >= time_budget_s:
-            break
-        if time_budget_s is None and len(routes) >= generated_route_limit:
-            break
-
-        attempts += 1
-        start_node_id = random.choice(start_nodes)
-        route = _build_route_from_start(
-            start_node_id,
-            edges,
-            adjacency,
-            min_distance_m,
-            max_distance_m,
-            max_steps,
-            matching_edge_ids=matching_edge_ids,
-            tag_bias=tag_bias,
-            distance_bias=distance_bias,
-            edge_reuse_penalty=edge_reuse_penalty,
-            allow_edge_reuse=allow_edge_reuse,
+    search = _RouteSearch(
+        min_distance_m=min_distance_m,
+        max_distance_m=max_distance_m,
+        max_steps=max_steps,
+        tag_bias=tag_bias,
+        distance_bias=distance_bias,
+        edge_reuse_penalty=edge_reuse_penalty,
+        allow_edge_reuse=allow_edge_reuse,
+        user_profile=user_profile,
+        score_tags=normalized_score_tags,
+        max_routes=max_routes,
+        candidate_route_limit=candidate_route_limit,
+        route_similarity_threshold=route_similarity_threshold,
+        batch_walks=batch_walks,
+        loop=loop,
+    )
+    deadline = None if time_budget_s is None else time.monotonic() + time_budget_s
+    route_limit = generated_route_limit if time_budget_s is None else None
+    if workers > 1 or seed is not None:
+        found = _generate_routes_parallel(
+            graph, start_nodes, search, max_attempts, route_limit, deadline, workers, seed
         )
-        if route is not None:
-            if user_profile is not None:
-                routes.append(route)
-            elif normalized_score_tags and matching_edge_ids is not None:
-                route_key = tuple(route.edge_ids)
-                if route_key in scored_route_keys:
-                    continue
-
-                route_edge_set = set(route.edge_ids)
-                if route_similarity_threshold < 1.0 and any(
-                    _route_edge_overlap_ratio(route.edge_ids, existing_edge_set, edges)
-                    >= route_similarity_threshold
-                    for existing_edge_set in scored_route_edge_sets.values()
-                ):
-                    continue
-
-                score = score_route_for_tag(route, edges, matching_edge_ids)
-                if candidate_route_limit > 0:
-                    if len(scored_routes_heap) < candidate_route_limit:
-                        heapq.heappush(scored_routes_heap, (score, heap_counter, route_key, route))
-                        scored_route_keys.add(route_key)
-                        scored_route_edge_sets[route_key] = route_edge_set
-                        heap_counter += 1
-                    elif score > scored_routes_heap[0][0]:
-                        _, _, evicted_key, _ = heapq.heapreplace(
-                            scored_routes_heap, (score, heap_counter, route_key, route)
-                        )
-                        scored_route_keys.remove(evicted_key)
-                        scored_route_edge_sets.pop(evicted_key, None)
-                        scored_route_keys.add(route_key)
-                        scored_route_edge_sets[route_key] = route_edge_set
-                        heap_counter += 1
-            else:
-                routes.append(route)
-
-    if user_profile is not None:
-        candidate_routes = routes
-    elif normalized_score_tags and matching_edge_ids is not None:
-        candidate_routes = [
-            route
-            for _, _, _, route in sorted(
-                scored_routes_heap,
-                key=lambda x: x[0],
-                reverse=True,
-            )
-        ]
-    elif time_budget_s is not None:
-        candidate_routes = routes[:max_routes]
     else:
-        candidate_routes = routes
+        found = _generate_routes(graph, start_nodes, search, max_attempts, route_limit, deadline)
 
     if user_profile is not None:
-        profile_scored_routes = score_routes_for_user_profile(
-            candidate_routes,
-            user_profile=user_profile,
-            edges=edges,
-        )
         selected_scored_routes = _select_diverse_top_routes(
-            profile_scored_routes,
-            edges=edges,
+            [(route, score) for _, score, route in found],
+            edges=graph,
             max_routes=max_routes,
             route_similarity_threshold=route_similarity_threshold,
         )
@@ -509,37 +863,36 @@ def build_routes(
         scored_routes = selected_scored_routes
     elif normalized_score_tags:
         tag_scored_routes = score_routes_for_tag(
-            candidate_routes,
+            [route for _, route in found],
             tag=normalized_score_tags,
-            edges=edges,
+            edges=graph,
         )
         selected_scored_routes = _select_diverse_top_routes(
             tag_scored_routes,
-            edges=edges,
+            edges=graph,
             max_routes=max_routes,
             route_similarity_threshold=route_similarity_threshold,
         )
         final_routes = [route for route, _ in selected_scored_routes]
         scored_routes = selected_scored_routes
     else:
-        final_routes = candidate_routes[:max_routes]
+        final_routes = found[:max_routes]
         scored_routes = [(route, 0.0) for route in final_routes]
 
     if return_scores:
-        return scored_routes
-
-    if normalized_score_tags:
-        return [route for route, _ in scored_routes]
-    return final_routes
+        result = scored_routes
+    elif normalized_score_tags:
+        result = [route for route, _ in scored_routes]
+    else:
+        result = final_routes
+    return (result, graph) if return_graph else result
 
 
-def _preferred_street_name(edge_ids: Sequence[int], edges: Dict[int, Edge], reverse: bool = False) -> Optional[str]:
+def _preferred_street_name(edge_ids: Sequence[int], edges: EdgeLookup, reverse: bool = False) -> Optional[str]:
     ordered_edge_ids = reversed(edge_ids) if reverse else edge_ids
     for edge_id in ordered_edge_ids:
-        edge = edges.get(edge_id)
-        if edge is None:
-            continue
-        street_name = edge.tags.get("name") if isinstance(edge.tags, dict) else None
+        tags = _edge_tags(edge_id, edges)
+        street_name = tags.get("name") if isinstance(tags, Mapping) else None
         if street_name:
             return street_name
     return None
@@ -548,7 +901,7 @@ def _preferred_street_name(edge_ids: Sequence[int], edges: Dict[int, Edge], reve
 def _route_name(
     route: Route,
     index: int,
-    edges: Dict[int, Edge],
+    edges: EdgeLookup,
 ) -> str:
     distance_miles = route.distance_m / MILES_TO_METERS
     start_street = _preferred_street_name(route.edge_ids, edges)
@@ -566,20 +919,20 @@ def _route_name(
 
 def routes_to_geojson(
     routes: Sequence[Route],
-    nodes: Dict[int, Node],
+    nodes: Union[Dict[int, Node], CompactGraph],
     route_scores: Optional[Dict[Tuple[int, ...], float]] = None,
     slim: bool = False,
     coord_stride: int = 1,
 ) -> dict:
-    from .feature_extraction import compute_route_features
+    from .feature_extraction import compute_routes_features
     
     features = []
-    edges = load_edges()
+    edges = nodes if isinstance(nodes, CompactGraph) else get_graph()
     coord_stride = max(1, int(coord_stride))
+    # extract feature information
+    all_route_features = compute_routes_features(routes, edges)
 
-    for index, route in enumerate(routes, start=1):
-        # extract feature information
-        route_features = compute_route_features(route, edges)
+    for index, (route, route_features) in enumerate(zip(routes, all_route_features), start=1):
         
         difficulty = None
         if route_features.difficulty_score <= 0.3:
@@ -599,7 +952,11 @@ def routes_to_geojson(
             if len(sampled) >= 2:
                 node_ids = sampled
 
-        coordinates = [[nodes[node_id].lon, nodes[node_id].lat] for node_id in node_ids]
+        if isinstance(nodes, CompactGraph):
+            node_indices = nodes.node_indices(node_ids)
+            coordinates = np.column_stack((nodes.lon[node_indices], nodes.lat[node_indices])).tolist()
+        else:
+            coordinates = [[nodes[node_id].lon, nodes[node_id].lat] for node_id in node_ids]
 
         # Payload minimization: the iOS client only needs geometry + a few properties.
         # Large arrays like `edge_ids`/`node_ids` and per-route score fields can easily
@@ -649,7 +1006,7 @@ def write_routes_geojson(
     path: Optional[Path] = None,
     route_scores: Optional[Dict[Tuple[int, ...], float]] = None,
 ) -> Path:
-    nodes = load_nodes()
+    nodes = get_graph()
     geojson = routes_to_geojson(routes, nodes, route_scores=route_scores)
     if path is None:
         path = Path(__file__).resolve().parent / "routes.geojson"
@@ -693,10 +1050,10 @@ PRESET_PARAMS = dict(
     longitude=-117.843058,
 
     # Route generation parameters
-    max_start_distance_m=250.0, # How far starting point can be from user location
+    max_start_distance_m=250.0, # How far starting point can be from user location (off a junction, the chain's start can be farther)
     max_routes=1000000, # Number of routes to return (after scoring and/or time budget)
     max_attempts=1000000, # Upper bound on generation attempts (loop iterations trying random starts/routes)
-    max_steps=2000000, # Max edges/hops per single route construction attempt before giving up.
+    max_steps=2000000, # Max junction-to-junction hops per single route construction attempt before giving up.
     time_budget_s=None,  # no time limit; generate until max_routes or max_attempts
 
     # Tag-based scoring parameters
@@ -705,6 +1062,11 @@ PRESET_PARAMS = dict(
     route_similarity_threshold=0.5, # How similar routes can be before being considered a duplicate (0.0 = no similarity allowed, 1.0 = identical routes only
     edge_reuse_penalty=2.0, # Used only when allow_edge_reuse=True; higher values make repeated edges less likely.
     allow_edge_reuse=False, # Prevents using the same edge twice within a single generated route.
+
+    # Parallel generation
+    workers=os.cpu_count() or 1, # Processes the attempts are spread over
+    seed=None, # Set for reproducible runs (same routes for any number of workers)
+    batch_walks=4096, # Walks each process advances together in lockstep (0 = one at a time)
 )
 
 if __name__ == "__main__":
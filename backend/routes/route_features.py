@@ -1,4 +1,8 @@
-from dataclasses import dataclass
+from collections import namedtuple
+from dataclasses import dataclass, fields
+from typing import Sequence
+
+import numpy as np
 
 @dataclass(frozen=True)
 class RouteFeatures:
@@ -86,4 +90,122 @@ class RouteFeatures:
             + 0.4 * self.residential_ratio
             - 0.3 * self.major_road_ratio
         )
-        return max(0.0, score)
\ No newline at end of file
+        return max(0.0, score)
+
+
+
+class FeatureValues(namedtuple("FeatureValues", [field.name for field in fields(RouteFeatures)])):
+    """RouteFeatures as a plain tuple with the same scores, cheap to build for bounds."""
+    __slots__ = ()
+    urban_score = RouteFeatures.urban_score
+    accessibility_score = RouteFeatures.accessibility_score
+    difficulty_score = RouteFeatures.difficulty_score
+    safety_score = RouteFeatures.safety_score
+
+# the fields that raise each score, the others lower it or do not enter it
+_SCORE_RAISED_BY = {
+    "urban_score": ("sidewalk_ratio", "lit_ratio", "residential_ratio"),
+    "accessibility_score": ("paved_ratio", "sidewalk_ratio", "lit_ratio"),
+    "difficulty_score": ("steps_ratio", "avg_incline", "trail_ratio", "rough_surface_ratio", "length_m"),
+    "safety_score": ("lit_ratio", "residential_ratio"),
+}
+SCORE_NAMES = tuple(_SCORE_RAISED_BY)
+_RAISED_MASKS = {
+    score: tuple(name in raised_by for name in FeatureValues._fields)
+    for score, raised_by in _SCORE_RAISED_BY.items()
+}
+
+def best_case(low: FeatureValues, high: FeatureValues, score: str) -> FeatureValues:
+    """
+    The features between low and high (field by field) with the highest value of score.
+    avg_incline bounds are on its absolute value, None counts as 0.
+    """
+    return FeatureValues(*[h if raised else l for raised, l, h in zip(_RAISED_MASKS[score], low, high)])
+
+def score_range(low: FeatureValues, high: FeatureValues, score: str) -> tuple[float, float]:
+    """Lowest and highest value of score for features between low and high."""
+    return getattr(best_case(high, low, score), score), getattr(best_case(low, high, score), score)
+
+
+@dataclass(frozen=True)
+class RouteFeatureBatch:
+    """
+    RouteFeatures of many routes as one array per field (avg_incline is NaN where None).
+    The scores are the RouteFeatures properties as array expressions.
+    """
+    length_m: np.ndarray
+    sidewalk_ratio: np.ndarray
+    lit_ratio: np.ndarray
+    residential_ratio: np.ndarray
+    major_road_ratio: np.ndarray
+    trail_ratio: np.ndarray
+    paved_ratio: np.ndarray
+    rough_surface_ratio: np.ndarray
+    accessible_ratio: np.ndarray
+    steps_ratio: np.ndarray
+    dog_friendly_ratio: np.ndarray
+    avg_incline: np.ndarray
+
+    @classmethod
+    def from_features(cls, features: Sequence[RouteFeatures]) -> "RouteFeatureBatch":
+        columns = {}
+        for field in fields(RouteFeatures):
+            values = [getattr(f, field.name) for f in features]
+            if field.name == "avg_incline":
+                values = [np.nan if v is None else v for v in values]
+            columns[field.name] = np.asarray(values, dtype=np.float64)
+        return cls(**columns)
+
+    def __len__(self) -> int:
+        return len(self.length_m)
+
+    def __getitem__(self, i: int) -> RouteFeatures:
+        values = {field.name: float(getattr(self, field.name)[i]) for field in fields(RouteFeatures)}
+        if np.isnan(values["avg_incline"]):
+            values["avg_incline"] = None
+        return RouteFeatures(**values)
+
+    @property
+    def urban_score(self) -> np.ndarray:
+        score = (
+            0.50 * self.sidewalk_ratio
+            + 0.35 * self.lit_ratio
+            + 0.40 * self.residential_ratio
+            - 0.05 * self.steps_ratio
+            - 0.05 * self.major_road_ratio
+            )
+        return np.clip(score, 0.0, 1.0)
+
+    @property
+    def accessibility_score(self) -> np.ndarray:
+        score = (
+            0.3 * self.paved_ratio 
+            + 0.3 * self.sidewalk_ratio 
+            + 0.2 * self.lit_ratio 
+            - 0.8 * self.steps_ratio
+            - 0.5 * self.rough_surface_ratio
+        )
+        return np.maximum(score, 0.0)
+
+    @property
+    def difficulty_score(self) -> np.ndarray:
+        incline_component = np.where(np.isnan(self.avg_incline), 0.0, np.abs(self.avg_incline))
+        distance_component = np.minimum(self.length_m / 5000.0, 1.0)
+
+        score = (
+            0.45 * self.steps_ratio
+            + 0.35 * incline_component
+            + 0.40 * self.trail_ratio
+            + 0.30 * self.rough_surface_ratio
+            + 0.45 * distance_component
+        )
+        return np.minimum(score, 1.0)
+
+    @property
+    def safety_score(self) -> np.ndarray:
+        score = (
+            0.6 * self.lit_ratio
+            + 0.4 * self.residential_ratio
+            - 0.3 * self.major_road_ratio
+        )
+        return np.maximum(score, 0.0)
@@ -1,5 +1,20 @@
 from dataclasses import dataclass
-from ..routes.route_features import RouteFeatures
+
+import numpy as np
+
+from ..routes.route_features import FeatureValues, RouteFeatureBatch, RouteFeatures, SCORE_NAMES, best_case, score_range
+
+def _top_k(values: np.ndarray, k: int | None) -> np.ndarray:
+    """Positions of the k largest values, largest first, ties in position order (like a stable sort)."""
+    if k is None or k >= len(values):
+        return np.argsort(-values, kind="stable")
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    kth = values[np.argpartition(-values, k - 1)[:k]].min()
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[:k - len(above)]
+    chosen = np.concatenate((above, ties))
+    return chosen[np.lexsort((chosen, -values[chosen]))]
 
 @dataclass
 class UserProfile:
@@ -83,6 +98,99 @@ class UserProfile:
 
         return base_score * difficulty_factor * (1 + self.step_goal_weight * step_factor)
     
+    def might_be_allowed(self, low: FeatureValues, high: FeatureValues) -> bool:
+        """Could a route with features between low and high be allowed?"""
+        # accessibility is highest with the fewest steps, which is all the checks want
+        return self.allowed(best_case(low, high, "accessibility_score"))
+
+    def score_upper_bound(self, low: FeatureValues, high: FeatureValues) -> float:
+        """No route with features between low and high (field by field) scores higher than this."""
+        ranges = {name: score_range(low, high, name) for name in SCORE_NAMES}
+        base_low = base_high = 0.0
+        for name, w in (
+            ("accessibility_score", self.accessibility_weight),
+            ("urban_score", self.urban_weight),
+            ("difficulty_score", self.difficulty_weight),
+            ("safety_score", self.safety_weight),
+        ):
+            score_low, score_high = ranges[name]
+            if w >= 0:
+                base_low += w * score_low
+                base_high += w * score_high
+            else:
+                base_low += w * score_high
+                base_high += w * score_low
+        base_scores = (base_low, base_high)
+
+        # the penalty only falls with difficulty, the step factor only grows with length
+        difficulty_factors = [self.difficulty_penalty(d, self.max_difficulty) for d in ranges["difficulty_score"]]
+        step_factors = [0.0]
+        if self.step_goal:
+            remaining_steps = max(0, self.step_goal - self.current_steps)
+            remaining_distance = remaining_steps * self.step_length_m
+            step_factors = [self.step_goal_factor(length, remaining_distance) for length in (low.length_m, high.length_m)]
+
+        return max(
+            base * difficulty * (1 + self.step_goal_weight * step)
+            for base in base_scores
+            for difficulty in difficulty_factors
+            for step in step_factors
+        )
+
+    def allowed_batch(self, batch: RouteFeatureBatch) -> np.ndarray:
+        """allowed for every route of the batch."""
+        allowed = np.ones(len(batch), dtype=bool)
+        if self.requires_wheelchair:
+            allowed &= (batch.accessibility_score >= 0.5) & (batch.steps_ratio <= 0)
+        if self.avoid_steps:
+            allowed &= batch.steps_ratio <= 0
+        return allowed
+
+    def score_batch(self, batch: RouteFeatureBatch) -> np.ndarray:
+        """score for every route of the batch."""
+        difficulty = batch.difficulty_score
+        base_score = (
+            self.accessibility_weight * batch.accessibility_score
+            + self.urban_weight * batch.urban_score
+            + self.difficulty_weight * difficulty
+            + self.safety_weight * batch.safety_score
+        )
+
+        difficulty_factor = np.ones(len(batch))
+        if self.max_difficulty is not None:
+            excess = difficulty - self.max_difficulty
+            difficulty_factor = np.where(excess <= 0, 1.0, np.maximum(0.0, 1 - 2 * excess))
+
+        step_factor = np.zeros(len(batch))
+        if self.step_goal:
+            remaining_steps = max(0, self.step_goal - self.current_steps)
+            remaining_distance = remaining_steps * self.step_length_m
+            if remaining_distance <= 0:
+                step_factor = np.full(len(batch), 0.5)
+            else:
+                step_factor = np.where(
+                    batch.length_m >= remaining_distance, 1.0, batch.length_m / remaining_distance
+                )
+
+        return base_score * difficulty_factor * (1 + self.step_goal_weight * step_factor)
+
+    def rank_batch(self, batch: RouteFeatureBatch, k: int | None = None, keep: np.ndarray | None = None):
+        """
+        Indices of the (at most k) best routes of the batch and their scores: allowed
+        routes by score, then the others by score, like sorting score and allowed
+        results. keep restricts the ranking to some routes.
+        """
+        scores = self.score_batch(batch)
+        allowed = self.allowed_batch(batch)
+        keep = np.ones(len(batch), dtype=bool) if keep is None else keep
+
+        ranked = []
+        for group in (np.flatnonzero(keep & allowed), np.flatnonzero(keep & ~allowed)):
+            remaining = None if k is None else k - sum(len(r) for r in ranked)
+            ranked.append(group[_top_k(scores[group], remaining)])
+        indices = np.concatenate(ranked)
+        return indices, scores[indices]
+
     def normalize_weights(self):
         total = (
             self.accessibility_weight +
@@ -5,3 +5,31 @@ class Config:
     # Main Overpass API; lz4.overpass-api.de often times out on large OC queries
     OVERPASS_URL = "https://overpass-api.de/api/interpreter"
     BATCH_SIZE = 1000
+
+    # tiled fetching (DataIngestion.fetch_tiled); overpass-api.de allows about 2 slots per client
+    OVERPASS_TILE_DEG = 0.1
+    OVERPASS_MAX_WORKERS = 2
+    OVERPASS_MAX_RETRIES = 5
+    OVERPASS_BACKOFF_S = 5.0
+
+    # compressed on-disk cache of Overpass responses (overpass_cache.py); the TTL stays under a
+    # day so a nightly refresh refetches. OVERPASS_OFFLINE serves only from the cache.
+    OVERPASS_CACHE_ENABLED = True
+    OVERPASS_CACHE_TTL_S = 12 * 3600
+    OVERPASS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+    OVERPASS_OFFLINE = False
+
+    # load a subgraph around each request instead of the whole graph, for regions
+    # too large to keep in memory (see graph_store.get_graph_for_area)
+    GRAPH_REGION_MODE = False
+    REGION_TILE_M = 5000
+    REGION_CACHE_SIZE = 8
+
+    # build_routes(workers=..., seed=...): attempts run as tasks of ROUTE_TASK_ATTEMPTS in a
+    # process pool, each task with its own random stream
+    ROUTE_WORKERS = 1
+    ROUTE_TASK_ATTEMPTS = 250
+
+    # build_routes(batch_walks=...): walks advanced together by the lockstep BatchWalker,
+    # 0 walks one at a time
+    ROUTE_BATCH_WALKS = 0